@@ -0,0 +1,46 @@
+"""
+Compares the cost of constructing Google API clients per call (googleapi.build)
+with the process-wide clients from src.utils.google_cloud.discovery_clients.
+
+Runs offline, with anonymous credentials:
+
+    python -m benchmarks.discovery_clients [iterations]
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import googleapiclient.discovery as googleapi
+from google.auth.credentials import AnonymousCredentials
+
+from src.utils.google_cloud import discovery_clients
+
+
+def per_call(name: str, version: str) -> None:
+    googleapi.build(name, version, credentials=AnonymousCredentials(), static_discovery=True)
+
+
+def shared(name: str, version: str) -> None:
+    discovery_clients.get_service(name, version)
+
+
+def measure(label: str, construct, iterations: int, threads: int = 1) -> None:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda _: construct("compute", "v1"), range(iterations)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {iterations:>5} x  {elapsed / iterations * 1000:9.3f} ms each")
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    discovery_clients.set_credentials(AnonymousCredentials())
+
+    measure("build per call", per_call, iterations)
+    measure("build per call, 8 threads", per_call, iterations, threads=8)
+    measure("shared client", shared, iterations)
+    measure("shared client, 8 threads", shared, iterations, threads=8)
+
+
+if __name__ == "__main__":
+    main()
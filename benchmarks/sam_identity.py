@@ -0,0 +1,50 @@
+"""
+Compares Terra authentication through SAM's /api/users/v2/self with and without the identity cache
+in src.auth, against the SAM stub from the tests, which answers after a fixed delay.
+
+Runs offline:
+
+    python -m benchmarks.sam_identity [requests] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+from src import auth
+from src.utils import http_clients
+from tests.fake_sam import FakeSAM
+
+SAM_DELAY = 0.02  # seconds
+
+
+async def measure(sam: FakeSAM, label: str, requests: int, concurrency: int, cached: bool) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+    before = sam.requests
+
+    async def authenticate(i: int) -> None:
+        async with semaphore:
+            if not cached:
+                auth._terra_users.clear()
+            # a handful of users, each sending many requests
+            await auth._get_terra_user(f"{auth.BEARER_PREFIX}user{i % 10}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(authenticate(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    lookups = sam.requests - before
+    print(f"{label:<16} {requests:>5} requests  {elapsed / requests * 1000:8.3f} ms each  {lookups:>5} SAM lookups")
+
+
+async def main() -> None:
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    sam = FakeSAM(SAM_DELAY)
+    await http_clients.set_transport(sam.transport)
+
+    await measure(sam, "without cache", requests, concurrency, cached=False)
+    await measure(sam, "with cache", requests, concurrency, cached=True)
+    await http_clients.close_http_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
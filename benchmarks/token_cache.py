@@ -0,0 +1,52 @@
+"""
+Compares the CPU cost of authenticating a request with an Azure B2C bearer token
+with and without the verified-token cache in src.auth.
+
+Runs offline, with a locally generated signing key:
+
+    python -m benchmarks.token_cache [iterations]
+"""
+import asyncio
+import sys
+import time
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from src import auth
+from src.utils import constants, metrics
+
+KID = "benchmark"
+
+
+def make_token() -> str:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    auth.jwks._keys = {KID: private_key.public_key()}
+    auth.jwks._expires = float("inf")
+    claims = {"sub": "user", "aud": constants.AZURE_B2C_CLIENT_ID, "exp": int(time.time()) + 3600}
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": KID})
+
+
+async def measure(label: str, auth_header: str, iterations: int, cached: bool) -> None:
+    start = time.process_time()
+    for _ in range(iterations):
+        if not cached:
+            auth._verified_tokens.clear()
+        await auth._get_azure_b2c_user(auth_header)
+    elapsed = time.process_time() - start
+    print(f"{label:<16} {iterations:>6} x  {elapsed / iterations * 1e6:9.1f} us CPU each")
+
+
+async def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    auth_header = auth.BEARER_PREFIX + make_token()
+
+    await measure("without cache", auth_header, iterations, cached=False)
+    await measure("with cache", auth_header, iterations, cached=True)
+    counters = metrics.snapshot()["counters"]
+    hits, misses = counters.get("verified_tokens.hits", 0), counters.get("verified_tokens.misses", 0)
+    print(f"cache hits: {hits:.0f}, misses: {misses:.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
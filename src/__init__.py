@@ -10,9 +10,16 @@ from sentry_sdk.integrations.quart import QuartIntegration
 from werkzeug.exceptions import HTTPException
 
 from src import cli, signaling, status
-from src.api_utils import get_allowed_origins
-from src.auth import register_terra_service_account
+from src.api_utils import STUDY_LIST_FIELDS, get_allowed_origins
+from src.auth import jwks, register_terra_service_account
 from src.utils import constants, custom_logging
+from src.utils.google_cloud.google_cloud_storage import close_upload_client
+from src.utils.http_clients import close_http_client
+from src.utils.jobs import JobQueue
+from src.utils.migrations import run_migrations
+from src.utils.signaling_backends import create_signaling_backend
+from src.utils.study_cache import PublicStudiesCache, StudyCache
+from src.utils.uploads import UploadConnection, UploadRequest
 from src.web import participants, study, web
 
 logger = custom_logging.setup_logging(__name__)
@@ -35,15 +42,36 @@ def create_app() -> Quart:
         )
 
     app = Quart(__name__)
+    app.request_class = UploadRequest
+    app.asgi_http_class = UploadConnection
 
     app = cors(app, allow_origin=get_allowed_origins())
 
+    # snapshot listeners are only available on the synchronous client
+    listener_client = firestore.Client(
+        project=constants.FIREBASE_PROJECT_ID,
+        database=constants.FIRESTORE_DATABASE,
+    )
+    db = firestore.AsyncClient(
+        project=constants.FIREBASE_PROJECT_ID,
+        database=constants.FIRESTORE_DATABASE,
+    )
     app.config.from_mapping(
         SECRET_KEY=secrets.token_hex(16),
-        DATABASE=firestore.AsyncClient(
-            project=constants.FIREBASE_PROJECT_ID,
-            database=constants.FIRESTORE_DATABASE,
+        DATABASE=db,
+        STUDY_CACHE=StudyCache(
+            listener_client,
+            max_size=constants.STUDY_CACHE_SIZE,
+            max_age=constants.STUDY_CACHE_MAX_AGE,
         ),
+        PUBLIC_STUDIES_CACHE=PublicStudiesCache(listener_client, fields=STUDY_LIST_FIELDS),
+        JOBS=JobQueue(
+            db,
+            workers=constants.JOB_WORKERS,
+            lease=constants.JOB_LEASE,
+            max_attempts=constants.JOB_MAX_ATTEMPTS,
+        ),
+        SIGNALING=create_signaling_backend(constants.SIGNALING_BACKEND, db, listener_client),
     )
 
     app.register_blueprint(status.bp)
@@ -53,11 +81,52 @@ def create_app() -> Quart:
     app.register_blueprint(study.bp)
     app.register_blueprint(signaling.bp)
 
+    @app.before_serving
+    async def _start_jwks_refresh():
+        jwks.start()
+
     @app.before_serving
     async def _register_terra_service_account():
         if constants.TERRA:
             await register_terra_service_account()
 
+    @app.before_serving
+    async def _run_migrations():
+        if constants.RUN_MIGRATIONS:
+            await run_migrations(app.config["DATABASE"])
+
+    @app.before_serving
+    async def _start_jobs():
+        # after migrations, so resumed jobs see migrated data
+        await app.config["JOBS"].start(app)
+
+    @app.before_serving
+    async def _start_signaling():
+        await app.config["SIGNALING"].start()
+
+    @app.after_serving
+    async def _stop_jwks_refresh():
+        await jwks.close()
+
+    @app.after_serving
+    async def _close_http_clients():
+        await close_http_client()
+        await close_upload_client()
+
+    @app.after_serving
+    async def _stop_jobs():
+        await app.config["JOBS"].close()
+
+    @app.after_serving
+    async def _stop_signaling():
+        await signaling.sessions.close()
+        await app.config["SIGNALING"].close()
+
+    @app.after_serving
+    async def _close_study_caches():
+        app.config["STUDY_CACHE"].close()
+        app.config["PUBLIC_STUDIES_CACHE"].close()
+
     @app.errorhandler(HTTPException)
     async def handle_exception(e: HTTPException):
         res = e.get_response()
@@ -68,13 +137,14 @@ def create_app() -> Quart:
 
     @app.after_request
     async def apply_security_headers(response: Response) -> Response:
-        # no caching
-        response.headers["Cache-Control"] = "no-store"
-        response.headers["Pragma"] = "no-cache"
+        # no caching, unless the endpoint has opted into revalidation
+        if "Cache-Control" not in response.headers:
+            response.headers["Cache-Control"] = "no-store"
+            response.headers["Pragma"] = "no-cache"
 
         # security
         response.headers["Access-Control-Allow-Headers"] = (
-            "authorization,content-type,accept,origin,x-app-id,x-mpc-study-id"
+            "authorization,content-type,accept,origin,x-app-id,x-mpc-study-id,x-mpc-session-token"
         )
         response.headers["Access-Control-Allow-Methods"] = (
             "GET,POST,PUT,PATCH,DELETE,OPTIONS,HEAD"
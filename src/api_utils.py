@@ -1,12 +1,14 @@
 import traceback
 import uuid
-from typing import Union
+from typing import Dict, Iterable, List, Optional, Union
 from urllib.parse import urlparse, urlunsplit
 
 import httpx
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 from google.cloud.firestore import AsyncDocumentReference
-from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1 import FieldFilter, Or
+from google.cloud.firestore_v1.field_path import FieldPath
 from jsonschema import ValidationError, validate
 from quart import current_app
 from sentry_sdk import capture_event
@@ -14,13 +16,19 @@ from werkzeug.exceptions import BadRequest, Forbidden, HTTPException
 from werkzeug.wrappers import Response
 
 from src.utils import constants, custom_logging
+from src.utils.migrations import is_migrated
 from src.utils.schemas.generic import generic_schema
+from src.utils.ttl_cache import TTLCache
 
 logger = custom_logging.setup_logging(__name__)
 
 ID_KEY = "sub"
 TERRA_ID_KEY = "id"
 
+_display_names: TTLCache[str, str] = TTLCache(
+    "display_names", max_size=constants.DISPLAY_NAME_CACHE_SIZE, ttl=constants.DISPLAY_NAME_CACHE_TTL
+)
+
 
 class APIException(HTTPException):
     def __init__(self, res: Union[httpx.Response, Response]):
@@ -54,48 +62,141 @@ def get_allowed_origins():
     return origins
 
 
-async def get_studies(private_filter=None) -> list:
+STUDY_LIST_FIELDS = [
+    "study_id",
+    "created",
+    "title",
+    "study_information",
+    "description",
+    "requested_participants",
+    "participants",
+    "owner",
+    "private",
+    "invited_participants",
+    "study_type",
+    "setup_configuration", # deprecated
+    "demo",
+]
+
+
+async def get_studies(
+    private_filter=None,
+    user_id: str = "",
+    email: str = "",
+    fields: Optional[List[str]] = None,
+    limit: Optional[int] = None,
+    start_after: str = "",
+) -> list:
+    """
+    Lists studies, projected onto STUDY_LIST_FIELDS (or the given subset of them).
+
+    :param private_filter: If set, only return studies whose "private" flag matches it.
+    :param user_id: If set, only return studies the user participates in (or is invited to, see email).
+    :param email: If set, also return studies the user is invited to by this email.
+    :param fields: Subset of STUDY_LIST_FIELDS to return; "study_id" is always included.
+    :param limit: Maximum number of studies to return, newest first.
+    :param start_after: Study ID of the last study on the previous page.
+    """
     db = current_app.config["DATABASE"]
-    desired_keys = [
-        "study_id",
-        "created",
-        "title",
-        "study_information",
-        "description",
-        "requested_participants",
-        "participants",
-        "owner",
-        "private",
-        "invited_participants",
-        "study_type",
-        "setup_configuration", # deprecated
-        "demo",
-    ]
+    desired_keys = sorted({"study_id", *fields}) if fields else STUDY_LIST_FIELDS
     try:
         studies_query = db.collection("studies").select(desired_keys)
         if private_filter is not None:
             studies_query = studies_query.where(filter=FieldFilter("private", "==", private_filter))
+
+        member_filters = []
+        if user_id:
+            member_filters.append(FieldFilter("participants", "array_contains", user_id))
+        if email:
+            member_filters.append(FieldFilter("invited_participants", "array_contains", email))
+        if len(member_filters) > 1:
+            studies_query = studies_query.where(filter=Or(member_filters))
+        elif member_filters:
+            studies_query = studies_query.where(filter=member_filters[0])
+
+        if limit or start_after:
+            studies_query = studies_query.order_by("created", direction=firestore.Query.DESCENDING)
+        if limit:
+            studies_query = studies_query.limit(limit)
+        if start_after:
+            cursor = await db.collection("studies").document(start_after).get(field_paths=["created"])
+            if not cursor.exists:
+                raise BadRequest("Invalid cursor")
+            studies_query = studies_query.start_after(cursor)
+
         studies = [doc.to_dict() async for doc in studies_query.stream()]
+    except BadRequest:
+        raise
     except Exception as e:
         raise RuntimeError({"error": "Failed to fetch studies", "details": str(e)}) from e
 
     return studies
 
 
-async def get_display_names() -> dict:
-    db = current_app.config["DATABASE"]
-    try:
-        doc_ref = await db.collection("users").document("display_names").get()
-        display_names = doc_ref.to_dict() or {}
-    except Exception as e:
-        raise RuntimeError({"error": "Failed to fetch display names", "details": str(e)}) from e
+async def get_display_names(user_ids: Iterable[str]) -> Dict[str, str]:
+    """
+    Looks up the display names of the given users, falling back to the user ID.
+
+    Names are read in one batch from the user documents, and cached for a short while.
+    Until the display_names migration has run, a name in the legacy users/display_names map
+    takes precedence, since that is where names used to be edited.
+    """
+    user_ids = set(user_ids)
+    display_names: Dict[str, str] = {}
+    missing = []
+    for user_id in user_ids:
+        if (display_name := _display_names.get(user_id)) is not None:
+            display_names[user_id] = display_name
+        elif user_id and "/" not in user_id:  # e.g. invited emails are not user IDs, but are still valid doc IDs
+            missing.append(user_id)
+
+    if missing:
+        db: firestore.AsyncClient = current_app.config["DATABASE"]
+        try:
+            legacy = await _get_legacy_display_names(db, missing)
+            refs = [db.collection("users").document(user_id) for user_id in missing]
+            async for doc in db.get_all(refs, field_paths=["display_name"]):
+                display_name = legacy.get(doc.id) or (doc.to_dict() or {}).get("display_name") or doc.id
+                _display_names.set(doc.id, display_name)
+                display_names[doc.id] = display_name
+        except Exception as e:
+            raise RuntimeError({"error": "Failed to fetch display names", "details": str(e)}) from e
 
-    return display_names
+    return {user_id: display_names.get(user_id, user_id) for user_id in user_ids}
 
 
-async def add_user_to_db(decoded_token: dict) -> None:
+async def _get_legacy_display_names(db: firestore.AsyncClient, user_ids: List[str]) -> Dict[str, str]:
+    if await is_migrated(db, "display_names"):
+        return {}
+    # read just these users' names from the legacy map document
+    field_paths = [FieldPath(user_id).to_api_repr() for user_id in user_ids]
+    return (await db.collection("users").document("display_names").get(field_paths=field_paths)).to_dict() or {}
+
+
+async def update_profile(user_id: str, fields: dict) -> None:
+    """
+    Updates the given fields of the user's document, e.g. "display_name" and "about". The user is also removed
+    from the legacy display names map, so that neither it nor its migration can override the new name.
+    """
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    await db.collection("users").document(user_id).set(fields, merge=True)
+    await db.collection("users").document("display_names").set({user_id: firestore.DELETE_FIELD}, merge=True)
+    forget_display_name(user_id)
+
+
+def forget_display_name(user_id: str) -> None:
+    """Drops the cached display name of a user in this process; call after changing it."""
+    _display_names.pop(user_id)
+
+
+async def add_user_to_db(decoded_token: dict) -> bool:
+    """
+    Creates the user's document unless it already exists, in a single write, so concurrent first logins
+    of the same user, e.g. on different workers, neither race nor overwrite each other.
+
+    :return: whether the user was created
+    """
     user_id = decoded_token[TERRA_ID_KEY] if constants.TERRA else decoded_token[ID_KEY]
-    logger.info(f"Creating user {user_id}")
     db = current_app.config["DATABASE"]
     try:
         display_name = user_id
@@ -109,16 +210,15 @@ async def add_user_to_db(decoded_token: dict) -> None:
                 display_name += " " + decoded_token["family_name"]
         if "emails" in decoded_token:
             email = decoded_token["emails"][0]
-        await db.collection("users").document("display_names").set({user_id: display_name}, merge=True)
-        await db.collection("users").document(user_id).set(
+        await db.collection("users").document(user_id).create(
             {
                 "about": "",
                 "notifications": [],
                 "email": email,
                 "display_name": display_name,
-            },
-            merge=True,
+            }
         )
+        logger.info(f"Created user {user_id}")
         if constants.SENTRY_DSN:
             capture_event(
                 {
@@ -129,6 +229,9 @@ async def add_user_to_db(decoded_token: dict) -> None:
                     },
                 }
             )
+        return True
+    except AlreadyExists:
+        return False
     except Exception as e:
         raise RuntimeError({"error": "Failed to create user", "details": str(e), "stacktrace": traceback.format_exc()}) from e
 
@@ -151,7 +254,7 @@ def validate_uuid(val) -> str:
 async def fetch_study(study_id: str, user_id: str = "") -> tuple[firestore.AsyncClient, AsyncDocumentReference, dict]:
     db: firestore.AsyncClient = current_app.config["DATABASE"]
     doc_ref = db.collection("studies").document(study_id)
-    doc_ref_dict = (await doc_ref.get()).to_dict() or {}
+    doc_ref_dict = await current_app.config["STUDY_CACHE"].get(doc_ref)
     if not doc_ref_dict:
         logger.error(f"Study not found: {study_id}")
         raise BadRequest("Study not found")
@@ -162,6 +265,11 @@ async def fetch_study(study_id: str, user_id: str = "") -> tuple[firestore.Async
     return db, doc_ref, doc_ref_dict
 
 
+def invalidate_study(study_id: str) -> None:
+    """Makes the next fetch_study() in this process read the study from Firestore; call after writing to it."""
+    current_app.config["STUDY_CACHE"].invalidate(study_id)
+
+
 def validate_json(data: dict, schema: dict = generic_schema) -> dict:
     try:
         validate(instance=data, schema=schema)
@@ -1,35 +1,60 @@
+import asyncio
+import hashlib
+import re
+import time
 from functools import wraps
 from http import HTTPMethod, HTTPStatus
-from typing import Dict, Set, Union
+from typing import Dict, List, Optional, Union
 
-import google.auth
-import httpx
 import jwt
-import requests
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
-from google.auth.transport.requests import Request as GAuthRequest
 from google.cloud import firestore
-from jwt import algorithms
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
 from quart import Request, Websocket, current_app, request
-from werkzeug.exceptions import Conflict, Unauthorized
+from werkzeug.exceptions import Conflict, ServiceUnavailable, Unauthorized
 
 from src.api_utils import ID_KEY, TERRA_ID_KEY, APIException, add_user_to_db
-from src.utils import constants, custom_logging
+from src.utils import constants, custom_logging, metrics
+from src.utils.http_clients import get_http_client
+from src.utils.jwks import JWKSManager
+from src.utils.migrations import is_migrated
+from src.utils.service_account import ServiceAccountCredentials
+from src.utils.ttl_cache import TTLCache
 
 logger = custom_logging.setup_logging(__name__)
 
 AUTH_HEADER = "Authorization"
 BEARER_PREFIX = "Bearer "
 
-PUBLIC_KEYS = {}
-USER_IDS: Set = set()
-
-
-# Prepare public keys from Microsoft's JWKS endpoint for token verification
-jwks = requests.get(constants.AZURE_B2C_JWKS_URL).json()
-for key in jwks["keys"]:
-    kid = key["kid"]
-    PUBLIC_KEYS[kid] = algorithms.RSAAlgorithm.from_jwk(key)
+AUTH_KEYS_COLLECTION = "auth_keys"
+AUTH_KEY_PATTERN = re.compile(r"[0-9a-zA-Z]{1,256}")
+
+# IDs of users whose document is known to exist, so that only their first request checks for it
+_known_users: TTLCache[str, bool] = TTLCache(
+    "known_users", max_size=constants.KNOWN_USER_CACHE_SIZE, ttl=constants.KNOWN_USER_CACHE_TTL
+)
+# users of CLI auth keys; keys that don't exist are cached as {} for AUTH_KEY_NEGATIVE_TTL
+_auth_keys: TTLCache[str, dict] = TTLCache(
+    "auth_keys", max_size=constants.AUTH_KEY_CACHE_SIZE, ttl=constants.AUTH_KEY_CACHE_TTL
+)
+# emails only change on first login, so they can share the display name cache settings
+_user_emails: TTLCache[str, str] = TTLCache(
+    "user_emails", max_size=constants.DISPLAY_NAME_CACHE_SIZE, ttl=constants.DISPLAY_NAME_CACHE_TTL
+)
+# verified claims of bearer tokens, keyed by the token's SHA-256, until the token expires
+_verified_tokens: TTLCache[str, dict] = TTLCache(
+    "verified_tokens", max_size=constants.VERIFIED_TOKEN_CACHE_SIZE, ttl=constants.VERIFIED_TOKEN_CACHE_MAX_TTL
+)
+# SAM identities of Terra bearer tokens, keyed by the Authorization header's SHA-256
+_terra_users: TTLCache[str, dict] = TTLCache(
+    "sam_identities", max_size=constants.SAM_IDENTITY_CACHE_SIZE, ttl=constants.SAM_IDENTITY_CACHE_TTL
+)
+_terra_user_lookups: Dict[str, "asyncio.Future[dict]"] = {}
+# public keys from Microsoft's JWKS endpoint for token verification, loaded on first use
+jwks = JWKSManager(constants.AZURE_B2C_JWKS_URL)
+# token of the service account that acts as CP0 on Terra, refreshed shortly before it expires
+service_account = ServiceAccountCredentials(["openid", "email", "profile"])
 
 
 def get_auth_header(req: Union[Request, Websocket]) -> str:
@@ -55,57 +80,71 @@ async def get_user_id(req: Union[Request, Websocket] = request) -> str:
         pass
 
     user_id = user[TERRA_ID_KEY] if constants.TERRA else user[ID_KEY]
-    if user_id in USER_IDS:
+    if _known_users.get(user_id):
         return user_id
 
-    # guard against possible confusion of user_id with auth_keys
-    # TODO: move auth_keys into a separate collection
+    # guard against possible confusion of user_id with the legacy users/auth_keys document
     if user_id == "auth_keys":
         logger.error("Attempted to use 'auth_keys' as user ID")
         raise Unauthorized("Invalid user ID")
 
-    db: firestore.AsyncClient = current_app.config["DATABASE"]
-    if not (await db.collection("users").document(user_id).get()).exists:
-        await add_user_to_db(user)
-    USER_IDS.add(user_id)
+    # the document is shared by all workers, so a worker that hasn't seen the user yet
+    # only pays for one create-if-absent write, which is a no-op for existing users
+    await add_user_to_db(user)
+    _known_users.set(user_id, True)
     return user_id
 
 
+def forget_user(user_id: str) -> None:
+    """Drops a user from this process's known users; call after deleting their document."""
+    _known_users.pop(user_id)
+
+
 async def _sam_request(
     method: HTTPMethod, path: str, headers: Dict[str, str], json: dict | None = None
 ):
-    async with httpx.AsyncClient() as http:
-        return await http.request(
-            method.name,
-            f"{constants.SAM_API_URL}{path}",
-            headers=headers,
-            json=json,
-        )
+    return await get_http_client().request(
+        method.name,
+        f"{constants.SAM_API_URL}{path}",
+        headers=headers,
+        json=json,
+    )
 
 
-async def _get_terra_user(auth_header: str):
-    res = await _sam_request(
-        HTTPMethod.GET,
-        "/api/users/v2/self",
-        headers={
-            AUTH_HEADER: auth_header,
-        },
-    )
+async def _get_terra_user(auth_header: str) -> dict:
+    key = hashlib.sha256(auth_header.encode()).hexdigest()
+    if (user := _terra_users.get(key)) is not None:
+        return dict(user)
+
+    # concurrent requests with the same token share one SAM lookup
+    lookup = _terra_user_lookups.get(key)
+    if lookup is None:
+        lookup = _terra_user_lookups[key] = asyncio.ensure_future(_lookup_terra_user(key, auth_header))
+        lookup.add_done_callback(lambda _: _terra_user_lookups.pop(key, None))
+    return dict(await asyncio.shield(lookup))
+
+
+async def _lookup_terra_user(key: str, auth_header: str) -> dict:
+    with metrics.timer("sam.self.seconds"):
+        res = await _sam_request(
+            HTTPMethod.GET,
+            "/api/users/v2/self",
+            headers={
+                AUTH_HEADER: auth_header,
+            },
+        )
 
     if res.status_code != HTTPStatus.OK.value:
         raise Unauthorized("Token is invalid")
 
-    return res.json()
+    user = res.json()
+    _terra_users.set(key, user)
+    return user
 
 
-def get_service_account_headers():
-    creds, _ = google.auth.default()
-    creds = creds.with_scopes(["openid", "email", "profile"])  # type: ignore
-    creds.refresh(GAuthRequest())
-    if creds.token is None:
-        raise ValueError("Token is None")
+async def get_service_account_headers() -> Dict[str, str]:
     return {
-        AUTH_HEADER: BEARER_PREFIX + creds.token,
+        AUTH_HEADER: BEARER_PREFIX + await service_account.get_token(),
     }
 
 
@@ -119,7 +158,7 @@ def get_cp0_id():
 async def register_terra_service_account() -> None:
     global _cp0_id
 
-    headers = get_service_account_headers()
+    headers = await get_service_account_headers()
     res = await _sam_request(
         HTTPMethod.POST,
         "/api/users/v2/self/register",
@@ -144,13 +183,21 @@ async def _get_azure_b2c_user(auth_header: str) -> dict:
         raise Unauthorized("Invalid Authorization header")
 
     token = auth_header[len(BEARER_PREFIX) :]
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    if (claims := _verified_tokens.get(token_hash)) is not None:
+        return dict(claims)
+
     headers = jwt.get_unverified_header(token)
     kid = headers["kid"]
 
-    if kid not in PUBLIC_KEYS:
+    try:
+        public_key = await jwks.get_key(kid)
+    except Exception as e:
+        # the keys have never loaded, so no token can be verified until they do
+        logger.error(f"Failed to load the public keys from {jwks.url}: {e}")
+        raise ServiceUnavailable("Unable to verify the token at the moment") from e
+    if public_key is None:
         raise Unauthorized("Invalid KID")
-
-    public_key = PUBLIC_KEYS[kid]
     if not isinstance(public_key, RSAPublicKey):
         raise ValueError("Invalid public key")
 
@@ -169,7 +216,10 @@ async def _get_azure_b2c_user(auth_header: str) -> dict:
     except jwt.InvalidTokenError as e:
         raise Unauthorized("Token is not valid") from e
 
-    return decoded_token
+    if (ttl := decoded_token.get("exp", 0) - time.time()) > 0:
+        _verified_tokens.set(token_hash, decoded_token, min(ttl, constants.VERIFIED_TOKEN_CACHE_MAX_TTL))
+    # callers may add to the claims, so they get their own copy
+    return dict(decoded_token)
 
 
 async def get_cli_user(req: Union[Request, Websocket]) -> dict:
@@ -180,17 +230,69 @@ async def get_cli_user(req: Union[Request, Websocket]) -> dict:
         if not auth_header:
             raise Unauthorized("Missing authorization key")
 
-        db: firestore.AsyncClient = current_app.config["DATABASE"]
-        doc_ref_dict = (
-            await db.collection("users").document("auth_keys").get()
-        ).to_dict() or {}
-        user = doc_ref_dict.get(auth_header) or None
-
+        user = await _get_auth_key_user(auth_header)
         if not user:
             raise Unauthorized("invalid authorization key")
     return user
 
 
+async def _get_auth_key_user(auth_key: str) -> Optional[dict]:
+    if not AUTH_KEY_PATTERN.fullmatch(auth_key):
+        return None
+    if (user := _auth_keys.get(auth_key)) is not None:
+        return user
+
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    user = (await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).get()).to_dict()
+    if user is None:
+        user = await _migrate_legacy_auth_key(db, auth_key)
+    if user:
+        _auth_keys.set(auth_key, user)
+    else:
+        _auth_keys.set(auth_key, {}, ttl=constants.AUTH_KEY_NEGATIVE_TTL)
+    return user
+
+
+async def _migrate_legacy_auth_key(db: firestore.AsyncClient, auth_key: str) -> Optional[dict]:
+    if await is_migrated(db, "auth_keys"):
+        return None
+    # read just this key from the legacy map document, and move it into the auth_keys collection
+    field_path = FieldPath(auth_key).to_api_repr()
+    legacy = (await db.collection("users").document("auth_keys").get(field_paths=[field_path])).to_dict() or {}
+    if user := legacy.get(auth_key):
+        logger.info(f"Migrating legacy auth key for user {user.get('username')}")
+        await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).set(user)
+    return user
+
+
+async def get_auth_key_options(username: str) -> List[dict]:
+    """Returns every auth key of the user, along with the study it belongs to."""
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    query = db.collection(AUTH_KEYS_COLLECTION).where(filter=FieldFilter("username", "==", username))
+    options = [(doc.to_dict() or {}) | {"auth_key": doc.id} async for doc in query.stream()]
+    if not await is_migrated(db, "auth_keys"):
+        # some of the user's keys may still be only in the legacy map, e.g. if one of them was migrated on use
+        legacy = (await db.collection("users").document("auth_keys").get()).to_dict() or {}
+        migrated = {option["auth_key"] for option in options}
+        for auth_key, user in legacy.items():
+            if user.get("username") == username and auth_key not in migrated:
+                await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).set(user)
+                options.append(user | {"auth_key": auth_key})
+    return options
+
+
+async def delete_auth_key(auth_key: str) -> None:
+    """
+    Deletes the auth key. Other instances may keep accepting it from their cache
+    for up to AUTH_KEY_CACHE_TTL seconds.
+    """
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    await db.collection(AUTH_KEYS_COLLECTION).document(auth_key).delete()
+    # also remove it from the legacy map, so that it cannot be migrated back
+    await db.collection("users").document("auth_keys").set({auth_key: firestore.DELETE_FIELD}, merge=True)
+    _auth_keys.pop(auth_key)
+
+
 async def get_cli_user_id():
     user = await get_cli_user(request)
     user_id = user[TERRA_ID_KEY] if constants.TERRA else user["username"]
@@ -201,9 +303,14 @@ async def get_cli_user_id():
 
 
 async def get_user_email(user_id: str) -> str:
+    if (email := _user_emails.get(user_id)) is not None:
+        return email
+
     db: firestore.AsyncClient = current_app.config["DATABASE"]
-    user = (await db.collection("users").document(user_id).get()).to_dict() or {}
-    return user.get("email", "")
+    user = (await db.collection("users").document(user_id).get(field_paths=["email"])).to_dict() or {}
+    email = user.get("email", "")
+    _user_emails.set(user_id, email)
+    return email
 
 
 def authenticate(f):
@@ -211,6 +318,8 @@ def authenticate(f):
     async def decorated_function(*args, **kwargs):
         try:
             user_id = await get_user_id()
+        except ServiceUnavailable:
+            raise
         except:
             logger.exception("Failed to authenticate user:")
             raise Unauthorized()
@@ -1,4 +1,3 @@
-import asyncio
 from dataclasses import dataclass
 from typing import Any, Dict, Tuple
 
@@ -6,11 +5,12 @@ from google.cloud.firestore import AsyncClient, AsyncDocumentReference
 from quart import Blueprint, current_app, request
 from werkzeug.exceptions import BadRequest, Conflict, Forbidden
 
-from src.auth import get_cli_user_id
+from src.auth import get_auth_key_options, get_cli_user_id
 from src.utils import constants, custom_logging
 from src.utils.api_functions import process_parameter, process_status, process_task
-from src.utils.google_cloud.google_cloud_storage import upload_blob_from_file
-from src.utils.studies_functions import setup_gcp, submit_terra_workflow
+from src.utils.jobs import enqueue_job
+from src.utils.studies_functions import submit_terra_workflow
+from src.utils.uploads import resumable_upload, stream_multipart_upload
 
 logger = custom_logging.setup_logging(__name__)
 bp = Blueprint("cli", __name__, url_prefix="/api")
@@ -49,8 +49,7 @@ async def _get_study():
     user_id, study_id = await _get_user_study_ids()
 
     study_ref = _get_db().collection("studies").document(study_id)
-    doc = await study_ref.get()
-    study = doc.to_dict()
+    study = await current_app.config["STUDY_CACHE"].get(study_ref)
     PARTICIPANTS_KEY = "participants"
     if not study or PARTICIPANTS_KEY in study and user_id not in study[PARTICIPANTS_KEY]:
         raise Forbidden()
@@ -64,29 +63,32 @@ async def _get_study():
 @bp.route("/upload_file", methods=["POST"])
 async def upload_file() -> Tuple[dict, int]:
     study: Study = await _get_study()
-    files = await request.files
-    logger.info(f"upload_file: {study.id}, request: {request}, request.files: {files}")
-
-    file = files.get("file", None)
-    if not file:
-        raise BadRequest("no file")
-    logger.info(f"filename: {file.filename}")
-
-    if "manhattan" in str(file.filename):
-        file_path = f"{study.id}/p{study.role}/manhattan.png"
-    elif "pca_plot" in str(file.filename):
-        file_path = f"{study.id}/p{study.role}/pca_plot.png"
-    elif str(file.filename) == "pos.txt":
-        file_path = f"{study.id}/pos.txt"
-    else:
-        file_path = f"{study.id}/p{study.role}/result.txt"
+    logger.info(f"upload_file: {study.id}, request: {request}")
 
-    upload_blob_from_file(constants.RESULTS_BUCKET, file, file_path)
-    logger.info(f"uploaded file {file.filename} to {file_path}")
+    filename, file_path = await stream_multipart_upload(request, study.id, study.role)
+    logger.info(f"uploaded file {filename} to {file_path}")
 
     return {}, 200
 
 
+@bp.route("/upload_file", methods=["PUT"])
+async def upload_file_resumable() -> Tuple[dict, int]:
+    """
+    Resumable variant of /upload_file: the body holds the part of the file given by Content-Range.
+    The first request starts the upload, and the rest pass its upload_id along.
+    The response tells the client how many bytes have been persisted, so it can resume from there after a failure.
+    """
+    study: Study = await _get_study()
+    filename = request.args.get("filename", "")
+    if not filename:
+        raise BadRequest("filename is required")
+
+    upload_id, committed, complete = await resumable_upload(
+        request, _get_db(), study.id, study.role, filename, request.args.get("upload_id", "")
+    )
+    return {"upload_id": upload_id, "committed": committed, "complete": complete}, 200
+
+
 @bp.route("/get_doc_ref_dict", methods=["GET"])
 async def get_doc_ref_dict() -> Tuple[dict, int]:
     study = await _get_study()
@@ -96,13 +98,7 @@ async def get_doc_ref_dict() -> Tuple[dict, int]:
 @bp.route("/get_study_options", methods=["GET"])
 async def get_study_options() -> Tuple[dict, int]:
     _, username = await get_cli_user_id()
-
-    auth_keys_doc = await _get_db().collection("users").document("auth_keys").get()
-    auth_keys = auth_keys_doc.to_dict() or {}
-
-    options = [value | {"auth_key": key} for key, value in auth_keys.items() if username == value["username"]]
-
-    return {"options": options}, 200
+    return {"options": await get_auth_key_options(username)}, 200
 
 
 @bp.route("/get_username", methods=["GET"])
@@ -128,7 +124,6 @@ async def update_firestore() -> Tuple[dict, int]:
     db = _get_db()
     if parameter.startswith("status="):
         return await process_status(
-            db,
             study.user_id,
             study.id,
             parameter,
@@ -138,7 +133,7 @@ async def update_firestore() -> Tuple[dict, int]:
             study.role,
         )
     elif parameter.startswith("task="):
-        return await process_task(db, study.user_id, parameter, study.ref)
+        return await process_task(study.user_id, parameter, study.ref)
     else:
         return await process_parameter(db, study.user_id, parameter, study.ref)
 
@@ -150,6 +145,6 @@ async def create_cp0() -> Tuple[dict, int]:
     if constants.TERRA:
         await submit_terra_workflow(study.id, "0")
     else:
-        asyncio.create_task(setup_gcp(study.ref, "0"))
+        await enqueue_job("setup_gcp", study.id, role="0")
 
     return {}, 200
@@ -1,19 +1,23 @@
 import asyncio
-from dataclasses import asdict, dataclass
+import functools
+import secrets
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
 from enum import Enum
-from typing import Dict, List
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
-from quart import Blueprint, Websocket, abort, websocket
+from quart import Blueprint, Websocket, abort, current_app, websocket
+from werkzeug.exceptions import Conflict
 
 from src.api_utils import fetch_study
 from src.auth import get_cli_user, get_user_id
-from src.utils import constants, custom_logging
+from src.utils import constants, custom_logging, metrics
+from src.utils.signaling_backends import PID, SignalingBackend
 
 bp = Blueprint("signaling", __name__, url_prefix="/api")
 logger = custom_logging.setup_logging(__name__)
 
-PID = int
-
 
 class MessageType(Enum):
     CANDIDATE = "candidate"
@@ -30,11 +34,19 @@ class Message:
     sourcePID: PID = -1
     targetPID: PID = -1
 
-    async def send(self, ws: Websocket):
+    def to_dict(self) -> dict:
         msg = asdict(self)
         for key, value in msg.items():
             if isinstance(value, Enum):
                 msg[key] = value.value
+        return msg
+
+    @staticmethod
+    def from_dict(msg: dict) -> "Message":
+        return Message(**(msg | {"type": MessageType(msg["type"])}))
+
+    async def send(self, ws: Websocket):
+        msg = self.to_dict()
         if self.type == MessageType.ERROR:
             logger.error("Sending error message: %s", msg)
         await ws.send_json(msg)
@@ -43,15 +55,333 @@ class Message:
     async def receive(ws: Websocket):
         msg = await ws.receive_json()
         logger.debug("Received: %s", msg)
-        msg["type"] = MessageType(msg["type"])
-        return Message(**msg)
+        return Message.from_dict(msg)
 
 
-# in-memory stores for Websockets
-study_barriers: Dict[str, asyncio.Barrier] = {}
-study_parties: Dict[str, Dict[PID, Websocket]] = {}
-
 STUDY_ID_HEADER = "X-MPC-Study-ID"
+SESSION_TOKEN_HEADER = "X-MPC-Session-Token"
+
+
+class PartyChannel:
+    """
+    Outbound side of one party's websocket.
+
+    Messages to the party are queued, up to SIGNALING_QUEUE_SIZE of them, and written by the channel's own task,
+    so a slow receiver never holds up the parties sending to it. A message that doesn't fit is rejected,
+    rather than growing the queue without bound or blocking its sender.
+    """
+
+    def __init__(self, study_id: str, pid: PID, ws: Websocket) -> None:
+        self.study_id = study_id
+        self.pid = pid
+        self.ws = ws
+        self.queue: "asyncio.Queue[Tuple[float, Message]]" = asyncio.Queue(constants.SIGNALING_QUEUE_SIZE)
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.latency = {"count": 0, "sum": 0.0, "max": 0.0}
+        self._sending: Optional[Message] = None
+        self.writer = asyncio.create_task(self._write())
+
+    def offer(self, msg: Message) -> bool:
+        """Queues the message for sending, and returns False if the queue is full."""
+        try:
+            self.queue.put_nowait((time.perf_counter(), msg))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.increment("signaling.dropped")
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    async def close(self) -> List[Message]:
+        """Stops the writer, and returns the messages that it hasn't sent, oldest first."""
+        self.writer.cancel()
+        await asyncio.gather(self.writer, return_exceptions=True)
+        unsent = [self._sending] if self._sending else []
+        while not self.queue.empty():
+            unsent.append(self.queue.get_nowait()[1])
+        self._sending = None
+        return unsent
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "latency": dict(self.latency),
+        }
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                queued, self._sending = await self.queue.get()
+                await self._sending.send(self.ws)
+                self._sending = None
+                self._record(time.perf_counter() - queued)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Failed to write to party %d in study %s: %s", self.pid, self.study_id, e)
+
+    def _record(self, latency: float) -> None:
+        self.sent += 1
+        self.latency["count"] += 1
+        self.latency["sum"] += latency
+        self.latency["max"] = max(self.latency["max"], latency)
+        metrics.observe("signaling.latency", latency)
+
+
+@dataclass
+class PartySession:
+    """
+    A party's place in a study's signaling, which outlives its websocket by SIGNALING_SESSION_TIMEOUT seconds.
+
+    While the party is disconnected, messages to it are kept, up to SIGNALING_REPLAY_SIZE of them,
+    and replayed when it reconnects with the session's token.
+    """
+
+    pid: PID
+    token: str = field(default_factory=lambda: _new_token())
+    channel: Optional[PartyChannel] = None
+    replay: Deque[Message] = field(default_factory=lambda: deque(maxlen=constants.SIGNALING_REPLAY_SIZE))
+    replay_dropped: int = 0
+    connects: int = 0
+    disconnected: Optional[float] = None
+    expiry: Optional[asyncio.Task] = None
+
+    def restart(self) -> None:
+        """Hands the session to a new client of the party, which gets a new token and none of the old messages."""
+        self.token = _new_token()
+        self.replay_dropped += len(self.replay)
+        self.replay.clear()
+
+    def buffer(self, msg: Message) -> None:
+        if len(self.replay) == self.replay.maxlen:
+            self.replay_dropped += 1
+            metrics.increment("signaling.replay_dropped")
+        self.replay.append(msg)
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.channel is not None,
+            "connects": self.connects,
+            "replay": len(self.replay),
+            "replay_dropped": self.replay_dropped,
+        } | (self.channel.stats() if self.channel else {})
+
+
+class StudyHub:
+    """
+    Relays signaling messages between the parties of one study, through the app's signaling backend.
+
+    The hub holds the sessions of the study's parties that are connected to this instance;
+    the others may be connected to any other instance that shares the backend.
+    A session stays joined to the backend while its party is briefly disconnected,
+    so the other parties can keep sending to it, and it leaves once its timeout runs out.
+    A party that reconnects to another instance takes its session, and the messages kept for it, along.
+    """
+
+    def __init__(self, study_id: str, backend: SignalingBackend, manager: "SessionManager") -> None:
+        self.study_id = study_id
+        self.backend = backend
+        self.manager = manager
+        self.sessions: Dict[PID, PartySession] = {}
+
+    async def connect(self, pid: PID, ws: Websocket, token: Optional[str]) -> PartySession:
+        """
+        Starts a session for the party, or resumes its session if the token matches, taking over from
+        any websocket that the session still has, on this instance or another one. A party that reconnects
+        without a token, e.g. because its client restarted, restarts its session here if the session is
+        disconnected.
+
+        :raises Conflict: If the party has a session on another instance that wasn't handed over,
+            a connected session here, or a session here whose token doesn't match the given one.
+        """
+        session = self.sessions.get(pid)
+        if session is None:
+            session = PartySession(pid)
+            if await self.backend.is_connected(self.study_id, pid):
+                replay = None if token is None else await self.backend.hand_over(self.study_id, pid, token)
+                if token is None or replay is None:
+                    raise Conflict(f"Party {pid} is already connected to study {self.study_id}")
+                logger.info("Party %d resumed its session in study %s from another instance", pid, self.study_id)
+                metrics.increment("signaling.resumed")
+                session.token = token
+                for msg in replay:
+                    session.buffer(Message.from_dict(msg))
+            self.sessions[pid] = session
+            try:
+                await self.backend.join(
+                    self.study_id,
+                    pid,
+                    functools.partial(self._deliver, session),
+                    functools.partial(self._hand_over, session),
+                )
+            except Exception:
+                del self.sessions[pid]
+                raise
+        elif token is not None and secrets.compare_digest(token, session.token):
+            logger.info("Party %d resumed its session in study %s", pid, self.study_id)
+            metrics.increment("signaling.resumed")
+        elif token is None and session.channel is None:
+            logger.info("Party %d restarted its disconnected session in study %s", pid, self.study_id)
+            metrics.increment("signaling.restarted")
+            session.restart()
+        else:
+            raise Conflict(f"Party {pid} is already connected to study {self.study_id}")
+
+        if session.expiry:
+            session.expiry.cancel()
+            session.expiry = None
+        if session.channel:
+            # the previous websocket is stale, e.g. half-open after a network change
+            for msg in await session.channel.close():
+                session.buffer(msg)
+
+        session.channel = PartyChannel(self.study_id, pid, ws)
+        session.disconnected = None
+        session.connects += 1
+        while session.replay:
+            session.channel.offer(session.replay.popleft())
+        return session
+
+    async def disconnect(self, session: PartySession, channel: PartyChannel) -> None:
+        """Detaches the websocket's channel from its session, and starts the session's timeout."""
+        if session.channel is not channel:
+            return  # already taken over by a newer websocket
+        session.channel = None
+        session.disconnected = time.monotonic()
+        for msg in await channel.close():
+            session.buffer(msg)
+        session.expiry = asyncio.create_task(self._expire(session))
+
+    async def route(self, msg: Message) -> None:
+        """Sends the message to its target party, and reports any problem back to its source party."""
+        source = self.sessions[msg.sourcePID]
+        if msg.targetPID < 0:
+            self._reply(source, Message(MessageType.ERROR, f"Missing target PID: {msg}"))
+        elif msg.targetPID == msg.sourcePID or not await self.backend.is_connected(self.study_id, msg.targetPID):
+            logger.error("Unexpected message is %s. Local parties are %s", msg, list(self.sessions))
+            self._reply(source, Message(MessageType.ERROR, f"Unexpected target id {msg.targetPID}"))
+        else:
+            await self.backend.publish(self.study_id, msg.targetPID, msg.to_dict())
+
+    async def close(self) -> None:
+        for session in list(self.sessions.values()):
+            if session.expiry:
+                session.expiry.cancel()
+            if session.channel:
+                await session.channel.close()
+            await self._leave(session)
+
+    def _reply(self, session: PartySession, msg: Message) -> None:
+        if session.channel:
+            session.channel.offer(msg)
+        else:
+            session.buffer(msg)
+
+    def _deliver(self, session: PartySession, data: dict) -> None:
+        msg = Message.from_dict(data)
+        if session.channel is None:
+            session.buffer(msg)
+            return
+        if session.channel.offer(msg) or msg.type == MessageType.ERROR:
+            return
+        logger.warning("Dropped message from party %d to party %d: queue is full", msg.sourcePID, session.pid)
+        error = Message(MessageType.ERROR, f"Party {session.pid} is not keeping up; message dropped")
+        task = asyncio.create_task(self.backend.publish(self.study_id, msg.sourcePID, error.to_dict()))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    async def _hand_over(self, session: PartySession, token: str) -> Optional[List[dict]]:
+        """Lets go of the session for another instance, if the token is the session's, and returns its messages."""
+        if self.sessions.get(session.pid) is not session or not secrets.compare_digest(token, session.token):
+            return None
+        logger.info("Handing the session of party %d in study %s over to another instance", session.pid, self.study_id)
+        metrics.increment("signaling.handed_over")
+        if session.expiry:
+            session.expiry.cancel()
+            session.expiry = None
+        if session.channel:
+            # the websocket is stale, as in connect; it's left to time out
+            channel, session.channel = session.channel, None
+            for msg in await channel.close():
+                session.buffer(msg)
+        replay = [msg.to_dict() for msg in session.replay]
+        await self._leave(session)
+        return replay
+
+    async def _expire(self, session: PartySession) -> None:
+        await asyncio.sleep(constants.SIGNALING_SESSION_TIMEOUT)
+        if session.channel is None and self.sessions.get(session.pid) is session:
+            logger.info("Session of party %d in study %s expired", session.pid, self.study_id)
+            metrics.increment("signaling.expired")
+            await self._leave(session)
+
+    async def _leave(self, session: PartySession) -> None:
+        del self.sessions[session.pid]
+        try:
+            await self.backend.leave(self.study_id, session.pid)
+        finally:
+            if not self.sessions:
+                self.manager.remove(self)
+
+
+class SessionManager:
+    """This instance's study hubs, which exist for as long as they have sessions."""
+
+    def __init__(self) -> None:
+        self.hubs: Dict[str, StudyHub] = {}
+
+    def hub(self, study_id: str, backend: SignalingBackend) -> StudyHub:
+        if study_id not in self.hubs:
+            self.hubs[study_id] = StudyHub(study_id, backend, self)
+        return self.hubs[study_id]
+
+    def remove(self, hub: StudyHub) -> None:
+        if self.hubs.get(hub.study_id) is hub:
+            del self.hubs[hub.study_id]
+
+    async def close(self) -> None:
+        for hub in list(self.hubs.values()):
+            await hub.close()
+
+    def stats(self) -> dict:
+        """Totals over all sessions, which say nothing about individual studies or parties."""
+        totals = {
+            "studies": len(self.hubs),
+            "sessions": 0,
+            "connected": 0,
+            "depth": 0,
+            "max_depth": 0,
+            "sent": 0,
+            "dropped": 0,
+            "replay": 0,
+            "replay_dropped": 0,
+        }
+        for hub in self.hubs.values():
+            for session in hub.sessions.values():
+                stats = session.stats()
+                totals["sessions"] += 1
+                totals["connected"] += stats["connected"]
+                totals["max_depth"] = max(totals["max_depth"], stats.get("max_depth", 0))
+                for key in ("depth", "sent", "dropped", "replay", "replay_dropped"):
+                    totals[key] += stats.get(key, 0)
+        return totals
+
+
+sessions = SessionManager()
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def hub_stats() -> dict:
+    return sessions.stats()
+
+
+def _new_token() -> str:
+    return secrets.token_urlsafe(32)
 
 
 @bp.websocket("/ice")
@@ -73,53 +403,49 @@ async def ice_ws():
         await Message(MessageType.ERROR, f"User {user_id} is not in study {study_id}").send(websocket)
         abort(403)
 
-    parties = study_parties.setdefault(study_id, {})
-    if pid in parties:
-        await Message(
-            MessageType.ERROR,
-            f"Party {pid} is already connected to study {study_id}",
-        ).send(websocket)
+    backend: SignalingBackend = current_app.config["SIGNALING"]
+    hub = sessions.hub(study_id, backend)
+    try:
+        # from now on, everything sent to this party goes through its session's channel
+        session = await hub.connect(
+            pid, websocket._get_current_object(), websocket.headers.get(SESSION_TOKEN_HEADER)  # type: ignore
+        )
+    except Conflict as e:
+        if not hub.sessions:
+            sessions.remove(hub)
+        await Message(MessageType.ERROR, str(e.description)).send(websocket)
         abort(409)
 
+    channel = session.channel
+    assert channel is not None
     try:
-        # store the current websocket for the party
-        parties[pid] = websocket._get_current_object()  # type: ignore
+        # the token lets the party resume this session if its connection drops
+        await websocket.accept(headers={SESSION_TOKEN_HEADER: session.token})
         logger.info("Registered websocket for party %d", pid)
 
-        # using a study-specific barrier,
-        # wait until all participants in a study are connected,
+        # wait until all participants in a study are connected, on any instance,
         # and then initiate the ICE protocol for it
-        barrier = study_barriers.setdefault(study_id, asyncio.Barrier(len(study_participants)))
-        async with barrier:
-            if pid == 0:
-                logger.info("PID %d: All parties have connected: %s", pid, parties)
+        await backend.wait_for_parties(study_id, len(study_participants))
+        if pid == 0 and session.connects == 1:
+            logger.info("PID %d: All parties have connected to study %s", pid, study_id)
 
-            while True:
-                logger.debug("pid: %d, parties: %s", pid, parties)
-                # read the next message and override its PID
-                # (this prevents PID spoofing)
-                msg = await Message.receive(websocket)
-                msg.sourcePID = pid
-                msg.studyID = study_id
-
-                # and send it to the other party
-                if msg.targetPID < 0:
-                    await Message(MessageType.ERROR, f"Missing target PID: {msg}").send(websocket)
-                    continue
-                elif msg.targetPID not in parties or msg.targetPID == pid:
-                    logger.error("Unexpected message is %s. Parties are %s", msg, parties)
-                    await Message(
-                        MessageType.ERROR,
-                        f"Unexpected target id {msg.targetPID}",
-                    ).send(websocket)
-                    continue
-                else:
-                    target_ws = parties[msg.targetPID]
-                    await msg.send(target_ws)
+        while True:
+            # read the next message and override its PID
+            # (this prevents PID spoofing);
+            # a half-open websocket never fails, so one that stays quiet for too long is dropped instead
+            msg = await asyncio.wait_for(Message.receive(websocket), constants.SIGNALING_IDLE_TIMEOUT)
+            msg.sourcePID = pid
+            msg.studyID = study_id
+
+            # and send it to the other party
+            await hub.route(msg)
+    except asyncio.TimeoutError:
+        logger.warning("Party %d in study %s was idle for %ss", pid, study_id, constants.SIGNALING_IDLE_TIMEOUT)
+        metrics.increment("signaling.idle")
     except Exception as e:
         logger.error("Terminal connection error for party %d in study %s: %s", pid, study_id, e)
     finally:
-        del parties[pid]
+        await hub.disconnect(session, channel)
         logger.warning("Party %d disconnected from study %s", pid, study_id)
 
 
@@ -1,8 +1,9 @@
 from typing import Tuple
 
-from quart import Blueprint
+from quart import Blueprint, current_app
 
-from src.utils import constants
+from src import signaling
+from src.utils import constants, metrics
 
 bp = Blueprint("status", __name__, url_prefix="")
 
@@ -15,3 +16,16 @@ async def status() -> Tuple[dict, int]:
 @bp.route("/version", methods=["GET"])
 async def version() -> Tuple[dict, int]:
     return {"appVersion": constants.APP_VERSION, "buildVersion": constants.BUILD_VERSION}, 200
+
+
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics() -> Tuple[dict, int]:
+    return (
+        metrics.snapshot()
+        | {
+            "study_cache": current_app.config["STUDY_CACHE"].stats(),
+            "jobs": current_app.config["JOBS"].stats(),
+            "signaling": signaling.hub_stats(),
+        },
+        200,
+    )
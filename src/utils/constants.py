@@ -38,6 +38,12 @@ AZURE_B2C_JWKS_URL = os.getenv(
     "https://sfkitdevb2c.b2clogin.com/sfkitdevb2c.onmicrosoft.com/discovery/v2.0/keys?p=B2C_1_signupsignin1",
 )
 
+# JWKS keys are cached for as long as the endpoint's Cache-Control allows, within these bounds
+JWKS_DEFAULT_TTL = float(os.getenv("JWKS_DEFAULT_TTL", "3600"))  # seconds
+JWKS_MIN_TTL = float(os.getenv("JWKS_MIN_TTL", "60"))
+JWKS_MAX_TTL = float(os.getenv("JWKS_MAX_TTL", "86400"))
+JWKS_UNKNOWN_KID_INTERVAL = float(os.getenv("JWKS_UNKNOWN_KID_INTERVAL", "30"))
+
 FIREBASE_API_KEY = os.getenv("FIREBASE_API_KEY")
 FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID", SERVER_GCP_PROJECT)
 FIRESTORE_DATABASE = os.getenv("FIRESTORE_DATABASE", "(default)")
@@ -48,6 +54,61 @@ SENDGRID_FROM_EMAIL = os.getenv("SENDGRID_FROM_EMAIL", "")
 SENTRY_DSN = os.getenv("SENTRY_DSN", "")
 SENTRY_ENVIRONMENT = os.getenv("SENTRY_ENVIRONMENT", "development")
 
+STUDY_CACHE_SIZE = int(os.getenv("STUDY_CACHE_SIZE", "256"))
+STUDY_CACHE_MAX_AGE = float(os.getenv("STUDY_CACHE_MAX_AGE", "300"))  # seconds
+DISPLAY_NAME_CACHE_SIZE = int(os.getenv("DISPLAY_NAME_CACHE_SIZE", "10000"))
+DISPLAY_NAME_CACHE_TTL = float(os.getenv("DISPLAY_NAME_CACHE_TTL", "60"))  # seconds
+KNOWN_USER_CACHE_SIZE = int(os.getenv("KNOWN_USER_CACHE_SIZE", "10000"))
+KNOWN_USER_CACHE_TTL = float(os.getenv("KNOWN_USER_CACHE_TTL", "600"))  # seconds
+AUTH_KEY_CACHE_SIZE = int(os.getenv("AUTH_KEY_CACHE_SIZE", "10000"))
+AUTH_KEY_CACHE_TTL = float(os.getenv("AUTH_KEY_CACHE_TTL", "300"))  # seconds
+AUTH_KEY_NEGATIVE_TTL = float(os.getenv("AUTH_KEY_NEGATIVE_TTL", "30"))  # seconds
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", "10000"))
+VERIFIED_TOKEN_CACHE_MAX_TTL = float(os.getenv("VERIFIED_TOKEN_CACHE_MAX_TTL", "3600"))  # seconds
+SAM_IDENTITY_CACHE_SIZE = int(os.getenv("SAM_IDENTITY_CACHE_SIZE", "10000"))
+SAM_IDENTITY_CACHE_TTL = float(os.getenv("SAM_IDENTITY_CACHE_TTL", "60"))  # seconds
+SERVICE_ACCOUNT_REFRESH_MARGIN = float(os.getenv("SERVICE_ACCOUNT_REFRESH_MARGIN", "300"))  # seconds
+IAM_PERMISSION_CACHE_SIZE = int(os.getenv("IAM_PERMISSION_CACHE_SIZE", "1000"))
+IAM_PERMISSION_CACHE_TTL = float(os.getenv("IAM_PERMISSION_CACHE_TTL", "300"))  # seconds
+IAM_PERMISSION_NEGATIVE_TTL = float(os.getenv("IAM_PERMISSION_NEGATIVE_TTL", "15"))  # seconds
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "")
+
+# limits for Compute Engine calls, which run on a thread pool
+COMPUTE_MAX_WORKERS = int(os.getenv("COMPUTE_MAX_WORKERS", "16"))
+COMPUTE_PROJECT_CONCURRENCY = int(os.getenv("COMPUTE_PROJECT_CONCURRENCY", "4"))
+COMPUTE_INVENTORY_TTL = float(os.getenv("COMPUTE_INVENTORY_TTL", "10"))  # seconds
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE = float(os.getenv("JOB_LEASE", "600"))  # seconds
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# result uploads are streamed to GCS in chunks of this size, which must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(4 * 1024 * 1024 * 1024)))
+# received upload bytes that may wait for the app to forward them; the client is paused while they do
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_SIZE", str(16 * 1024 * 1024)))
+# how long a resumable upload can be resumed for, which is how long GCS keeps its session
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(7 * 24 * 3600)))  # seconds
+# GCS calls run on a thread pool of this size, with one pooled connection per thread
+STORAGE_MAX_WORKERS = int(os.getenv("STORAGE_MAX_WORKERS", "16"))
+# results downloads are read from GCS in ranges of this size
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+# when set, results downloads return short-lived signed URLs by default, instead of proxying the bytes
+SIGNED_URL_DOWNLOADS = os.getenv("SIGNED_URL_DOWNLOADS", "")
+SIGNED_URL_TTL = int(os.getenv("SIGNED_URL_TTL", "900"))  # seconds
+# e.g. http://localhost:4443 for a local fake-gcs-server, whose download URLs need no signature
+STORAGE_EMULATOR_HOST = os.getenv("STORAGE_EMULATOR_HOST", "")
+
+# outbound signaling messages queued per websocket
+SIGNALING_QUEUE_SIZE = int(os.getenv("SIGNALING_QUEUE_SIZE", "256"))
+# "memory" keeps all parties of a study on one instance; "firestore" relays them across instances
+SIGNALING_BACKEND = os.getenv("SIGNALING_BACKEND", "memory")
+SIGNALING_PRESENCE_TTL = float(os.getenv("SIGNALING_PRESENCE_TTL", "60"))  # seconds
+# how long a disconnected party can resume its session, and how many messages are kept for it meanwhile
+SIGNALING_SESSION_TIMEOUT = float(os.getenv("SIGNALING_SESSION_TIMEOUT", "120"))  # seconds
+SIGNALING_REPLAY_SIZE = int(os.getenv("SIGNALING_REPLAY_SIZE", "256"))
+# a websocket that sends nothing for this long is treated as disconnected, and its party has to resume its session
+SIGNALING_IDLE_TIMEOUT = float(os.getenv("SIGNALING_IDLE_TIMEOUT", "300"))  # seconds
+
 PARAMETERS_TYPE = Dict[str, Union[Dict[str, Any], List[str]]]
 
 MPCGWAS_SHARED_PARAMETERS = {
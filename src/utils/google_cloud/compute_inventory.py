@@ -0,0 +1,98 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.utils import custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+
+class ComputeInventory:
+    """
+    Short-lived cache of the Compute Engine resources in one GCP project.
+
+    Resources are grouped by collection, which is the part of their URL between the project and the name,
+    e.g. "global/networks", "regions/us-central1/subnetworks" or "zones/us-central1-a/instances".
+    A collection can be cached as a full listing, or one name at a time (including names that don't exist),
+    and finished operations update the cache directly, so polling and re-listing don't hit the API.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._listings: Dict[str, Tuple[float, Dict[str, dict]]] = {}
+        self._lookups: Dict[Tuple[str, str], Tuple[float, Optional[dict]]] = {}
+        self._lock = threading.Lock()
+
+    def listing(self, collection: str, fetch: Callable[[], List[dict]]) -> List[dict]:
+        """Returns every resource in the collection, calling fetch() if it isn't cached."""
+        with self._lock:
+            cached = self._listings.get(collection)
+            if cached and cached[0] > time.monotonic():
+                metrics.increment("compute_inventory.hits")
+                return list(cached[1].values())
+
+        metrics.increment("compute_inventory.misses")
+        resources = fetch()
+        with self._lock:
+            self._listings[collection] = (
+                time.monotonic() + self.ttl,
+                {resource["name"]: resource for resource in resources},
+            )
+        return resources
+
+    def lookup(self, collection: str, name: str, fetch: Callable[[], Optional[dict]]) -> Optional[dict]:
+        """Returns the named resource, or None if it doesn't exist, calling fetch() if it isn't cached."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._listings.get(collection)
+            if cached and cached[0] > now:
+                metrics.increment("compute_inventory.hits")
+                return cached[1].get(name)
+            lookup = self._lookups.get((collection, name))
+            if lookup and lookup[0] > now:
+                metrics.increment("compute_inventory.hits")
+                return lookup[1]
+
+        metrics.increment("compute_inventory.misses")
+        resource = fetch()
+        with self._lock:
+            self._lookups[(collection, name)] = (time.monotonic() + self.ttl, resource)
+        return resource
+
+    def invalidate(self, collection: str, name: str = "") -> None:
+        with self._lock:
+            self._listings.pop(collection, None)
+            if name:
+                self._lookups.pop((collection, name), None)
+            else:
+                for key in [key for key in self._lookups if key[0] == collection]:
+                    del self._lookups[key]
+
+    def apply_operation(self, operation: dict) -> None:
+        """Updates the cache from a finished operation on a resource in this project."""
+        target = operation.get("targetLink", "")
+        if "/projects/" not in target:
+            return
+        # e.g. https://www.googleapis.com/compute/v1/projects/<project>/zones/<zone>/instances/<name>
+        collection, _, name = target.split("/projects/", 1)[1].split("/", 1)[1].rpartition("/")
+
+        if operation.get("operationType") == "delete" and "error" not in operation:
+            with self._lock:
+                if cached := self._listings.get(collection):
+                    cached[1].pop(name, None)
+                self._lookups[(collection, name)] = (time.monotonic() + self.ttl, None)
+        else:
+            # inserts and updates don't return the resource, so it's refetched on the next read
+            self.invalidate(collection, name)
+
+
+_inventories: Dict[str, ComputeInventory] = {}
+_inventories_lock = threading.Lock()
+
+
+def get_inventory(gcp_project: str, ttl: float) -> ComputeInventory:
+    """Returns the process-wide inventory of the project, shared by all GoogleCloudCompute clients."""
+    with _inventories_lock:
+        if gcp_project not in _inventories:
+            _inventories[gcp_project] = ComputeInventory(ttl)
+        return _inventories[gcp_project]
@@ -0,0 +1,72 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import google.auth
+import google_auth_httplib2
+import googleapiclient.discovery as googleapi
+import httplib2
+from google.auth.credentials import Credentials
+from googleapiclient.http import HttpRequest
+
+from src.utils import custom_logging
+
+logger = custom_logging.setup_logging(__name__)
+
+_lock = threading.RLock()
+_services: Dict[Tuple[str, str], googleapi.Resource] = {}
+_credentials: Optional[Credentials] = None
+_local = threading.local()
+
+
+def get_service(name: str, version: str) -> googleapi.Resource:
+    """
+    Returns the process-wide client for a Google API, e.g. get_service("compute", "v1").
+
+    Each client is built once, from the discovery document bundled with googleapiclient,
+    and is safe to share between threads: every request it builds is sent
+    over an authorized HTTP connection that belongs to the calling thread.
+    """
+    key = (name, version)
+    if service := _services.get(key):
+        return service
+    with _lock:
+        if key not in _services:
+            _services[key] = googleapi.build(
+                name,
+                version,
+                http=_thread_http(),
+                requestBuilder=_build_request,
+                static_discovery=True,
+            )
+            logger.info(f"Built {name} {version} API client")
+        return _services[key]
+
+
+def set_credentials(credentials: Optional[Credentials]) -> None:
+    """Replaces the credentials used by all clients, e.g. for local testing. Each thread reconnects on its next request."""
+    global _credentials
+    with _lock:
+        _credentials = credentials
+        _services.clear()
+
+
+def _get_credentials() -> Credentials:
+    global _credentials
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                _credentials, _ = google.auth.default()
+    return _credentials
+
+
+def _thread_http() -> google_auth_httplib2.AuthorizedHttp:
+    # httplib2 connections are not thread-safe, so each thread gets its own, reused across requests
+    credentials = _get_credentials()
+    http = getattr(_local, "http", None)
+    if http is None or http.credentials is not credentials:
+        http = _local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    return http
+
+
+def _build_request(_http: Any, *args: Any, **kwargs: Any) -> HttpRequest:
+    return HttpRequest(_thread_http(), *args, **kwargs)
@@ -1,9 +1,10 @@
+import asyncio
+import functools
 import os
 import re
-from time import sleep
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
 
-import googleapiclient.discovery as googleapi
 import ipaddr
 from googleapiclient.errors import HttpError
 from tenacity import retry
@@ -12,9 +13,17 @@ from tenacity.wait import wait_fixed
 
 from src.utils import constants, custom_logging
 from src.utils.generic_functions import is_create_vm
+from src.utils.google_cloud.compute_inventory import get_inventory
+from src.utils.google_cloud.discovery_clients import get_service
 
 logger = custom_logging.setup_logging(__name__)
 
+T = TypeVar("T")
+
+# googleapiclient only offers blocking calls, so they run on this pool instead of the event loop
+_executor = ThreadPoolExecutor(max_workers=constants.COMPUTE_MAX_WORKERS, thread_name_prefix="gcp-compute")
+_project_semaphores: Dict[str, asyncio.Semaphore] = {}
+
 
 class GoogleCloudCompute:
     """
@@ -27,73 +36,20 @@ class GoogleCloudCompute:
         self.network_name = f"{constants.NETWORK_NAME_ROOT}-{study_id}"
         self.firewall_name = f"{self.network_name}-vm-ingress"
         self.zone = constants.SERVER_ZONE
-        self.compute = googleapi.build("compute", "v1")
-
-    def delete_everything(self) -> None:
-        logger.info(f"Deleting gcp resources for study {self.study_id}...")
-        # if the network doesn't exist, there's nothing to delete
-        try:
-            self.compute.networks().get(project=self.gcp_project, network=self.network_name).execute()
-        except Exception as e:
-            logger.info(f"Cannot find network {self.network_name}; skipping deletion.")
-            return
-
-        self.remove_conflicting_peerings()
-
-        for instance in self.list_instances():
-            if instance[:-1] == format_instance_name(self.study_id, ""):
-                self.delete_instance(instance)
-
-        try:
-            firewalls: list = self.compute.firewalls().list(project=self.gcp_project).execute()["items"]
-        except:
-            logger.exception("Error getting firewalls:")
-            firewalls = []
-        firewall_names: list[str] = [firewall["name"] for firewall in firewalls]
-        for firewall_name in firewall_names:
-            if firewall_name == self.firewall_name:
-                self.delete_firewall(firewall_name)
-
-        try:
-            subnets: list = (
-                self.compute.subnetworks()
-                .list(project=self.gcp_project, region=constants.SERVER_REGION)
-                .execute()["items"]
-            )
-        except:
-            logger.exception("Error getting subnets:")
-            subnets = []
-        for subnet in subnets:
-            if subnet["name"][:-1] == create_subnet_name(self.network_name, ""):
-                self.delete_subnet(subnet)
-
-        self.delete_network()
-
-    def setup_networking(self, doc_ref_dict: dict, role: str) -> None:
-        logger.info(f"Setting up networking for role {role}...")
-        gcp_projects: list = [constants.SERVER_GCP_PROJECT]
-        gcp_projects_peerings: list = [constants.SERVER_GCP_PROJECT]
-
-        for username, participant in doc_ref_dict["participants"].items():
-            gcp_project = participant["GCP_PROJECT"]["value"]
-            gcp_projects.extend(gcp_project)
-
-            if is_create_vm(doc_ref_dict, username):
-                gcp_projects_peerings.extend(gcp_project)
-
-        self.create_network_if_it_does_not_already_exist(doc_ref_dict)
-        self.create_firewall(doc_ref_dict)
-        self.remove_conflicting_peerings(gcp_projects)
-        self.remove_conflicting_subnets(gcp_projects)
-        self.create_subnet(role)
-        if gcp_projects_peerings:
-            self.create_peerings(gcp_projects_peerings)
+        self.compute = get_service("compute", "v1")
+        self.inventory = get_inventory(gcp_project, constants.COMPUTE_INVENTORY_TTL)
+
+    def get_network(self) -> Optional[dict]:
+        return self.inventory.lookup(
+            "global/networks",
+            self.network_name,
+            lambda: first_item(
+                self.compute.networks().list(project=self.gcp_project, filter=f'name = "{self.network_name}"')
+            ),
+        )
 
     def create_network_if_it_does_not_already_exist(self, doc_ref_dict: dict) -> None:
-        networks: list = self.compute.networks().list(project=self.gcp_project).execute()["items"]
-        network_names: list[str] = [net["name"] for net in networks]
-
-        if self.network_name not in network_names:
+        if self.get_network() is None:
             logger.info(f"Creating new network {self.network_name}")
             req_body = {
                 "name": self.network_name,
@@ -107,23 +63,19 @@ class GoogleCloudCompute:
 
     def delete_network(self) -> None:
         try:
-            networks: list = self.compute.networks().list(project=self.gcp_project).execute()["items"]
+            network = self.get_network()
         except:
             logger.exception("Error getting networks:")
-            networks = []
-        network_names: list[str] = [net["name"] for net in networks]
+            network = None
 
-        if self.network_name in network_names:
+        if network is not None:
             logger.info(f"Deleting network {self.network_name}")
             operation = self.compute.networks().delete(project=self.gcp_project, network=self.network_name).execute()
             self.wait_for_operation(operation["name"])
 
     def create_firewall(self, doc_ref_dict) -> None:
         logger.info(f"Creating firewall {self.firewall_name}")
-        network_url: str = ""
-        for net in self.compute.networks().list(project=self.gcp_project).execute()["items"]:
-            if net["name"] == self.network_name:
-                network_url = net["selfLink"]
+        network_url: str = (self.get_network() or {}).get("selfLink", "")
 
         source_ranges: list = constants.SOURCE_IP_RANGES
         for participant in doc_ref_dict["participants"]:
@@ -140,17 +92,21 @@ class GoogleCloudCompute:
         }
 
         # Check if the firewall already exists
-        existing_firewalls = self.compute.firewalls().list(project=self.gcp_project).execute().get("items", [])
-
-        for firewall in existing_firewalls:
-            if firewall["name"] == self.firewall_name:
-                logger.info(f"Firewall {self.firewall_name} already exists. Skipping creation.")
-                return
+        if self.get_firewall(self.firewall_name) is not None:
+            logger.info(f"Firewall {self.firewall_name} already exists. Skipping creation.")
+            return
 
         # If the firewall doesn't already exist, create it
         operation = self.compute.firewalls().insert(project=self.gcp_project, body=firewall_body).execute()
         self.wait_for_operation(operation["name"])
 
+    def get_firewall(self, name: str) -> Optional[dict]:
+        return self.inventory.lookup(
+            "global/firewalls",
+            name,
+            lambda: first_item(self.compute.firewalls().list(project=self.gcp_project, filter=f'name = "{name}"')),
+        )
+
     def delete_firewall(self, firewall_name: str) -> None:
         if not firewall_name:
             firewall_name = self.firewall_name
@@ -164,38 +120,58 @@ class GoogleCloudCompute:
             else:
                 raise
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(10))
-    def remove_conflicting_peerings(self, allowed_gcp_projects: Optional[list] = None) -> bool:
-        if allowed_gcp_projects is None:
-            allowed_gcp_projects = []
+    def list_firewalls(self) -> list:
+        try:
+            return self.inventory.listing(
+                "global/firewalls",
+                lambda: all_items(self.compute.firewalls(), project=self.gcp_project),
+            )
+        except Exception:
+            logger.exception("Error getting firewalls:")
+            return []
 
-        # a peering is conflicting if it connects to a project that is not in the allowed_gcp_projects list
+    def list_subnets(self) -> list:
+        try:
+            return self._list_subnets()
+        except Exception:
+            logger.exception("Error getting subnets:")
+            return []
+
+    def _list_subnets(self) -> list:
+        return self.inventory.listing(
+            f"regions/{constants.SERVER_REGION}/subnetworks",
+            lambda: all_items(self.compute.subnetworks(), project=self.gcp_project, region=constants.SERVER_REGION),
+        )
+
+    def get_subnet(self, subnet_name: str, region: str = constants.SERVER_REGION) -> Optional[dict]:
+        return self.inventory.lookup(
+            f"regions/{region}/subnetworks",
+            subnet_name,
+            lambda: first_item(
+                self.compute.subnetworks().list(
+                    project=self.gcp_project, region=region, filter=f'name = "{subnet_name}"'
+                )
+            ),
+        )
+
+    def list_conflicting_peerings(self, allowed_gcp_projects: list) -> Optional[list]:
+        """Returns the projects of peerings that connect to a project not in allowed_gcp_projects, or None on error."""
         try:
-            network_info = self.compute.networks().get(project=self.gcp_project, network=self.network_name).execute()
+            peerings = self.get_existing_peerings()
         except:
             logger.exception("Error getting network info:")
-            return False
-
-        peerings = [peer["name"].split("peering-")[1] for peer in network_info.get("peerings", [])]
+            return None
+        return [other_project for other_project in peerings if other_project not in allowed_gcp_projects]
 
-        for other_project in peerings:
-            if other_project not in allowed_gcp_projects:
-                logger.info(f"Deleting peering called {self.study_id}peering-{other_project}")
-                body = {"name": f"{self.study_id}peering-{other_project}"}
-                self.compute.networks().removePeering(
-                    project=self.gcp_project, network=self.network_name, body=body
-                ).execute()
-                sleep(2)
-        return True
+    def remove_peering(self, other_project: str) -> None:
+        logger.info(f"Deleting peering called {self.study_id}peering-{other_project}")
+        body = {"name": f"{self.study_id}peering-{other_project}"}
+        self.compute.networks().removePeering(project=self.gcp_project, network=self.network_name, body=body).execute()
 
     def remove_conflicting_subnets(self, gcp_projects: list) -> None:
         # a subnet is conflicting if it has an IpCidrRange that
         # does not match the expected ranges based on the roles of participants in the study
-        subnets = (
-            self.compute.subnetworks()
-            .list(project=self.gcp_project, region=constants.SERVER_REGION)
-            .execute()["items"]
-        )
+        subnets = self._list_subnets()
         ip_ranges = [f"10.0.{i}.0/24" for i in range(3) if gcp_projects[i] == self.gcp_project]
         for subnet in subnets:
             if self.network_name in subnet["network"] and subnet["ipCidrRange"] not in ip_ranges:
@@ -205,14 +181,7 @@ class GoogleCloudCompute:
 
     @retry(stop=stop_after_attempt(3), wait=wait_fixed(30))
     def delete_subnet(self, subnet: dict) -> None:
-        subnets = (
-            self.compute.subnetworks()
-            .list(project=self.gcp_project, region=constants.SERVER_REGION)
-            .execute()["items"]
-        )
-        subnet_names = [subnet["name"] for subnet in subnets]
-
-        if subnet["name"] not in subnet_names:
+        if self.get_subnet(subnet["name"]) is None:
             logger.info(f"Subnet {subnet['name']} does not exist. Skipping deletion.")
             return
 
@@ -220,42 +189,24 @@ class GoogleCloudCompute:
             self.delete_instance(instance)
 
         logger.info(f"Deleting subnet {subnet['name']}")
-        self.compute.subnetworks().delete(
-            project=self.gcp_project,
-            region=constants.SERVER_REGION,
-            subnetwork=subnet["name"],
-        ).execute()
-
-        # wait for the subnet to be deleted
-        for _ in range(30):
-            subnets = (
-                self.compute.subnetworks()
-                .list(project=self.gcp_project, region=constants.SERVER_REGION)
-                .execute()["items"]
+        operation = (
+            self.compute.subnetworks()
+            .delete(
+                project=self.gcp_project,
+                region=constants.SERVER_REGION,
+                subnetwork=subnet["name"],
             )
-            if subnet["name"] not in [sub["name"] for sub in subnets]:
-                return
-            sleep(2)
-
-        logger.error(f"Failure to delete subnet {subnet['name']}")
-        raise RuntimeError(f"Failure to delete subnet {subnet['name']}")
+            .execute()
+        )
+        self.wait_for_region_operation(constants.SERVER_REGION, operation["name"])
 
     @retry(stop=stop_after_attempt(3), wait=wait_fixed(30))
     def create_subnet(self, role: str, region: str = constants.SERVER_REGION) -> None:
         # create subnet if it doesn't already exist
         subnet_name = create_subnet_name(self.network_name, role)
-        subnets = (
-            self.compute.subnetworks()
-            .list(project=self.gcp_project, region=constants.SERVER_REGION)
-            .execute()["items"]
-        )
-        subnet_names = [subnet["name"] for subnet in subnets]
-        if subnet_name not in subnet_names:
+        if self.get_subnet(subnet_name, region) is None:
             logger.info(f"Creating subnet {subnet_name}")
-            network_url = ""
-            for net in self.compute.networks().list(project=self.gcp_project).execute()["items"]:
-                if net["name"] == self.network_name:
-                    network_url = net["selfLink"]
+            network_url: str = (self.get_network() or {}).get("selfLink", "")
 
             req_body = {
                 "name": subnet_name,
@@ -277,7 +228,10 @@ class GoogleCloudCompute:
                 body = {
                     "networkPeering": {
                         "name": f"{self.study_id}peering-{other_project}",
-                        "network": f"https://www.googleapis.com/compute/v1/projects/{other_project}/global/networks/{self.network_name}",
+                        "network": (
+                            f"https://www.googleapis.com/compute/v1/projects/{other_project}"
+                            f"/global/networks/{self.network_name}"
+                        ),
                         "exchangeSubnetRoutes": True,
                     }
                 }
@@ -300,16 +254,11 @@ class GoogleCloudCompute:
         delete: bool = True,
     ) -> str:
         logger.info(f"Setting up instance {name}...")
-        if name in self.list_instances() and delete:
+        if self.get_instance(name) is not None and delete:
+            # returns once the deletion has finished, which also records it in the inventory
             self.delete_instance(name)
-            logger.info(f"Waiting for instance {name} to be deleted")
 
-            max_wait = 60
-            while name in self.list_instances() and max_wait > 0:
-                sleep(2)
-                max_wait -= 1
-
-        if name not in self.list_instances():
+        if self.get_instance(name) is None:
             try:
                 self.create_instance(name, role, num_cpus, boot_disk_size, metadata)
             except Exception as e:
@@ -347,8 +296,10 @@ class GoogleCloudCompute:
                         {
                             "type": "ONE_TO_ONE_NAT",
                             "name": "External NAT",
-                        }  # This is necessary to give the VM access to the internet, which it needs to do things like download the git repos.
-                        # See (https://cloud.google.com/compute/docs/reference/rest/v1/instances) for more information.  If it helps, the external IP address is ephemeral.
+                        }  # This is necessary to give the VM access to the internet,
+                        # which it needs to do things like download the git repos.
+                        # See (https://cloud.google.com/compute/docs/reference/rest/v1/instances) for more information.
+                        # If it helps, the external IP address is ephemeral.
                     ],
                 }
             ],
@@ -415,56 +366,88 @@ class GoogleCloudCompute:
     def list_instances(self, subnetwork: str = "") -> list[str]:
         logger.info("Listing VM instances...")
         try:
-            result = self.compute.instances().list(project=self.gcp_project, zone=self.zone).execute()
+            instances = self.inventory.listing(
+                f"zones/{self.zone}/instances",
+                lambda: all_items(self.compute.instances(), project=self.gcp_project, zone=self.zone),
+            )
         except:
             logger.exception("Error listing instances:")
             return []
         return [
             instance["name"]
-            for instance in result.get("items", [])
+            for instance in instances
             if subnetwork in instance["networkInterfaces"][0]["subnetwork"]
         ]
 
-    def delete_instance(self, name: str) -> None:
+    def list_study_instances(self) -> Dict[str, str]:
+        """
+        Lists the study's instances in every zone, since instance creation may have fallen back to another zone.
+
+        :return: The zone of each instance, keyed by instance name.
+        """
+        request = self.compute.instances().aggregatedList(
+            project=self.gcp_project, filter=f"name eq '{format_instance_name(self.study_id, '')}.*'"
+        )
+        instances: Dict[str, str] = {}
+        while request is not None:
+            response = request.execute()
+            for scope, scoped_list in response.get("items", {}).items():
+                for instance in scoped_list.get("instances", []):
+                    instances[instance["name"]] = scope.split("/")[-1]
+            request = self.compute.instances().aggregatedList_next(request, response)
+        return instances
+
+    def get_instance(self, name: str) -> Optional[dict]:
+        return self.inventory.lookup(
+            f"zones/{self.zone}/instances",
+            name,
+            lambda: first_item(
+                self.compute.instances().list(project=self.gcp_project, zone=self.zone, filter=f'name = "{name}"')
+            ),
+        )
+
+    def delete_instance(self, name: str, zone: str = "") -> None:
+        zone = zone or self.zone
         logger.info(f"Deleting VM instance with name {name}...")
-        operation = self.compute.instances().delete(project=self.gcp_project, zone=self.zone, instance=name).execute()
-        self.wait_for_zone_operation(self.zone, operation["name"])
+        operation = self.compute.instances().delete(project=self.gcp_project, zone=zone, instance=name).execute()
+        self.wait_for_zone_operation(zone, operation["name"])
+
+    # The wait() calls below block server-side until the operation is done (or for up to 2 minutes),
+    # which replaces polling get() every second.
 
     def wait_for_operation(self, operation: str) -> dict[str, str]:
         logger.info("Waiting for operation to finish...")
         while True:
-            result = self.compute.globalOperations().get(project=self.gcp_project, operation=operation).execute()
+            result = self.compute.globalOperations().wait(project=self.gcp_project, operation=operation).execute()
 
             if result["status"] == "DONE":
                 return self.return_result_or_error(result)
-            sleep(1)
 
     def wait_for_zone_operation(self, zone: str, operation: str) -> dict[str, str]:
         logger.info("Waiting for operation to finish...")
         while True:
             result = (
-                self.compute.zoneOperations().get(project=self.gcp_project, zone=zone, operation=operation).execute()
+                self.compute.zoneOperations().wait(project=self.gcp_project, zone=zone, operation=operation).execute()
             )
 
             if result["status"] == "DONE":
                 return self.return_result_or_error(result)
-            sleep(1)
 
     def wait_for_region_operation(self, region: str, operation: str) -> dict[str, str]:
         logger.info("Waiting for operation to finish...")
         while True:
             result: dict[str, str] = (
                 self.compute.regionOperations()
-                .get(project=self.gcp_project, region=region, operation=operation)
+                .wait(project=self.gcp_project, region=region, operation=operation)
                 .execute()
             )
 
             if result["status"] == "DONE":
                 return self.return_result_or_error(result)
-            sleep(1)
 
     def return_result_or_error(self, result: dict[str, str]) -> dict[str, str]:
         logger.info("Operation finished.")
+        self.inventory.apply_operation(result)
         if "error" in result:
             if "RESOURCE_NOT_FOUND" in str(result):
                 return result
@@ -478,6 +461,220 @@ class GoogleCloudCompute:
         return response["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
 
 
+class AsyncGoogleCloudCompute:
+    """
+    Async counterpart of GoogleCloudCompute, for use from request handlers and background tasks.
+
+    Every call runs on a bounded thread pool, so provisioning never blocks the event loop,
+    and at most COMPUTE_PROJECT_CONCURRENCY calls run at once for each GCP project.
+    """
+
+    def __init__(self, compute: GoogleCloudCompute) -> None:
+        self.sync = compute
+        self.study_id = compute.study_id
+        self.gcp_project = compute.gcp_project
+
+    @classmethod
+    async def create(cls, study_id: str, gcp_project: str) -> "AsyncGoogleCloudCompute":
+        loop = asyncio.get_running_loop()
+        return cls(await loop.run_in_executor(_executor, GoogleCloudCompute, study_id, gcp_project))
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        semaphore = _project_semaphores.setdefault(
+            self.gcp_project, asyncio.Semaphore(constants.COMPUTE_PROJECT_CONCURRENCY)
+        )
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+    async def delete_everything(self) -> Dict[str, str]:
+        """
+        Deletes the study's resources in this project, running independent deletions concurrently.
+
+        Instances go first, then subnets and firewalls, then peerings, then the network.
+        :return: The outcome of each resource deletion, keyed by resource.
+        """
+        logger.info(f"Deleting gcp resources for study {self.study_id} in project {self.gcp_project}...")
+        network_name = self.sync.network_name
+        # if the network doesn't exist, there's nothing to delete
+        try:
+            network = await self.run_isolated("get_network")
+        except Exception:
+            logger.exception(f"Error getting network {network_name}:")
+            network = None
+        if network is None:
+            logger.info(f"Cannot find network {network_name}; skipping deletion.")
+            return {}
+
+        instances, firewalls, subnets = await asyncio.gather(
+            self.run_isolated("list_study_instances"),
+            self.run_isolated("list_firewalls"),
+            self.run_isolated("list_subnets"),
+        )
+
+        plan = TeardownPlan(f"{self.gcp_project}/{network_name}")
+        instance_steps = [
+            plan.add(f"instance/{instance}", functools.partial(self.run_isolated, "delete_instance", instance, zone))
+            for instance, zone in instances.items()
+            if instance[:-1] == format_instance_name(self.study_id, "")
+        ]
+        cleanup_steps = [
+            plan.add(
+                f"firewall/{firewall['name']}",
+                functools.partial(self.run_isolated, "delete_firewall", firewall["name"]),
+                after=instance_steps,
+            )
+            for firewall in firewalls
+            if firewall["name"] == self.sync.firewall_name
+        ] + [
+            plan.add(
+                f"subnet/{subnet['name']}",
+                functools.partial(self.run_isolated, "delete_subnet", subnet),
+                after=instance_steps,
+            )
+            for subnet in subnets
+            if subnet["name"][:-1] == create_subnet_name(network_name, "")
+        ]
+        peerings_step = plan.add("peerings", self.remove_conflicting_peerings, after=cleanup_steps)
+        plan.add(
+            f"network/{network_name}", functools.partial(self.run_isolated, "delete_network"), after=[peerings_step]
+        )
+        return await plan.run()
+
+    async def delete_instances_and_firewall(self, names: List[str]) -> Dict[str, str]:
+        """
+        Deletes the given instances concurrently, then the study's firewall, keeping the network in place.
+
+        :return: The outcome of each resource deletion, keyed by resource.
+        """
+        existing: Dict[str, str] = await self.run_isolated("list_study_instances")
+        plan = TeardownPlan(f"{self.gcp_project}/{self.sync.network_name}")
+        instance_steps = [
+            plan.add(f"instance/{name}", functools.partial(self.run_isolated, "delete_instance", name, existing[name]))
+            for name in names
+            if name in existing
+        ]
+        plan.add(
+            f"firewall/{self.sync.firewall_name}",
+            functools.partial(self.run_isolated, "delete_firewall", ""),
+            after=instance_steps,
+        )
+        return await plan.run()
+
+    async def run_isolated(self, method: str, *args: Any) -> Any:
+        """
+        Runs a GoogleCloudCompute method on an instance of its own.
+
+        Instances keep per-call state, such as the zone an instance was created in,
+        so calls that run concurrently within a project must not share one.
+        """
+
+        def call() -> Any:
+            return getattr(GoogleCloudCompute(self.study_id, self.gcp_project), method)(*args)
+
+        return await self.run(call)
+
+    async def setup_networking(self, doc_ref_dict: dict, role: str) -> None:
+        logger.info(f"Setting up networking for role {role}...")
+        gcp_projects: list = [constants.SERVER_GCP_PROJECT]
+        gcp_projects_peerings: list = [constants.SERVER_GCP_PROJECT]
+
+        for username, participant in doc_ref_dict["participants"].items():
+            gcp_project = participant["GCP_PROJECT"]["value"]
+            gcp_projects.extend(gcp_project)
+
+            if is_create_vm(doc_ref_dict, username):
+                gcp_projects_peerings.extend(gcp_project)
+
+        await self.run(self.sync.create_network_if_it_does_not_already_exist, doc_ref_dict)
+        await self.run(self.sync.create_firewall, doc_ref_dict)
+        await self.remove_conflicting_peerings(gcp_projects)
+        await self.run(self.sync.remove_conflicting_subnets, gcp_projects)
+        await self.run(self.sync.create_subnet, role)
+        if gcp_projects_peerings:
+            await self.run(self.sync.create_peerings, gcp_projects_peerings)
+
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(10))
+    async def remove_conflicting_peerings(self, allowed_gcp_projects: Optional[list] = None) -> bool:
+        # a peering is conflicting if it connects to a project that is not in the allowed_gcp_projects list
+        conflicting = await self.run(self.sync.list_conflicting_peerings, allowed_gcp_projects or [])
+        if conflicting is None:
+            return False
+        for other_project in conflicting:
+            await self.run(self.sync.remove_peering, other_project)
+            # give the peering's removal time to settle before the next change to the network
+            await asyncio.sleep(2)
+        return True
+
+    async def setup_instance(self, name: str, role: str, metadata: list, **kwargs: Any) -> str:
+        return await self.run(self.sync.setup_instance, name, role, metadata, **kwargs)
+
+    async def delete_instance(self, name: str) -> None:
+        await self.run(self.sync.delete_instance, name)
+
+    async def stop_instance(self, name: str) -> None:
+        await self.run(self.sync.stop_instance, name)
+
+
+class TeardownPlan:
+    """
+    Dependency graph of resource deletions.
+
+    Each step starts as soon as the steps it depends on have finished,
+    and is skipped if any of them failed. Progress is logged per resource.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._steps: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._deps: Dict[str, List[str]] = {}
+
+    def add(self, resource: str, delete: Callable[[], Awaitable[Any]], after: Optional[List[str]] = None) -> str:
+        self._steps[resource] = delete
+        self._deps[resource] = list(after or [])
+        return resource
+
+    async def run(self) -> Dict[str, str]:
+        results: Dict[str, str] = {}
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def run_step(resource: str) -> None:
+            if self._deps[resource]:
+                await asyncio.wait([tasks[dep] for dep in self._deps[resource]])
+            if failed := [dep for dep in self._deps[resource] if results[dep] != "deleted"]:
+                results[resource] = f"skipped: {', '.join(failed)} not deleted"
+            else:
+                logger.info(f"[{self.name}] Deleting {resource}")
+                try:
+                    await self._steps[resource]()
+                    results[resource] = "deleted"
+                except Exception as e:
+                    logger.exception(f"[{self.name}] Failed to delete {resource}:")
+                    results[resource] = f"failed: {e}"
+            logger.info(f"[{self.name}] {resource}: {results[resource]}")
+
+        # steps are added after their dependencies, so every dependency task exists by the time it's awaited
+        for resource in self._steps:
+            tasks[resource] = asyncio.create_task(run_step(resource))
+        await asyncio.gather(*tasks.values())
+        return results
+
+
+def first_item(list_request: Any) -> Optional[dict]:
+    items = list_request.execute().get("items", [])
+    return items[0] if items else None
+
+
+def all_items(collection: Any, **kwargs: Any) -> list:
+    items = []
+    list_request = collection.list(**kwargs)
+    while list_request is not None:
+        response = list_request.execute()
+        items += response.get("items", [])
+        list_request = collection.list_next(list_request, response)
+    return items
+
+
 def format_instance_name(study_id: str, role: str) -> str:
     return f"{constants.INSTANCE_NAME_ROOT}-{study_id}---p{role}"
 
@@ -1,9 +1,47 @@
-import googleapiclient.discovery as googleapi
+import asyncio
+from typing import FrozenSet, Iterable, Set, Tuple
 
 from src.utils import constants, custom_logging
+from src.utils.google_cloud.discovery_clients import get_service
+from src.utils.ttl_cache import TTLCache
 
 logger = custom_logging.setup_logging(__name__)
 
+# permissions the website needs in a participant's project to set up their VM
+REQUIRED_PERMISSIONS: Tuple[str, ...] = (
+    "compute.disks.create",
+    "compute.firewalls.list",
+    "compute.firewalls.delete",
+    "compute.firewallPolicies.create",
+    "compute.firewallPolicies.get",
+    "compute.instances.create",
+    "compute.instances.delete",
+    "compute.instances.get",
+    "compute.instances.list",
+    "compute.instances.setMetadata",
+    "compute.instances.setServiceAccount",
+    "compute.instances.stop",
+    "compute.networks.access",
+    "compute.networks.addPeering",
+    "compute.networks.create",
+    "compute.networks.get",
+    "compute.networks.list",
+    "compute.networks.delete",
+    "compute.networks.removePeering",
+    "compute.networks.updatePolicy",
+    "compute.subnetworks.create",
+    "compute.subnetworks.delete",
+    "compute.subnetworks.list",
+    "compute.subnetworks.use",
+    "compute.subnetworks.useExternalIp",
+    "iam.serviceAccounts.actAs",
+)
+
+_permission_checks: TTLCache[Tuple[str, FrozenSet[str]], bool] = TTLCache(
+    "iam_permissions", max_size=constants.IAM_PERMISSION_CACHE_SIZE, ttl=constants.IAM_PERMISSION_CACHE_TTL
+)
+_permission_sets: Set[FrozenSet[str]] = set()
+
 
 class GoogleCloudIAM:
     """
@@ -11,7 +49,7 @@ class GoogleCloudIAM:
     """
 
     def __init__(self) -> None:
-        self.service = googleapi.build("cloudresourcemanager", "v1")
+        self.service = get_service("cloudresourcemanager", "v1")
         self.project = constants.SERVER_GCP_PROJECT
 
     def get_policy(self, version: int = 1) -> dict:
@@ -56,39 +94,11 @@ class GoogleCloudIAM:
         policy = self.modify_policy_add_member(policy, "roles/firebase.viewer", f"{member_type}:{user}")
         self.set_policy(policy)
 
-    def test_permissions(self, project_id: str) -> bool:
+    def test_permissions(self, project_id: str, desired_permissions: Iterable[str] = REQUIRED_PERMISSIONS) -> bool:
         """Tests IAM permissions of the caller"""
         logger.info(f"Testing IAM permissions for project: {project_id}")
 
-        desired_permissions = [
-            "compute.disks.create",
-            "compute.firewalls.list",
-            "compute.firewalls.delete",
-            "compute.firewallPolicies.create",
-            "compute.firewallPolicies.get",
-            "compute.instances.create",
-            "compute.instances.delete",
-            "compute.instances.get",
-            "compute.instances.list",
-            "compute.instances.setMetadata",
-            "compute.instances.setServiceAccount",
-            "compute.instances.stop",
-            "compute.networks.access",
-            "compute.networks.addPeering",
-            "compute.networks.create",
-            "compute.networks.get",
-            "compute.networks.list",
-            "compute.networks.delete",
-            "compute.networks.removePeering",
-            "compute.networks.updatePolicy",
-            "compute.subnetworks.create",
-            "compute.subnetworks.delete",
-            "compute.subnetworks.list",
-            "compute.subnetworks.use",
-            "compute.subnetworks.useExternalIp",
-            "iam.serviceAccounts.actAs",
-        ]
-
+        desired_permissions = sorted(desired_permissions)
         permissions = {"permissions": desired_permissions}
 
         returnedPermissions: dict = (
@@ -103,3 +113,28 @@ class GoogleCloudIAM:
             f"Missing permissions: {set(desired_permissions) - set(returnedPermissions.get('permissions', {}))}"
         )
         return False
+
+
+async def has_permissions(project_id: str, desired_permissions: Iterable[str] = REQUIRED_PERMISSIONS) -> bool:
+    """
+    Tests IAM permissions of the caller without blocking the event loop.
+
+    Results are cached per project and permission set, and missing permissions only briefly,
+    so that users who have just granted them can retry right away.
+    """
+    key = (project_id, frozenset(desired_permissions))
+    if (allowed := _permission_checks.get(key)) is not None:
+        return allowed
+
+    loop = asyncio.get_running_loop()
+    allowed = await loop.run_in_executor(None, GoogleCloudIAM().test_permissions, project_id, key[1])
+    _permission_checks.set(key, allowed, ttl=None if allowed else constants.IAM_PERMISSION_NEGATIVE_TTL)
+    _permission_sets.add(key[1])
+    return allowed
+
+
+def forget_permissions(*project_ids: str) -> None:
+    """Drops the cached permission checks of the given projects, e.g. after a participant changes GCP_PROJECT."""
+    for project_id in project_ids:
+        for permission_set in list(_permission_sets):
+            _permission_checks.pop((project_id, permission_set))
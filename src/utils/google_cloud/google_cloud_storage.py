@@ -1,13 +1,69 @@
-from typing import Optional
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, TypeVar
+from urllib.parse import quote
 
+import google.auth
+import httpx
 from google.api_core.exceptions import GoogleAPIError
+from google.auth.credentials import AnonymousCredentials, Credentials, Signing
+from google.auth.transport.requests import AuthorizedSession
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.cloud.storage import Blob
 from google.cloud.storage import Client as StorageClient
+from requests.adapters import HTTPAdapter
+from tenacity import retry
+from tenacity.retry import retry_if_exception_type
+from tenacity.stop import stop_after_attempt
+from tenacity.wait import wait_exponential
 from werkzeug.datastructures import FileStorage
 
-from src.utils import custom_logging
+from src.utils import constants, custom_logging, metrics
 
 logger = custom_logging.setup_logging(__name__)
 
+# GCS requires every chunk of a resumable upload, except the last, to be a multiple of this size
+RESUMABLE_CHUNK_QUANTUM = 256 * 1024
+
+_client: Optional[Tuple[StorageClient, Credentials]] = None
+_client_lock = threading.Lock()
+_http: Optional[httpx.AsyncClient] = None
+_executor = ThreadPoolExecutor(max_workers=constants.STORAGE_MAX_WORKERS, thread_name_prefix="gcs")
+
+T = TypeVar("T")
+
+
+def get_storage_client() -> StorageClient:
+    """Returns the process-wide storage client, which is thread-safe and keeps its connections alive."""
+    return _get_client()[0]
+
+
+def get_storage_credentials() -> Credentials:
+    """Returns the credentials that the storage client authenticates with."""
+    return _get_client()[1]
+
+
+def _get_client() -> Tuple[StorageClient, Credentials]:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                project: Optional[str]
+                if constants.STORAGE_EMULATOR_HOST:
+                    credentials, project = AnonymousCredentials(), None
+                else:
+                    credentials, project = google.auth.default(scopes=StorageClient.SCOPE)
+                session = AuthorizedSession(credentials)
+                # keep a connection for every executor thread, rather than requests' default of 10
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=constants.STORAGE_MAX_WORKERS)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _client = (StorageClient(project=project, credentials=credentials, _http=session), credentials)
+    return _client
+
 
 def upload_blob_from_filename(bucket_name: str, source_file_name: str, destination_blob_name: str) -> bool:
     """Upload a file to a Google Cloud Storage bucket using its file name.
@@ -18,7 +74,7 @@ def upload_blob_from_filename(bucket_name: str, source_file_name: str, destinati
     :return: True if successful, False otherwise.
     """
     try:
-        storage_client = StorageClient()
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
         blob.upload_from_filename(source_file_name)
@@ -40,7 +96,7 @@ def upload_blob_from_file(bucket_name: str, file_storage: FileStorage, destinati
     :return: True if successful, False otherwise.
     """
     try:
-        storage_client = StorageClient()
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
         blob.upload_from_file(file_storage)
@@ -59,7 +115,7 @@ def download_blob_to_bytes(bucket_name: str, source_blob_name: str) -> Optional[
     :return: The contents of the blob as bytes if successful, None otherwise.
     """
     try:
-        storage_client = StorageClient()
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(source_blob_name)
         return blob.download_as_bytes()
@@ -67,3 +123,264 @@ def download_blob_to_bytes(bucket_name: str, source_blob_name: str) -> Optional[
         logger.error(f"Error downloading blob {source_blob_name} from bucket {bucket_name}.")
         logger.error(e)
         return None
+
+
+def get_blob(bucket_name: str, blob_name: str) -> Optional[Blob]:
+    """Fetch a blob's metadata, e.g. its size, update time and generation, without downloading it.
+
+    :param bucket_name: The name of the GCS bucket.
+    :param blob_name: The name of the blob in the GCS bucket.
+    :return: The blob if it exists and could be fetched, None otherwise.
+    """
+    try:
+        return get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    except GoogleAPIError as e:
+        logger.error(f"Error fetching blob {blob_name} from bucket {bucket_name}: {e}")
+        return None
+
+
+def list_blobs(bucket_name: str, prefix: str = "") -> List[Blob]:
+    """List the blobs in a Google Cloud Storage bucket whose names start with a prefix.
+
+    :param bucket_name: The name of the GCS bucket.
+    :param prefix: The prefix of the blob names, e.g. "<study_id>/p1/".
+    :return: The blobs if successful, an empty list otherwise.
+    """
+    try:
+        return list(get_storage_client().list_blobs(bucket_name, prefix=prefix))
+    except GoogleAPIError as e:
+        logger.error(f"Error listing blobs with prefix {prefix} in bucket {bucket_name}: {e}")
+        return []
+
+
+def generate_download_url(blob: Blob, filename: str, expiration: int) -> str:
+    """Generate a V4 signed URL that lets its holder download a blob directly from GCS, until it expires.
+
+    Credentials without a private key, e.g. those of a Cloud Run service account, sign through the IAM API.
+    :param blob: The blob to download.
+    :param filename: The name that the browser should save the file under.
+    :param expiration: The number of seconds that the URL is valid for, at most 7 days.
+    :return: The signed URL.
+    """
+    if constants.STORAGE_EMULATOR_HOST:
+        # the emulator serves objects to anyone, and can't verify signatures anyway
+        return (
+            f"{constants.STORAGE_EMULATOR_HOST.rstrip('/')}/download/storage/v1/b/{blob.bucket.name}"
+            f"/o/{quote(blob.name, safe='')}?alt=media"
+        )
+
+    credentials = get_storage_credentials()
+    signing_kwargs = {}
+    if not isinstance(credentials, Signing):
+        if not credentials.valid:
+            credentials.refresh(GoogleAuthRequest())
+        signing_kwargs = {"service_account_email": credentials.service_account_email, "access_token": credentials.token}
+
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=timedelta(seconds=expiration),
+        method="GET",
+        response_disposition=f'attachment; filename="{filename}"',
+        **signing_kwargs,
+    )
+
+
+class AsyncStorage:
+    """
+    Async facade over the process-wide storage client, for use from request handlers.
+
+    Every call runs on a bounded thread pool, so blocking GCS I/O never stalls the event loop,
+    and its latency is recorded as the gcs.<method>.seconds timing.
+    """
+
+    async def run(self, method: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        with metrics.timer(f"gcs.{method}.seconds"):
+            return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+    async def exists(self, bucket_name: str, blob_name: str) -> bool:
+        return await self.metadata(bucket_name, blob_name) is not None
+
+    async def metadata(self, bucket_name: str, blob_name: str) -> Optional[Blob]:
+        """Returns the blob, with its size, update time and generation, or None if it doesn't exist."""
+        return await self.run("metadata", get_blob, bucket_name, blob_name)
+
+    async def metadata_many(self, bucket_name: str, blob_names: List[str]) -> Dict[str, Optional[Blob]]:
+        blobs = await asyncio.gather(*(self.metadata(bucket_name, name) for name in blob_names))
+        return dict(zip(blob_names, blobs))
+
+    async def list(self, bucket_name: str, prefix: str = "") -> List[Blob]:
+        """Returns the blobs whose names start with the prefix, or an empty list if they couldn't be listed."""
+        return await self.run("list", list_blobs, bucket_name, prefix)
+
+    async def download(self, bucket_name: str, blob_name: str) -> Optional[bytes]:
+        return await self.run("download", download_blob_to_bytes, bucket_name, blob_name)
+
+    async def download_many(self, bucket_name: str, blob_names: List[str]) -> Dict[str, Optional[bytes]]:
+        """Downloads the blobs concurrently; missing blobs map to None."""
+        contents = await asyncio.gather(*(self.download(bucket_name, name) for name in blob_names))
+        return dict(zip(blob_names, contents))
+
+    async def read_range(self, blob: Blob, start: int, end: int) -> AsyncIterator[bytes]:
+        """
+        Yields the bytes of a blob from start (inclusive) to end (exclusive), one DOWNLOAD_CHUNK_SIZE range at a time.
+
+        The reads are pinned to the blob's generation, so a blob that is overwritten meanwhile fails
+        rather than mixing the contents of both versions.
+        """
+        position = start
+        while position < end:
+            chunk_end = min(position + constants.DOWNLOAD_CHUNK_SIZE, end)
+            chunk = await self.run(
+                "read_range",
+                blob.download_as_bytes,
+                start=position,
+                end=chunk_end - 1,  # inclusive
+                if_generation_match=blob.generation,
+                checksum=None,
+            )
+            if not chunk:
+                return
+            yield chunk
+            position += len(chunk)
+
+    async def signed_url(self, blob: Blob, filename: str, expiration: int) -> str:
+        return await self.run("signed_url", generate_download_url, blob, filename, expiration)
+
+    async def create_upload_session(
+        self, bucket_name: str, blob_name: str, content_type: str, size: Optional[int]
+    ) -> str:
+        return await self.run(
+            "create_upload_session", create_resumable_upload_session, bucket_name, blob_name, content_type, size
+        )
+
+
+storage = AsyncStorage()
+
+
+def create_resumable_upload_session(bucket_name: str, blob_name: str, content_type: str, size: Optional[int]) -> str:
+    """Starts a resumable upload to a blob and returns the session URL, which authorizes the upload by itself.
+
+    :param bucket_name: The name of the GCS bucket.
+    :param blob_name: The name of the destination blob in the GCS bucket.
+    :param content_type: The content type of the blob.
+    :param size: The total size of the upload, if known.
+    :return: The session URL.
+    """
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    return blob.create_resumable_upload_session(content_type=content_type, size=size)
+
+
+class UploadSessionExpired(Exception):
+    pass
+
+
+class _RetryableUploadError(Exception):
+    pass
+
+
+class ResumableUpload:
+    """
+    Sends data to a GCS resumable upload session in chunks, holding at most about one chunk in memory.
+
+    offset is the number of bytes that GCS has persisted; data written beyond it is buffered
+    until a whole chunk is available, or until finish() or flush() is called.
+    """
+
+    def __init__(
+        self,
+        session_url: str,
+        total_size: Optional[int] = None,
+        offset: int = 0,
+        chunk_size: int = constants.UPLOAD_CHUNK_SIZE,
+    ) -> None:
+        if chunk_size <= 0 or chunk_size % RESUMABLE_CHUNK_QUANTUM:
+            raise ValueError(f"chunk_size must be a positive multiple of {RESUMABLE_CHUNK_QUANTUM}")
+        self.session_url = session_url
+        self.total_size = total_size
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.complete = False
+        self._buffer = bytearray()
+
+    async def write(self, data: bytes) -> None:
+        if self.total_size is not None and self.offset + len(self._buffer) + len(data) > self.total_size:
+            raise ValueError(f"Upload is larger than its declared size of {self.total_size} bytes")
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size and not self._is_last(self.chunk_size):
+            await self._send(self.chunk_size)
+
+    async def flush(self) -> int:
+        """Sends all whole quanta of buffered data and drops the rest, which the client must send again."""
+        if self._is_last(len(self._buffer)):
+            await self.finish()
+        else:
+            await self._send(len(self._buffer) - len(self._buffer) % RESUMABLE_CHUNK_QUANTUM)
+            self._buffer.clear()
+        return self.offset
+
+    async def finish(self) -> None:
+        """Sends the buffered data as the end of the upload, which completes the blob."""
+        if self.total_size is None:
+            self.total_size = self.offset + len(self._buffer)
+        elif not self._is_last(len(self._buffer)):
+            raise ValueError(f"Upload ends at {self.offset + len(self._buffer)} bytes instead of {self.total_size}")
+        while not self.complete:
+            await self._send(len(self._buffer))
+
+    async def query(self) -> int:
+        """Updates offset and complete from GCS, e.g. before resuming an upload, and returns offset."""
+        await self._put(b"", f"bytes */{'*' if self.total_size is None else self.total_size}")
+        return self.offset
+
+    def _is_last(self, size: int) -> bool:
+        return self.total_size is not None and self.offset + size == self.total_size
+
+    async def _send(self, size: int) -> None:
+        if size == 0 and not self._is_last(0):
+            return
+        total = str(self.total_size) if self._is_last(size) else "*"
+        content_range = f"bytes {self.offset}-{self.offset + size - 1}/{total}" if size else f"bytes */{total}"
+        offset = self.offset
+        await self._put(bytes(self._buffer[:size]), content_range)
+        if self.offset == offset and size and not self.complete:
+            raise RuntimeError(f"GCS persisted none of the {size} bytes sent at offset {offset}")
+        # GCS may persist only part of a chunk; the rest stays buffered and is sent again
+        del self._buffer[: self.offset - offset]
+
+    @retry(
+        retry=retry_if_exception_type((httpx.TransportError, _RetryableUploadError)),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=0.5, max=8),
+        reraise=True,
+    )
+    async def _put(self, data: bytes, content_range: str) -> None:
+        res = await _get_http().put(self.session_url, content=data, headers={"Content-Range": content_range})
+        if res.status_code in (200, 201):
+            self.complete = True
+            self.offset = self.total_size if self.total_size is not None else self.offset + len(data)
+        elif res.status_code == 308:
+            # Range is e.g. "bytes=0-1048575", and is missing if nothing has been persisted yet
+            persisted = res.headers.get("Range")
+            self.offset = int(persisted.rsplit("-", 1)[1]) + 1 if persisted else 0
+        elif res.status_code in (404, 410):
+            raise UploadSessionExpired(self.session_url)
+        elif res.status_code == 429 or res.status_code >= 500:
+            raise _RetryableUploadError(f"{res.status_code}: {res.text}")
+        else:
+            res.raise_for_status()
+
+
+def _get_http() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+    return _http
+
+
+async def close_upload_client() -> None:
+    """Closes the connections to GCS upload sessions."""
+    global _http
+    if _http is not None:
+        client, _http = _http, None
+        await client.aclose()
@@ -0,0 +1,47 @@
+import asyncio
+import weakref
+from typing import Optional
+
+import httpx
+
+from src.utils import custom_logging
+
+logger = custom_logging.setup_logging(__name__)
+
+# a loop's client goes away with the loop, whose connections can't outlive it anyway
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_transport: Optional[httpx.AsyncBaseTransport] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the process-wide HTTP client for Terra's APIs (SAM and Rawls), which keeps its connections,
+    and their TLS sessions, alive between requests, and multiplexes concurrent requests over HTTP/2.
+
+    Connections belong to the event loop that opened them, so each loop gets its own client,
+    which close_http_client closes on that loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _clients[loop] = httpx.AsyncClient(
+            http2=_transport is None,
+            transport=_transport,
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+        )
+    return client
+
+
+async def set_transport(transport: Optional[httpx.AsyncBaseTransport]) -> None:
+    """Sends all requests through the given transport from now on, e.g. an httpx.MockTransport stub for testing."""
+    global _transport
+    await close_http_client()
+    _transport = transport
+
+
+async def close_http_client() -> None:
+    """Closes the running loop's client, if it has one."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,277 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from google.cloud import firestore
+from google.cloud.firestore_v1 import FieldFilter
+from quart import Quart, current_app
+
+from src.utils import custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+JOBS_COLLECTION = "jobs"
+ACTIVE_STATUSES = ["queued", "running"]
+
+JobHandler = Callable[..., Awaitable[None]]
+_handlers: Dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str) -> Callable[[JobHandler], JobHandler]:
+    """
+    Registers a coroutine function as the handler for jobs of the given kind.
+
+    It's called with the job's study ID, followed by the job's other arguments, which must be JSON-like, as keywords.
+    """
+
+    def register(handler: JobHandler) -> JobHandler:
+        _handlers[kind] = handler
+        return handler
+
+    return register
+
+
+async def enqueue_job(kind: str, study_id: str, **args: Any) -> str:
+    """Submits a job to the app's queue and returns its ID."""
+    return await current_app.config["JOBS"].submit(kind, study_id, **args)
+
+
+class JobQueue:
+    """
+    Background job queue, persisted in the jobs collection.
+
+    Jobs are executed in the app context by a fixed number of workers, and jobs of the same study and role
+    run one at a time. Each record holds the job's status (queued, running, done or failed), its timings
+    and its error, if any. A running job holds a lease that its worker keeps renewing; every instance
+    periodically looks for running jobs whose lease has lapsed, and for jobs that have been queued for longer
+    than a lease, and picks up those that were left behind by an instance that has shut down.
+    """
+
+    def __init__(
+        self,
+        db: firestore.AsyncClient,
+        workers: int = 4,
+        lease: float = 600,
+        max_attempts: int = 3,
+    ) -> None:
+        self.db = db
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker_id = uuid.uuid4().hex
+        self._app: Optional[Quart] = None
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, str] = {}
+        # (study, role) pairs with a job in progress, and their jobs that are waiting for it to finish
+        self._busy: Dict[Tuple[str, str], Deque[str]] = {}
+        # jobs that this instance has queued, parked or is running
+        self._pending: Set[str] = set()
+
+    async def start(self, app: Quart) -> None:
+        """Starts the workers and requeues the jobs that were queued or running when their instance stopped."""
+        self._app = app
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        await self._resume(abandoned_only=False)
+        self._tasks.append(asyncio.create_task(self._resume_periodically()))
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, kind: str, study_id: str, **args: Any) -> str:
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        await self.db.collection(JOBS_COLLECTION).document(job_id).set(
+            {
+                "kind": kind,
+                "study_id": study_id,
+                "args": args,
+                "status": "queued",
+                "attempts": 0,
+                "created": firestore.SERVER_TIMESTAMP,
+            }
+        )
+        self._enqueue(job_id)
+        metrics.increment(f"jobs.{kind}.submitted")
+        logger.info(f"Queued {kind} job {job_id} for study {study_id}")
+        return job_id
+
+    async def list(self, study_id: str, limit: int = 50) -> List[dict]:
+        """Returns the study's most recent jobs, newest first."""
+        query = (
+            self.db.collection(JOBS_COLLECTION)
+            .where(filter=FieldFilter("study_id", "==", study_id))
+            .order_by("created", direction=firestore.Query.DESCENDING)
+            .limit(limit)
+        )
+        return [_serialize(doc.id, doc.to_dict() or {}) async for doc in query.stream()]
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "running": dict(self._running),
+            "waiting": sum(len(waiting) for waiting in self._busy.values()),
+        }
+
+    def _enqueue(self, job_id: str) -> bool:
+        if job_id in self._pending:
+            return False
+        self._pending.add(job_id)
+        self._queue.put_nowait(job_id)
+        return True
+
+    async def _resume(self, abandoned_only: bool) -> None:
+        query = (
+            self.db.collection(JOBS_COLLECTION)
+            .where(filter=FieldFilter("status", "in", ACTIVE_STATUSES))
+            .order_by("created")
+        )
+        now = datetime.now(timezone.utc)
+        resumed = 0
+        async for doc in query.stream():
+            job = doc.to_dict() or {}
+            if abandoned_only and not _is_abandoned(job, now, self.lease):
+                continue
+            resumed += self._enqueue(doc.id)
+        if resumed:
+            logger.info(f"Resuming {resumed} queued or interrupted jobs")
+
+    async def _resume_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 2)
+            try:
+                await self._resume(abandoned_only=True)
+            except Exception:
+                logger.exception("Failed to look for abandoned jobs:")
+
+    async def _work(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            parked = False
+            try:
+                parked = await self._run(job_id)
+            except Exception:
+                logger.exception(f"Failed to run job {job_id}:")
+            finally:
+                if not parked:
+                    self._pending.discard(job_id)
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> bool:
+        """Runs the job, or parks it if another job of its study and role is in progress, returning whether it did."""
+        ref = self.db.collection(JOBS_COLLECTION).document(job_id)
+        job = await self._peek(ref)
+        if job is None:
+            return False
+
+        # provisioning the VMs of a study's parties can run concurrently, but each party's jobs must not overlap
+        key = (job["study_id"], str(job.get("args", {}).get("role", "")))
+        if key in self._busy:
+            # park it rather than hold up this worker; it's requeued when the current job finishes
+            self._busy[key].append(job_id)
+            return True
+
+        self._busy[key] = deque()
+        try:
+            await self._execute(ref)
+        finally:
+            for waiting_id in self._busy.pop(key):
+                self._queue.put_nowait(waiting_id)
+        return False
+
+    async def _execute(self, ref: firestore.AsyncDocumentReference) -> None:
+        job_id = ref.id
+        # claim only once it's this job's turn, so the lease doesn't run out while it waits
+        job = await self._claim(self.db.transaction(), ref)
+        if job is None:
+            return
+
+        kind = job["kind"]
+        self._running[job_id] = kind
+        heartbeat = asyncio.create_task(self._renew_lease(ref))
+        start = datetime.now(timezone.utc)
+        try:
+            assert self._app is not None
+            async with self._app.app_context():
+                await _handlers[kind](job["study_id"], **job.get("args", {}))
+        except Exception as e:
+            logger.exception(f"{kind} job {job_id} for study {job['study_id']} failed:")
+            result = {"status": "failed", "error": str(e) or type(e).__name__}
+        else:
+            result = {"status": "done"}
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+
+        duration = (datetime.now(timezone.utc) - start).total_seconds()
+        metrics.increment(f"jobs.{kind}.{result['status']}")
+        metrics.observe(f"jobs.{kind}.seconds", duration)
+        await ref.update(result | {"finished": firestore.SERVER_TIMESTAMP, "duration": duration})
+        logger.info(f"{kind} job {job_id} {result['status']} after {duration:.1f}s")
+
+    async def _peek(self, ref: firestore.AsyncDocumentReference) -> Optional[dict]:
+        job = (await ref.get()).to_dict()
+        if not job or job.get("status") not in ACTIVE_STATUSES:
+            return None
+        if job.get("kind") not in _handlers:
+            await ref.update({"status": "failed", "error": f"Unknown job kind: {job.get('kind')}"})
+            return None
+        return job
+
+    async def _claim(
+        self, transaction: firestore.AsyncTransaction, ref: firestore.AsyncDocumentReference
+    ) -> Optional[dict]:
+        @firestore.async_transactional
+        async def claim(transaction: firestore.AsyncTransaction) -> Optional[dict]:
+            job = (await ref.get(transaction=transaction)).to_dict()
+            now = datetime.now(timezone.utc)
+            if not job or job.get("status") not in ACTIVE_STATUSES:
+                return None
+            if job["status"] == "running" and job.get("lease_expires") and job["lease_expires"] > now:
+                return None  # another worker holds it
+            if job.get("attempts", 0) >= self.max_attempts:
+                transaction.update(ref, {"status": "failed", "error": "Interrupted too many times"})
+                return None
+            transaction.update(
+                ref,
+                {
+                    "status": "running",
+                    "worker": self.worker_id,
+                    "attempts": firestore.Increment(1),
+                    "started": firestore.SERVER_TIMESTAMP,
+                    "lease_expires": now + timedelta(seconds=self.lease),
+                },
+            )
+            return job
+
+        return await claim(transaction)
+
+    async def _renew_lease(self, ref: firestore.AsyncDocumentReference) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await ref.update({"lease_expires": datetime.now(timezone.utc) + timedelta(seconds=self.lease)})
+            except Exception:
+                logger.exception(f"Failed to renew the lease of job {ref.id}:")
+
+
+def _is_abandoned(job: dict, now: datetime, lease: float) -> bool:
+    if job.get("status") == "running":
+        return not job.get("lease_expires") or job["lease_expires"] <= now
+    # queued jobs are only in the memory of the instance that queued them
+    return isinstance(job.get("created"), datetime) and job["created"] <= now - timedelta(seconds=lease)
+
+
+def _serialize(job_id: str, job: dict) -> dict:
+    return {"id": job_id} | {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in job.items()
+        if key not in ("worker", "lease_expires")
+    }
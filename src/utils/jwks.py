@@ -0,0 +1,146 @@
+import asyncio
+import json
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import httpx
+from jwt import algorithms
+
+from src.utils import constants, custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+MAX_AGE_PATTERN = re.compile(r"(?:^|,)\s*(?:s-)?max-age\s*=\s*(\d+)", re.IGNORECASE)
+
+
+class JWKSManager:
+    """
+    Public keys from a JWKS endpoint, by key ID, loaded on first use and kept for as long as
+    the endpoint's Cache-Control allows (within JWKS_MIN_TTL and JWKS_MAX_TTL).
+
+    Keys are refreshed in the background before they expire, and a token signed with an unknown key ID
+    triggers a refetch, at most once every JWKS_UNKNOWN_KID_INTERVAL seconds, so rotated keys are picked up
+    without a redeploy. Concurrent refreshes share one request, and the previous keys are kept if it fails.
+    The URL may also be a file:// URL, e.g. for local testing.
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self._keys: Dict[str, Any] = {}
+        self._expires = 0.0
+        self._last_refresh = -float("inf")
+        self._refreshing: Optional[asyncio.Task] = None
+        self._background: Optional[asyncio.Task] = None
+
+    async def get_key(self, kid: str) -> Optional[Any]:
+        """
+        Returns the public key with the given ID, or None if the endpoint doesn't have it.
+
+        :raises Exception: If no keys have ever loaded, e.g. because the endpoint is down,
+            until a retry, at most every JWKS_MIN_TTL seconds, succeeds.
+        """
+        if time.monotonic() >= self._expires:
+            await self._refresh_or_keep()
+        elif not self._keys:
+            raise RuntimeError(f"No keys have loaded from {self.url} yet")
+        if kid in self._keys:
+            return self._keys[kid]
+
+        metrics.increment("jwks.unknown_kid")
+        if time.monotonic() - self._last_refresh >= constants.JWKS_UNKNOWN_KID_INTERVAL:
+            logger.info(f"Unknown key ID {kid}; refetching {self.url}")
+            await self._refresh_or_keep()
+        return self._keys.get(kid)
+
+    async def refresh(self) -> None:
+        """Refetches the keys, joining the refresh that is already in progress, if any."""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._refresh())
+        await asyncio.shield(self._refreshing)
+
+    def start(self) -> None:
+        """Starts refreshing the keys in the background, shortly before they expire."""
+        if self._background is None:
+            self._background = asyncio.create_task(self._refresh_periodically())
+
+    async def close(self) -> None:
+        if self._background:
+            self._background.cancel()
+            await asyncio.gather(self._background, return_exceptions=True)
+            self._background = None
+
+    async def _refresh_or_keep(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            if not self._keys:
+                raise
+            logger.warning(f"Failed to refresh JWKS from {self.url}; keeping the previous keys: {e}")
+
+    async def _refresh(self) -> None:
+        self._last_refresh = time.monotonic()
+        start = time.perf_counter()
+        try:
+            jwks, ttl = await self._fetch()
+        except Exception:
+            metrics.increment("jwks.refresh_failures")
+            # retry soon, rather than on every request
+            self._expires = time.monotonic() + constants.JWKS_MIN_TTL
+            raise
+
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("kty") != "RSA" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = algorithms.RSAAlgorithm.from_jwk(jwk)
+            except Exception as e:
+                logger.warning(f"Skipping invalid key {jwk.get('kid')} from {self.url}: {e}")
+        if not keys:
+            raise ValueError(f"No usable keys in JWKS from {self.url}")
+
+        self._keys = keys
+        self._expires = time.monotonic() + ttl
+        metrics.increment("jwks.refreshes")
+        metrics.observe("jwks.refresh_seconds", time.perf_counter() - start)
+        logger.info(f"Loaded {len(keys)} keys from {self.url}, valid for {ttl:.0f}s")
+
+    async def _fetch(self) -> Tuple[dict, float]:
+        parsed = urlparse(self.url)
+        if parsed.scheme == "file":
+            loop = asyncio.get_running_loop()
+            path = url2pathname(parsed.path)
+            return await loop.run_in_executor(None, _read_json, path), constants.JWKS_DEFAULT_TTL
+
+        async with httpx.AsyncClient(timeout=10) as http:
+            res = await http.get(self.url)
+            res.raise_for_status()
+        return res.json(), _ttl(res.headers.get("Cache-Control", ""))
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            # the first load is left to the first request that needs a key
+            delay = (self._expires - time.monotonic()) * 0.8 if self._keys else constants.JWKS_MIN_TTL
+            await asyncio.sleep(max(delay, 1))
+            if not self._keys:
+                continue
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Background JWKS refresh from {self.url} failed: {e}")
+
+
+def _ttl(cache_control: str) -> float:
+    if "no-store" in cache_control.lower() or "no-cache" in cache_control.lower():
+        return constants.JWKS_MIN_TTL
+    if match := MAX_AGE_PATTERN.search(cache_control):
+        return min(max(float(match[1]), constants.JWKS_MIN_TTL), constants.JWKS_MAX_TTL)
+    return constants.JWKS_DEFAULT_TTL
+
+
+def _read_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,74 @@
+from typing import Awaitable, Callable, List, Set, Tuple
+
+from google.cloud import firestore
+
+from src.utils import custom_logging
+
+logger = custom_logging.setup_logging(__name__)
+
+# Firestore limits a batched write to 500 operations
+BATCH_SIZE = 500
+
+# migrations that are known to be done; they can't be undone, so this is never invalidated
+_done: Set[str] = set()
+
+
+async def migrate_display_names(db: firestore.AsyncClient) -> None:
+    """Copies the legacy users/display_names map into the display_name field of each existing user document."""
+    legacy: dict = (await db.collection("users").document("display_names").get()).to_dict() or {}
+    items = [(user_id, name) for user_id, name in legacy.items() if user_id and "/" not in user_id]
+
+    migrated = 0
+    for i in range(0, len(items), BATCH_SIZE):
+        chunk = dict(items[i : i + BATCH_SIZE])
+        refs = [db.collection("users").document(user_id) for user_id in chunk]
+        batch = db.batch()
+        async for doc in db.get_all(refs, field_paths=["display_name"]):
+            # don't resurrect users that have since been deleted
+            if doc.exists:
+                batch.set(doc.reference, {"display_name": chunk[doc.id]}, merge=True)
+                migrated += 1
+        await batch.commit()
+
+    logger.info(f"Migrated {migrated} display names to user documents")
+
+
+async def migrate_auth_keys(db: firestore.AsyncClient) -> None:
+    """Copies the legacy users/auth_keys map into one document per key in the auth_keys collection."""
+    legacy: dict = (await db.collection("users").document("auth_keys").get()).to_dict() or {}
+    items = list(legacy.items())
+
+    for i in range(0, len(items), BATCH_SIZE):
+        batch = db.batch()
+        for auth_key, user in items[i : i + BATCH_SIZE]:
+            batch.set(db.collection("auth_keys").document(auth_key), user)
+        await batch.commit()
+
+    logger.info(f"Migrated {len(items)} auth keys to the auth_keys collection")
+
+
+MIGRATIONS: List[Tuple[str, Callable[[firestore.AsyncClient], Awaitable[None]]]] = [
+    ("display_names", migrate_display_names),
+    ("auth_keys", migrate_auth_keys),
+]
+
+
+async def is_migrated(db: firestore.AsyncClient, name: str) -> bool:
+    """Returns whether the named migration has been recorded as done; only a negative answer costs a read."""
+    if name not in _done:
+        done = (await db.collection("meta").document("migrations").get()).to_dict() or {}
+        _done.update(done)
+    return name in _done
+
+
+async def run_migrations(db: firestore.AsyncClient) -> None:
+    """Runs every migration that has not yet been recorded as done in meta/migrations."""
+    marker = db.collection("meta").document("migrations")
+    done = (await marker.get()).to_dict() or {}
+    for name, migrate in MIGRATIONS:
+        if name in done:
+            continue
+        logger.info(f"Running migration {name}")
+        await migrate(db)
+        await marker.set({name: firestore.SERVER_TIMESTAMP}, merge=True)
+        _done.add(name)
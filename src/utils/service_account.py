@@ -0,0 +1,67 @@
+import asyncio
+import datetime
+import time
+from typing import List, Optional
+
+import google.auth
+from google.auth.credentials import Credentials
+from google.auth.transport.requests import Request as GAuthRequest
+
+from src.utils import constants, custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+
+class ServiceAccountCredentials:
+    """
+    OAuth access token of the application default credentials (the service account on Cloud Run),
+    fetched on first use and reused until SERVICE_ACCOUNT_REFRESH_MARGIN seconds before it expires.
+
+    Loading and refreshing the credentials are blocking calls, so they run on the default executor,
+    and concurrent callers share one refresh.
+    """
+
+    def __init__(self, scopes: List[str]) -> None:
+        self.scopes = scopes
+        self._creds: Optional[Credentials] = None
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def get_token(self) -> str:
+        if not self._is_fresh():
+            if self._refreshing is None or self._refreshing.done():
+                self._refreshing = asyncio.create_task(self._refresh())
+            await asyncio.shield(self._refreshing)
+        assert self._creds is not None and self._creds.token is not None
+        return self._creds.token
+
+    def _is_fresh(self) -> bool:
+        if self._creds is None or self._creds.token is None:
+            return False
+        if self._creds.expiry is None:  # e.g. credentials that don't expire
+            return True
+        # google-auth keeps expiry as a naive UTC datetime
+        remaining = self._creds.expiry - datetime.datetime.utcnow()
+        return remaining.total_seconds() > constants.SERVICE_ACCOUNT_REFRESH_MARGIN
+
+    async def _refresh(self) -> None:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            creds = await loop.run_in_executor(None, self._load_and_refresh)
+        except Exception:
+            metrics.increment("service_account.refresh_failures")
+            raise
+        if creds.token is None:
+            raise ValueError("Token is None")
+        self._creds = creds
+        metrics.increment("service_account.refreshes")
+        metrics.observe("service_account.refresh_seconds", time.perf_counter() - start)
+        logger.info(f"Refreshed service account token, valid until {creds.expiry}")
+
+    def _load_and_refresh(self) -> Credentials:
+        creds = self._creds
+        if creds is None:
+            creds, _ = google.auth.default()
+            creds = creds.with_scopes(self.scopes)  # type: ignore
+        creds.refresh(GAuthRequest())
+        return creds
@@ -0,0 +1,451 @@
+import asyncio
+import functools
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from google.cloud import firestore
+from google.cloud.firestore_v1 import FieldFilter
+
+from src.utils import constants, custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+PID = int
+# called on the event loop with each message addressed to a party connected to this instance
+Deliver = Callable[[dict], None]
+# called when another instance asks for a party's session with the given token; returns the messages kept for
+# the party once this instance has let go of the session, or None if the token isn't the session's
+HandOver = Callable[[str], Awaitable[Optional[List[dict]]]]
+Unsubscribe = Callable[[], Awaitable[None]]
+
+
+class SignalingBackend(ABC):
+    """
+    Routes signaling messages between the parties of a study, and tracks which parties are connected,
+    wherever their websockets are served.
+    """
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def join(self, study_id: str, pid: PID, deliver: Deliver, hand_over: Optional[HandOver] = None) -> None:
+        """
+        Registers a party connected to this instance, and starts delivering its messages.
+        hand_over answers other instances that ask for the party's session.
+        """
+
+    @abstractmethod
+    async def leave(self, study_id: str, pid: PID) -> None:
+        pass
+
+    @abstractmethod
+    async def is_connected(self, study_id: str, pid: PID) -> bool:
+        pass
+
+    @abstractmethod
+    async def publish(self, study_id: str, target_pid: PID, message: dict) -> None:
+        """Sends the message to the target party, which must be connected."""
+
+    @abstractmethod
+    async def wait_for_parties(self, study_id: str, num_parties: int) -> None:
+        """Waits until the given number of the study's parties are connected; this is the study's barrier."""
+
+    async def hand_over(self, study_id: str, pid: PID, token: str) -> Optional[List[dict]]:
+        """
+        Asks the instance that holds the party's session to let go of it, if the token is the session's.
+
+        :return: The messages kept for the party, or None if no instance handed its session over.
+        """
+        return None
+
+
+class InMemorySignalingBackend(SignalingBackend):
+    """Backend for a single instance, which requires all parties of a study to connect to the same process."""
+
+    def __init__(self) -> None:
+        self._parties: Dict[str, Dict[PID, Deliver]] = {}
+        self._changed: Dict[str, asyncio.Condition] = {}
+
+    async def join(self, study_id: str, pid: PID, deliver: Deliver, hand_over: Optional[HandOver] = None) -> None:
+        self._parties.setdefault(study_id, {})[pid] = deliver
+        await self._notify(study_id)
+
+    async def leave(self, study_id: str, pid: PID) -> None:
+        parties = self._parties.get(study_id, {})
+        parties.pop(pid, None)
+        if not parties:
+            self._parties.pop(study_id, None)
+        await self._notify(study_id)
+
+    async def is_connected(self, study_id: str, pid: PID) -> bool:
+        return pid in self._parties.get(study_id, {})
+
+    async def publish(self, study_id: str, target_pid: PID, message: dict) -> None:
+        if deliver := self._parties.get(study_id, {}).get(target_pid):
+            deliver(message)
+
+    async def wait_for_parties(self, study_id: str, num_parties: int) -> None:
+        changed = self._changed.setdefault(study_id, asyncio.Condition())
+        async with changed:
+            await changed.wait_for(lambda: len(self._parties.get(study_id, {})) >= num_parties)
+
+    async def _notify(self, study_id: str) -> None:
+        # only connected parties wait, so a study without any has no waiters left to notify
+        changed = self._changed.get(study_id) if study_id in self._parties else self._changed.pop(study_id, None)
+        if changed:
+            async with changed:
+                changed.notify_all()
+
+
+class Broker(ABC):
+    """Minimal pub/sub and presence service shared by all instances, e.g. Firestore or a Redis-like server."""
+
+    @abstractmethod
+    async def publish(self, channel: str, message: dict) -> None:
+        pass
+
+    @abstractmethod
+    async def subscribe(self, channel: str, callback: Deliver) -> Unsubscribe:
+        """Calls back on the event loop with every message published to the channel from now on."""
+
+    @abstractmethod
+    async def add_member(self, key: str, member: str, ttl: float) -> None:
+        """Adds or refreshes a member of a set, which expires unless it is refreshed within ttl seconds."""
+
+    @abstractmethod
+    async def remove_member(self, key: str, member: str) -> None:
+        pass
+
+    @abstractmethod
+    async def members(self, key: str) -> Set[str]:
+        pass
+
+
+class InProcessBroker(Broker):
+    """Broker for local testing; backends that share one behave like instances that share a real broker."""
+
+    def __init__(self) -> None:
+        self._subscribers: Dict[str, List[Deliver]] = {}
+        self._sets: Dict[str, Dict[str, float]] = {}
+
+    async def publish(self, channel: str, message: dict) -> None:
+        for callback in list(self._subscribers.get(channel, [])):
+            callback(dict(message))
+
+    async def subscribe(self, channel: str, callback: Deliver) -> Unsubscribe:
+        self._subscribers.setdefault(channel, []).append(callback)
+
+        async def unsubscribe() -> None:
+            callbacks = self._subscribers.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(channel, None)
+
+        return unsubscribe
+
+    async def add_member(self, key: str, member: str, ttl: float) -> None:
+        self._sets.setdefault(key, {})[member] = time.monotonic() + ttl
+
+    async def remove_member(self, key: str, member: str) -> None:
+        members = self._sets.get(key, {})
+        members.pop(member, None)
+        if not members:
+            self._sets.pop(key, None)
+
+    async def members(self, key: str) -> Set[str]:
+        now = time.monotonic()
+        return {member for member, expires in self._sets.get(key, {}).items() if expires > now}
+
+
+class FirestoreBroker(Broker):
+    """
+    Broker on top of Firestore: messages are documents in the signaling_messages collection,
+    fanned out to subscribers by snapshot listeners, and each set is a document
+    in the signaling_presence collection that maps members to their expiry.
+
+    Messages are left for a TTL policy on their "expires" field to delete, since a channel may have
+    subscribers on several instances.
+    """
+
+    MESSAGES_COLLECTION = "signaling_messages"
+    PRESENCE_COLLECTION = "signaling_presence"
+    MESSAGE_TTL = 3600  # seconds
+    SUBSCRIBE_TIMEOUT = 10  # seconds
+
+    def __init__(self, db: firestore.AsyncClient, listener_client: firestore.Client) -> None:
+        self.db = db
+        self._client = listener_client
+
+    async def publish(self, channel: str, message: dict) -> None:
+        await self.db.collection(self.MESSAGES_COLLECTION).add(
+            {
+                "channel": channel,
+                "message": message,
+                "created": firestore.SERVER_TIMESTAMP,
+                "expires": datetime.now(timezone.utc) + timedelta(seconds=self.MESSAGE_TTL),
+            }
+        )
+
+    async def subscribe(self, channel: str, callback: Deliver) -> Unsubscribe:
+        loop = asyncio.get_running_loop()
+        initial = threading.Event()
+
+        def on_snapshot(_snapshots, changes, _read_time) -> None:
+            # the first snapshot holds messages left over from earlier connections, which are stale
+            if not initial.is_set():
+                initial.set()
+                return
+            for change in changes:
+                if change.type.name == "ADDED":
+                    data = change.document.to_dict() or {}
+                    loop.call_soon_threadsafe(callback, data.get("message", {}))
+
+        # changes come in query order, so each snapshot delivers its messages in the order they were published
+        query = (
+            self._client.collection(self.MESSAGES_COLLECTION)
+            .where(filter=FieldFilter("channel", "==", channel))
+            .order_by("created")
+        )
+        watch = query.on_snapshot(on_snapshot)
+
+        async def unsubscribe() -> None:
+            # unsubscribing joins the listener threads, so it must not run on the event loop
+            await loop.run_in_executor(None, watch.unsubscribe)
+
+        # don't report the subscription as ready until the listener has caught up
+        if not await loop.run_in_executor(None, initial.wait, self.SUBSCRIBE_TIMEOUT):
+            await unsubscribe()
+            raise TimeoutError(f"Timed out subscribing to signaling channel {channel}")
+        return unsubscribe
+
+    async def add_member(self, key: str, member: str, ttl: float) -> None:
+        expires = datetime.now(timezone.utc).timestamp() + ttl
+        await self.db.collection(self.PRESENCE_COLLECTION).document(key).set({member: expires}, merge=True)
+
+    async def remove_member(self, key: str, member: str) -> None:
+        await self.db.collection(self.PRESENCE_COLLECTION).document(key).set(
+            {member: firestore.DELETE_FIELD}, merge=True
+        )
+
+    async def members(self, key: str) -> Set[str]:
+        doc = (await self.db.collection(self.PRESENCE_COLLECTION).document(key).get()).to_dict() or {}
+        now = datetime.now(timezone.utc).timestamp()
+        return {member for member, expires in doc.items() if expires > now}
+
+
+@dataclass
+class _PresenceWatch:
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+    changed: asyncio.Condition = field(default_factory=asyncio.Condition)
+    parties: Set[PID] = field(default_factory=set)
+    users: int = 0
+    unsubscribe: Optional[Unsubscribe] = None
+
+
+class BrokerSignalingBackend(SignalingBackend):
+    """
+    Backend that lets the parties of a study connect to different instances.
+
+    Each connected party subscribes to its own channel, and is listed in the study's presence set,
+    which its instance keeps refreshing for as long as it is connected. Changes to the set are announced
+    on the study's presence channel, so that waiting parties re-check it without polling the broker.
+
+    A party that reconnects to another instance asks for its session on its own channel; the instance
+    that holds the session checks the token, leaves, and replies with the messages it kept for the party.
+    """
+
+    HANDOVER_TIMEOUT = 5  # seconds
+
+    def __init__(self, broker: Broker, presence_ttl: float = 60) -> None:
+        self.broker = broker
+        self.presence_ttl = presence_ttl
+        self._local: Dict[Tuple[str, PID], Unsubscribe] = {}
+        self._watches: Dict[str, _PresenceWatch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._refresh_task = asyncio.create_task(self._refresh_presence())
+
+    async def close(self) -> None:
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+        for study_id, pid in list(self._local):
+            await self.leave(study_id, pid)
+
+    async def join(self, study_id: str, pid: PID, deliver: Deliver, hand_over: Optional[HandOver] = None) -> None:
+        await self._watch_presence(study_id)
+        try:
+            self._local[(study_id, pid)] = await self.broker.subscribe(
+                _party_channel(study_id, pid), functools.partial(self._receive, deliver, hand_over)
+            )
+        except Exception:
+            await self._unwatch_presence(study_id)
+            raise
+        try:
+            await self.broker.add_member(_presence_key(study_id), str(pid), self.presence_ttl)
+            await self.broker.publish(_presence_channel(study_id), {"joined": pid})
+        except Exception:
+            await self.leave(study_id, pid)
+            raise
+
+    async def leave(self, study_id: str, pid: PID) -> None:
+        unsubscribe = self._local.pop((study_id, pid), None)
+        if unsubscribe is None:
+            return
+        try:
+            await unsubscribe()
+            await self.broker.remove_member(_presence_key(study_id), str(pid))
+            await self.broker.publish(_presence_channel(study_id), {"left": pid})
+        finally:
+            await self._unwatch_presence(study_id)
+
+    async def is_connected(self, study_id: str, pid: PID) -> bool:
+        if watch := self._watches.get(study_id):
+            return pid in watch.parties
+        return str(pid) in await self.broker.members(_presence_key(study_id))
+
+    async def publish(self, study_id: str, target_pid: PID, message: dict) -> None:
+        metrics.increment("signaling.broker.published")
+        await self.broker.publish(_party_channel(study_id, target_pid), message)
+
+    async def wait_for_parties(self, study_id: str, num_parties: int) -> None:
+        watch = await self._watch_presence(study_id)
+        try:
+            async with watch.changed:
+                await watch.changed.wait_for(lambda: len(watch.parties) >= num_parties)
+        finally:
+            await self._unwatch_presence(study_id)
+
+    async def hand_over(self, study_id: str, pid: PID, token: str) -> Optional[List[dict]]:
+        loop = asyncio.get_running_loop()
+        replied: "asyncio.Future[dict]" = loop.create_future()
+        reply_channel = f"{_party_channel(study_id, pid)}/handover/{secrets.token_urlsafe(8)}"
+
+        def on_reply(message: dict) -> None:
+            if not replied.done():
+                replied.set_result(message)
+
+        unsubscribe = await self.broker.subscribe(reply_channel, on_reply)
+        try:
+            await self.broker.publish(_party_channel(study_id, pid), {"handover": token, "reply": reply_channel})
+            reply = await asyncio.wait_for(replied, self.HANDOVER_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("No instance handed over the session of party %d in study %s", pid, study_id)
+            return None
+        finally:
+            await unsubscribe()
+        return reply.get("replay")
+
+    def _receive(self, deliver: Deliver, hand_over: Optional[HandOver], message: dict) -> None:
+        # parties' messages never have a "handover" field, so it marks requests for the party's session
+        if "handover" not in message:
+            deliver(message)
+        elif hand_over is not None:
+            task = asyncio.create_task(self._answer_handover(hand_over, message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _answer_handover(self, hand_over: HandOver, request: dict) -> None:
+        try:
+            replay = await hand_over(request["handover"])
+        except Exception as e:
+            logger.error("Failed to hand over a session on %s: %s", request["reply"], e)
+            replay = None
+        await self.broker.publish(request["reply"], {"replay": replay})
+
+    async def _watch_presence(self, study_id: str) -> _PresenceWatch:
+        # the study's presence is watched while this instance has a party in it, or one waiting for it
+        watch = self._watches.get(study_id)
+        if watch is not None:
+            watch.users += 1
+            await watch.ready.wait()
+            if self._watches.get(study_id) is not watch:
+                raise ConnectionError(f"Failed to watch the presence of study {study_id}")
+            return watch
+
+        watch = self._watches[study_id] = _PresenceWatch(users=1)
+        try:
+
+            def on_presence(_message: dict) -> None:
+                task = asyncio.create_task(self._reload_presence(study_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            watch.unsubscribe = await self.broker.subscribe(_presence_channel(study_id), on_presence)
+            await self._reload_presence(study_id)
+        except Exception:
+            # the parties waiting for this watch fail along with it, so none of them unwatches it
+            del self._watches[study_id]
+            if watch.unsubscribe:
+                await watch.unsubscribe()
+            raise
+        finally:
+            watch.ready.set()
+        return watch
+
+    async def _unwatch_presence(self, study_id: str) -> None:
+        watch = self._watches[study_id]
+        watch.users -= 1
+        if watch.users == 0:
+            del self._watches[study_id]
+            if watch.unsubscribe:
+                await watch.unsubscribe()
+
+    async def _reload_presence(self, study_id: str) -> None:
+        members = await self.broker.members(_presence_key(study_id))
+        if watch := self._watches.get(study_id):
+            async with watch.changed:
+                watch.parties = {int(member) for member in members}
+                watch.changed.notify_all()
+
+    async def _refresh_presence(self) -> None:
+        # keep this instance's parties from expiring, and pick up parties whose instances stopped without leaving
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            for study_id, pid in list(self._local):
+                try:
+                    await self.broker.add_member(_presence_key(study_id), str(pid), self.presence_ttl)
+                except Exception as e:
+                    logger.warning("Failed to refresh presence of party %d in study %s: %s", pid, study_id, e)
+            for study_id in list(self._watches):
+                try:
+                    await self._reload_presence(study_id)
+                except Exception as e:
+                    logger.warning("Failed to reload presence of study %s: %s", study_id, e)
+
+
+def create_signaling_backend(
+    name: str, db: firestore.AsyncClient, listener_client: firestore.Client
+) -> SignalingBackend:
+    """Returns the backend named by SIGNALING_BACKEND: "memory", "firestore" or "inprocess" (for local testing)."""
+    if name == "memory":
+        return InMemorySignalingBackend()
+    elif name == "firestore":
+        return BrokerSignalingBackend(FirestoreBroker(db, listener_client), constants.SIGNALING_PRESENCE_TTL)
+    elif name == "inprocess":
+        return BrokerSignalingBackend(InProcessBroker(), constants.SIGNALING_PRESENCE_TTL)
+    raise ValueError(f"Unknown signaling backend: {name}")
+
+
+def _party_channel(study_id: str, pid: PID) -> str:
+    return f"signaling/{study_id}/{pid}"
+
+
+def _presence_channel(study_id: str) -> str:
+    return f"signaling/{study_id}/presence"
+
+
+def _presence_key(study_id: str) -> str:
+    return study_id
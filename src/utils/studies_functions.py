@@ -1,13 +1,11 @@
-import asyncio
 import os
 import secrets
-import time
+from datetime import datetime, timezone
 from html import escape
 from http import HTTPStatus
 from string import Template
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
-import httpx
 from google.cloud import firestore
 from google.cloud.firestore_v1 import AsyncDocumentReference, FieldFilter
 from python_http_client.exceptions import HTTPError
@@ -17,11 +15,15 @@ from sendgrid.helpers.mail import Email, Mail
 from werkzeug.exceptions import BadRequest
 
 from src.api_utils import APIException, fetch_study
-from src.auth import get_service_account_headers
+from src.auth import AUTH_KEYS_COLLECTION, get_service_account_headers
 from src.utils import constants, custom_logging
 from src.utils.generic_functions import is_create_vm
-from src.utils.google_cloud.google_cloud_compute import GoogleCloudCompute, format_instance_name
-from src.utils.google_cloud.google_cloud_iam import GoogleCloudIAM
+from src.utils.google_cloud.google_cloud_compute import AsyncGoogleCloudCompute, format_instance_name
+from src.utils.google_cloud.google_cloud_iam import has_permissions
+from src.utils.http_clients import get_http_client
+from src.utils.jobs import enqueue_job, job_handler
+from src.utils.migrations import BATCH_SIZE
+from src.utils.study_mutations import StudyUpdate
 
 logger = custom_logging.setup_logging(__name__)
 
@@ -86,23 +88,119 @@ async def make_auth_key(study_id: str, user_id: str) -> str:
     _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
 
     auth_key = secrets.token_hex(16)
-    doc_ref_dict["personal_parameters"][user_id]["AUTH_KEY"]["value"] = auth_key
-    await doc_ref.set(doc_ref_dict)
+    await StudyUpdate(doc_ref).set("personal_parameters", user_id, "AUTH_KEY", "value", value=auth_key).commit()
 
-    await current_app.config["DATABASE"].collection("users").document("auth_keys").set(
+    await current_app.config["DATABASE"].collection(AUTH_KEYS_COLLECTION).document(auth_key).set(
         {
-            auth_key: {
-                "study_id": study_id,
-                "title": doc_ref_dict["title"],
-                "username": user_id,
-            }
-        },
-        merge=True,
+            "study_id": study_id,
+            "title": doc_ref_dict["title"],
+            "username": user_id,
+        }
     )
 
     return auth_key
 
 
+MESSAGE_TIME_FORMAT = "%m/%d/%Y %H:%M"
+
+
+async def add_message(doc_ref: AsyncDocumentReference, sender: str, body: str) -> dict:
+    """
+    Stores a chat message in the study's messages subcollection.
+
+    :return: The message, as it will be returned by get_messages().
+    """
+    message = {
+        "sender": sender,
+        "time": datetime.now(timezone.utc).strftime(MESSAGE_TIME_FORMAT),
+        "body": body,
+    }
+    message_ref = doc_ref.collection("messages").document()
+    await message_ref.set(message | {"created": firestore.SERVER_TIMESTAMP})
+    return message | {"id": message_ref.id}
+
+
+async def get_messages(
+    doc_ref: AsyncDocumentReference, limit: int, start_after: str = ""
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Returns a page of the study's chat messages, newest first.
+
+    :param limit: The maximum number of messages to return.
+    :param start_after: The ID of the last message on the previous page.
+    :return: The messages and the cursor for the next page (None if this is the last page).
+    """
+    messages_ref = doc_ref.collection("messages")
+    query = messages_ref.order_by("created", direction=firestore.Query.DESCENDING).limit(limit + 1)
+    if start_after:
+        cursor = await messages_ref.document(start_after).get()
+        if not cursor.exists:
+            raise BadRequest("Invalid cursor")
+        query = query.start_after(cursor)
+
+    messages = []
+    async for doc in query.stream():
+        message = doc.to_dict() or {}
+        message.pop("created", None)
+        messages.append(message | {"id": doc.id})
+
+    next_cursor = messages[limit - 1]["id"] if len(messages) > limit else None
+    return messages[:limit], next_cursor
+
+
+async def migrate_legacy_messages(doc_ref: AsyncDocumentReference, doc_ref_dict: dict) -> None:
+    """
+    Moves messages stored in the study document itself into its messages subcollection.
+
+    The messages are written in batches, and the legacy field is only removed once all of them are,
+    so a migration that is interrupted resumes with the first batch that wasn't committed.
+    """
+    legacy_messages = doc_ref_dict.pop("messages", None)
+    if legacy_messages is None:
+        return
+
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    messages_ref = doc_ref.collection("messages")
+    for start in range(0, len(legacy_messages), BATCH_SIZE):
+        chunk = legacy_messages[start : start + BATCH_SIZE]
+        # deterministic IDs make concurrent migrations of the same study idempotent,
+        # and since each batch is atomic, its last message tells whether it's already been written
+        if (await messages_ref.document(_legacy_message_id(start + len(chunk) - 1)).get()).exists:
+            continue
+        batch = db.batch()
+        for i, message in enumerate(chunk, start):
+            try:
+                created = datetime.strptime(message["time"], MESSAGE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+            except (KeyError, ValueError):
+                created = datetime.fromtimestamp(0, timezone.utc)
+            batch.set(messages_ref.document(_legacy_message_id(i)), message | {"created": created})
+        await batch.commit()
+    await StudyUpdate(doc_ref).delete("messages").commit()
+    logger.info(f"Migrated {len(legacy_messages)} messages of study {doc_ref.id} to a subcollection")
+
+
+def _legacy_message_id(index: int) -> str:
+    return f"legacy-{index:05d}"
+
+
+async def archive_messages(doc_ref: AsyncDocumentReference, archive_ref: AsyncDocumentReference) -> int:
+    """
+    Moves the study's messages into the messages subcollection of its archived copy, in batches.
+
+    :return: The number of messages moved.
+    """
+    db: firestore.AsyncClient = current_app.config["DATABASE"]
+    messages = [doc async for doc in doc_ref.collection("messages").stream()]
+    # each message takes two writes, a copy and a delete
+    for start in range(0, len(messages), BATCH_SIZE // 2):
+        batch = db.batch()
+        for doc in messages[start : start + BATCH_SIZE // 2]:
+            batch.set(archive_ref.collection("messages").document(doc.id), doc.to_dict() or {})
+            batch.delete(doc.reference)
+        await batch.commit()
+    return len(messages)
+
+
 async def setup_gcp(doc_ref: AsyncDocumentReference, role: str) -> None:
     await generate_ports(doc_ref, role)
 
@@ -111,17 +209,13 @@ async def setup_gcp(doc_ref: AsyncDocumentReference, role: str) -> None:
     user: str = doc_ref_dict["participants"][int(role)]
     user_parameters: dict = doc_ref_dict["personal_parameters"][user]
 
-    if "tasks" not in doc_ref_dict:
-        doc_ref_dict["tasks"] = {}
-    if user not in doc_ref_dict["tasks"]:
-        doc_ref_dict["tasks"][user] = []
-    doc_ref_dict["tasks"][user].append("Setting up networking and creating VM instance")
-    await doc_ref.set(doc_ref_dict)
-
-    gcloudCompute = GoogleCloudCompute(study_id, user_parameters["GCP_PROJECT"]["value"])
+    await StudyUpdate(doc_ref).array_union(
+        "tasks", user, values=["Setting up networking and creating VM instance"]
+    ).commit()
 
     try:
-        gcloudCompute.setup_networking(doc_ref_dict, role)
+        gcloudCompute = await AsyncGoogleCloudCompute.create(study_id, user_parameters["GCP_PROJECT"]["value"])
+        await gcloudCompute.setup_networking(doc_ref_dict, role)
 
         metadata = [
             {
@@ -139,7 +233,7 @@ async def setup_gcp(doc_ref: AsyncDocumentReference, role: str) -> None:
             {"key": "SFKIT_API_URL", "value": constants.SFKIT_API_URL},
         ]
 
-        gcloudCompute.setup_instance(
+        await gcloudCompute.setup_instance(
             name=format_instance_name(doc_ref_dict["study_id"], role),
             role=role,
             metadata=metadata,
@@ -148,25 +242,28 @@ async def setup_gcp(doc_ref: AsyncDocumentReference, role: str) -> None:
         )
     except:
         logger.exception("An error occurred during GCP setup:")
-        doc_ref_dict["status"][
-            user
-        ] = "FAILED - sfkit failed to set up your networking and VM instance. Please restart the study and double-check your parameters and configuration. If the problem persists, please contact us."
-        await doc_ref.set(doc_ref_dict)
+        await StudyUpdate(doc_ref).set(
+            "status",
+            user,
+            value="FAILED - sfkit failed to set up your networking and VM instance. Please restart the study and double-check your parameters and configuration. If the problem persists, please contact us.",
+        ).commit()
         return
     else:
-        doc_ref_dict = (await doc_ref.get()).to_dict() or {}
-        doc_ref_dict["tasks"][user].append("Configuring your VM instance")
-        await doc_ref.set(doc_ref_dict)
+        await StudyUpdate(doc_ref).array_union("tasks", user, values=["Configuring your VM instance"]).commit()
         return
 
 
+@job_handler("setup_gcp")
+async def setup_gcp_job(study_id: str, role: str) -> None:
+    await setup_gcp(current_app.config["DATABASE"].collection("studies").document(study_id), role)
+
+
 async def _terra_rawls_post(path: str, json: Dict[str, Any]):
-    async with httpx.AsyncClient() as http:
-        return await http.post(
-            f"{constants.RAWLS_API_URL}/api/workspaces/{constants.TERRA_CP0_WORKSPACE_NAMESPACE}/{constants.TERRA_CP0_WORKSPACE_NAME}{path}",
-            headers=get_service_account_headers(),
-            json=json,
-        )
+    return await get_http_client().post(
+        f"{constants.RAWLS_API_URL}/api/workspaces/{constants.TERRA_CP0_WORKSPACE_NAMESPACE}/{constants.TERRA_CP0_WORKSPACE_NAME}{path}",
+        headers=await get_service_account_headers(),
+        json=json,
+    )
 
 
 async def submit_terra_workflow(study_id: str, _role: str) -> None:
@@ -209,8 +306,7 @@ async def generate_ports(doc_ref: AsyncDocumentReference, role: str) -> None:
     ports = [base + 20 * r for r in range(len(doc_ref_dict["participants"]))]
     ports_str = ",".join([str(p) for p in ports])
 
-    doc_ref_dict["personal_parameters"][user]["PORTS"]["value"] = ports_str
-    await doc_ref.set(doc_ref_dict, merge=True)
+    await StudyUpdate(doc_ref).set("personal_parameters", user, "PORTS", "value", value=ports_str).commit()
 
 
 def sanitize_path(path: str) -> str:
@@ -253,7 +349,7 @@ async def study_title_already_exists(study_title: str) -> bool:
     return False
 
 
-def check_conditions(doc_ref_dict, user_id) -> str:
+async def check_conditions(doc_ref_dict, user_id) -> str:
     # sourcery skip: assign-if-exp, reintroduce-else, swap-if-expression
     participants = doc_ref_dict["participants"]
     num_inds = doc_ref_dict["personal_parameters"][user_id]["NUM_INDS"]["value"]
@@ -273,21 +369,17 @@ def check_conditions(doc_ref_dict, user_id) -> str:
         return "This project ID is only allowed for a demo study. Please follow the instructions in the 'Configure Study' button to set up your own GCP project before running the protocol."
     if not demo and not data_path:
         return "Your data path is not set. Please follow the instructions in the 'Configure Study' button before running the protocol."
-    if not GoogleCloudIAM().test_permissions(gcp_project):
+    if not await has_permissions(gcp_project):
         return "You have not given the website the necessary GCP permissions for the project you have entered. Please click on 'Configure Study' to double-check that your project ID is correct and that you have given the website the necessary permissions (and they are not expired) in that GCP project."
     return ""
 
 
 async def update_status_and_start_setup(doc_ref, doc_ref_dict, study_id):
     participants = doc_ref_dict["participants"]
-    statuses = doc_ref_dict["status"]
 
     for role in range(1, len(participants)):
         user = participants[role]
-        statuses[user] = "setting up your vm instance"
-        await doc_ref.set({"status": statuses}, merge=True)
+        await StudyUpdate(doc_ref).set("status", user, value="setting up your vm instance").commit()
 
         if is_create_vm(doc_ref_dict, user):
-            asyncio.create_task(setup_gcp(doc_ref, str(role)))
-
-        time.sleep(1)
+            await enqueue_job("setup_gcp", study_id, role=str(role))
@@ -0,0 +1,277 @@
+import copy
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from google.cloud import firestore
+from google.cloud.firestore import AsyncDocumentReference
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.watch import ChangeType
+
+from src.utils import custom_logging, metrics
+
+logger = custom_logging.setup_logging(__name__)
+
+
+@dataclass
+class _Entry:
+    data: dict
+    fetched: float
+    watch: Any = None
+
+
+class StudyCache:
+    """
+    In-process, size-bounded LRU cache of study documents, keyed by study ID.
+
+    Every cached study is watched by a Firestore snapshot listener,
+    so changes made by any instance replace the cached copy as soon as they are committed.
+    Writers in this process call invalidate() so that their next read goes to Firestore,
+    and entries that have not been refreshed for max_age seconds are refetched,
+    in case a listener has silently stopped.
+    """
+
+    def __init__(self, listener_client: Optional[firestore.Client], max_size: int = 256, max_age: float = 300) -> None:
+        self._client = listener_client
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        # per study, bumped by writes and listener updates, so that a fetch that raced with one isn't cached;
+        # only kept for studies that are cached or being fetched
+        self._versions: Dict[str, int] = {}
+        self._fetches: Dict[str, int] = {}
+        # guards the fields above, which are also updated from listener threads
+        self._lock = threading.Lock()
+
+    async def get(self, doc_ref: AsyncDocumentReference) -> dict:
+        """Returns a private copy of the study document, or an empty dict if it does not exist."""
+        study_id = doc_ref.id
+        with self._lock:
+            entry = self._entries.get(study_id)
+            if entry and time.monotonic() - entry.fetched < self.max_age:
+                self._entries.move_to_end(study_id)
+                data = entry.data
+            else:
+                data = None
+                version = self._versions.get(study_id, 0)
+                self._fetches[study_id] = self._fetches.get(study_id, 0) + 1
+
+        if data is not None:
+            metrics.increment("study_cache.hits")
+            return copy.deepcopy(data)
+
+        metrics.increment("study_cache.misses")
+        doc_ref_dict: dict = {}
+        try:
+            doc_ref_dict = (await doc_ref.get()).to_dict() or {}
+        finally:
+            self._store(study_id, doc_ref_dict, version)
+        return copy.deepcopy(doc_ref_dict)
+
+    def invalidate(self, study_id: str) -> None:
+        """Forces the next read of the study to go to Firestore, keeping its listener."""
+        with self._lock:
+            self._bump(study_id)
+            if entry := self._entries.get(study_id):
+                entry.fetched = -math.inf
+
+    def stats(self) -> dict:
+        """Hits, misses and evictions are counted in the process metrics under "study_cache.*"."""
+        with self._lock:
+            return {"size": len(self._entries)}
+
+    def close(self) -> None:
+        with self._lock:
+            watches = [entry.watch for entry in self._entries.values()]
+            self._entries.clear()
+            self._versions.clear()
+            self._fetches.clear()
+        self._unsubscribe(watches)
+
+    def _bump(self, study_id: str) -> None:
+        if study_id in self._entries or study_id in self._fetches:
+            self._versions[study_id] = self._versions.get(study_id, 0) + 1
+
+    def _forget(self, study_id: str) -> None:
+        if study_id not in self._entries and study_id not in self._fetches:
+            self._versions.pop(study_id, None)
+
+    def _store(self, study_id: str, doc_ref_dict: dict, version: int) -> None:
+        evicted: List[Any] = []
+        with self._lock:
+            if self._fetches.get(study_id, 0) > 1:
+                self._fetches[study_id] -= 1
+            else:
+                self._fetches.pop(study_id, None)
+            if not doc_ref_dict or version != self._versions.get(study_id, 0):
+                # missing, or a write or a listener update raced with this fetch, so it may be stale
+                self._forget(study_id)
+                return
+
+            if entry := self._entries.get(study_id):
+                entry.data = doc_ref_dict
+                entry.fetched = time.monotonic()
+                self._entries.move_to_end(study_id)
+                return
+
+            self._entries[study_id] = _Entry(doc_ref_dict, time.monotonic())
+            while len(self._entries) > self.max_size:
+                old_id, old_entry = self._entries.popitem(last=False)
+                self._forget(old_id)
+                evicted.append(old_entry.watch)
+                metrics.increment("study_cache.evictions")
+
+        self._unsubscribe(evicted)
+        self._watch(study_id)
+
+    def _watch(self, study_id: str) -> None:
+        if self._client is None:
+            return
+
+        def on_snapshot(snapshots: list, _changes, _read_time) -> None:
+            with self._lock:
+                self._bump(study_id)
+                entry = self._entries.get(study_id)
+                if entry is None:
+                    return
+                if snapshots and snapshots[0].exists:
+                    entry.data = snapshots[0].to_dict() or {}
+                    entry.fetched = time.monotonic()
+                    return
+                del self._entries[study_id]
+                self._forget(study_id)
+                watch = entry.watch
+            logger.debug(f"Study {study_id} was deleted; dropping it from the cache")
+            self._unsubscribe([watch])
+
+        try:
+            watch = self._client.collection("studies").document(study_id).on_snapshot(on_snapshot)
+        except Exception:
+            logger.exception(f"Failed to watch study {study_id}; it will expire after {self.max_age}s:")
+            return
+
+        with self._lock:
+            if entry := self._entries.get(study_id):
+                entry.watch = watch
+                return
+        # evicted before the listener was attached
+        self._unsubscribe([watch])
+
+    @staticmethod
+    def _unsubscribe(watches: List[Any]) -> None:
+        watches = [watch for watch in watches if watch is not None]
+        if not watches:
+            return
+
+        # unsubscribing joins the listener threads, so it must not run
+        # on the event loop or on the listener's own callback thread
+        def unsubscribe_all() -> None:
+            for watch in watches:
+                try:
+                    watch.unsubscribe()
+                except Exception:
+                    logger.exception("Failed to stop study listener:")
+
+        threading.Thread(target=unsubscribe_all, daemon=True).start()
+
+
+class PublicStudiesCache:
+    """
+    Shared cache of rendered /public_studies pages, keyed by page parameters.
+
+    A Firestore listener on the public studies query clears the cache whenever a public study
+    is added or removed, or one of its listed fields changes (on any instance);
+    other updates, like the status and task updates of running studies, keep the cached pages.
+    Pages older than max_age are re-rendered in case the listener has stopped,
+    and each page carries an ETag derived from its contents.
+    """
+
+    def __init__(
+        self,
+        listener_client: Optional[firestore.Client],
+        fields: List[str],
+        max_size: int = 64,
+        max_age: float = 60,
+    ) -> None:
+        self._client = listener_client
+        self.fields = fields
+        self.max_size = max_size
+        self.max_age = max_age
+        self._pages: OrderedDict[Hashable, Tuple[float, dict, str]] = OrderedDict()
+        self._version = 0
+        self._watch: Any = None
+        # digests of the listed fields of each public study, as last seen by the listener
+        self._listed: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    async def get(self, key: Hashable, render: Callable[[], Awaitable[dict]]) -> Tuple[dict, str]:
+        """Returns the cached page and its ETag, rendering it first if needed. The page must not be mutated."""
+        self._ensure_watch()
+        with self._lock:
+            page = self._pages.get(key)
+            if page and time.monotonic() - page[0] < self.max_age:
+                self._pages.move_to_end(key)
+                metrics.increment("public_studies_cache.hits")
+                return page[1], page[2]
+            version = self._version
+
+        metrics.increment("public_studies_cache.misses")
+        data = await render()
+        etag = _digest(data)
+        with self._lock:
+            if version == self._version:
+                self._pages[key] = (time.monotonic(), data, etag)
+                while len(self._pages) > self.max_size:
+                    self._pages.popitem(last=False)
+        return data, etag
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            watch, self._watch = self._watch, None
+            self._listed.clear()
+        StudyCache._unsubscribe([watch])
+
+    def on_changes(self, changes: list) -> None:
+        """Invalidates the pages if any of the changed public studies appeared, disappeared or changed a listed field."""
+        changed = False
+        with self._lock:
+            for change in changes:
+                study_id = change.document.id
+                if change.type == ChangeType.REMOVED:
+                    changed |= self._listed.pop(study_id, None) is not None
+                    continue
+                data = change.document.to_dict() or {}
+                digest = _digest({field: data.get(field) for field in self.fields})
+                changed |= self._listed.get(study_id) != digest
+                self._listed[study_id] = digest
+        if changed:
+            metrics.increment("public_studies_cache.invalidations")
+            self.invalidate()
+
+    def _ensure_watch(self) -> None:
+        if self._client is None or self._watch is not None:
+            return
+
+        def on_snapshot(_snapshots, changes, _read_time) -> None:
+            self.on_changes(changes)
+
+        try:
+            query = self._client.collection("studies").where(filter=FieldFilter("private", "==", False))
+            self._watch = query.on_snapshot(on_snapshot)
+        except Exception:
+            logger.exception(f"Failed to watch public studies; pages will expire after {self.max_age}s:")
+            self._client = None
+
+
+def _digest(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
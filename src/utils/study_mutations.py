@@ -0,0 +1,45 @@
+from typing import Any, Dict
+
+from google.cloud import firestore
+from google.cloud.firestore import AsyncDocumentReference
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from src.api_utils import invalidate_study
+
+
+class StudyUpdate:
+    """
+    Collects field-level changes to a study document and writes them in a single update() call.
+
+    Paths are given as separate segments (e.g. "personal_parameters", user_id, "PORTS", "value"),
+    so user IDs and emails never need escaping, and only the changed fields are sent.
+    Array changes use ArrayUnion/ArrayRemove, so concurrent writers don't clobber each other.
+    """
+
+    def __init__(self, doc_ref: AsyncDocumentReference) -> None:
+        self.doc_ref = doc_ref
+        self.changes: Dict[str, Any] = {}
+
+    def set(self, *path: str, value: Any) -> "StudyUpdate":
+        self.changes[FieldPath(*path).to_api_repr()] = value
+        return self
+
+    def delete(self, *path: str) -> "StudyUpdate":
+        return self.set(*path, value=firestore.DELETE_FIELD)
+
+    def array_union(self, *path: str, values: list) -> "StudyUpdate":
+        return self.set(*path, value=firestore.ArrayUnion(values))
+
+    def array_remove(self, *path: str, values: list) -> "StudyUpdate":
+        return self.set(*path, value=firestore.ArrayRemove(values))
+
+    async def commit(self) -> None:
+        if not self.changes:
+            return
+        await self.doc_ref.update(self.changes)
+        invalidate_study(self.doc_ref.id)
+
+    def apply(self, transaction: firestore.AsyncTransaction) -> None:
+        """Adds the changes to a transaction; the caller must invalidate the study after it commits."""
+        if self.changes:
+            transaction.update(self.doc_ref, self.changes)
@@ -0,0 +1,272 @@
+import asyncio
+import mimetypes
+import re
+import secrets
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterable, Generator, Optional, Tuple
+
+from google.cloud import firestore
+from hypercorn.typing import ASGIReceiveCallable
+from quart import Request
+from quart.asgi import ASGIHTTPConnection
+from quart.wrappers.request import Body
+from werkzeug.exceptions import BadRequest, NotFound, RequestEntityTooLarge
+from werkzeug.sansio.multipart import NEED_DATA, Data, Epilogue, File, MultipartDecoder
+
+from src.utils import constants, custom_logging, metrics
+from src.utils.google_cloud.google_cloud_storage import ResumableUpload, UploadSessionExpired, storage
+
+logger = custom_logging.setup_logging(__name__)
+
+UPLOADS_COLLECTION = "uploads"
+STREAMING_UPLOAD_PATHS = {"/api/upload_file"}
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+)")
+
+
+class UploadBody(Body):
+    """
+    Request body that holds at most UPLOAD_BUFFER_SIZE bytes while it's being read in chunks;
+    UploadConnection stops receiving more of it until the app has taken what's buffered,
+    so a client that sends faster than GCS accepts is paused instead of filling up memory.
+
+    Awaiting the whole body lifts the limit, since it can only complete once every byte has been buffered.
+    """
+
+    def __init__(self, expected_content_length: Optional[int], max_content_length: Optional[int]) -> None:
+        super().__init__(expected_content_length, max_content_length)
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._unbounded = False
+
+    def append(self, data: bytes) -> None:
+        super().append(data)
+        if not self._unbounded and len(self._data) >= constants.UPLOAD_BUFFER_SIZE:
+            self._has_space.clear()
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await super().__anext__()
+        finally:
+            self._has_space.set()
+
+    def __await__(self) -> Generator[Any, None, Any]:
+        self._unbounded = True
+        self._has_space.set()
+        return super().__await__()
+
+    def set_complete(self) -> None:
+        super().set_complete()
+        self._has_space.set()
+
+    async def wait_for_space(self) -> None:
+        await self._has_space.wait()
+
+
+class UploadRequest(Request):
+    """
+    Request that lifts MAX_CONTENT_LENGTH to MAX_UPLOAD_SIZE on the streaming upload endpoints,
+    whose bodies are read in chunks of at most UPLOAD_BUFFER_SIZE (see UploadBody).
+    """
+
+    def __init__(self, method, scheme, path, *args, max_content_length=None, **kwargs) -> None:
+        if path in STREAMING_UPLOAD_PATHS:
+            max_content_length = constants.MAX_UPLOAD_SIZE
+            self.body_class = UploadBody
+        super().__init__(method, scheme, path, *args, max_content_length=max_content_length, **kwargs)
+
+
+class UploadConnection(ASGIHTTPConnection):
+    """Receives the body of an upload only as fast as the app reads it, which ASGI servers pass on to the client."""
+
+    async def handle_messages(self, request: Request, receive: ASGIReceiveCallable) -> None:
+        while True:
+            if isinstance(request.body, UploadBody):
+                await request.body.wait_for_space()
+            message = await receive()
+            if message["type"] == "http.request":
+                request.body.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    request.body.set_complete()
+            elif message["type"] == "http.disconnect":
+                return
+
+
+def result_path(study_id: str, role: str, filename: str) -> str:
+    """Returns the path in the results bucket that an uploaded result file is stored at."""
+    if "manhattan" in filename:
+        return f"{study_id}/p{role}/manhattan.png"
+    elif "pca_plot" in filename:
+        return f"{study_id}/p{role}/pca_plot.png"
+    elif filename == "pos.txt":
+        return f"{study_id}/pos.txt"
+    else:
+        return f"{study_id}/p{role}/result.txt"
+
+
+async def stream_multipart_upload(request: Request, study_id: str, role: str) -> Tuple[str, str]:
+    """
+    Streams the "file" part of a multipart/form-data request into the results bucket, chunk by chunk.
+
+    :return: The uploaded file's name and its path in the bucket.
+    """
+    boundary = request.mimetype_params.get("boundary", "")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        raise BadRequest("Expected a multipart/form-data request")
+
+    decoder = MultipartDecoder(boundary.encode())
+    upload: Optional[ResumableUpload] = None
+    filename = file_path = ""
+    stats = _UploadStats()
+
+    async for chunk in _chunks_then_end(request.body):
+        decoder.receive_data(chunk)
+        while (event := decoder.next_event()) is not NEED_DATA:
+            if isinstance(event, File) and event.name == "file" and upload is None:
+                filename = str(event.filename)
+                file_path = result_path(study_id, role, filename)
+                content_type = event.headers.get("Content-Type") or _guess_type(filename)
+                session_url = await _create_session(file_path, content_type, None)
+                upload = ResumableUpload(session_url)
+            elif isinstance(event, Data) and upload is not None and not upload.complete:
+                stats.add(len(event.data))
+                await upload.write(event.data)
+                if not event.more_data:
+                    await upload.finish()
+            elif isinstance(event, Epilogue):
+                break
+
+    if upload is None or not upload.complete:
+        raise BadRequest("no file")
+    stats.record(file_path)
+    return filename, file_path
+
+
+async def resumable_upload(
+    request: Request, db: firestore.AsyncClient, study_id: str, role: str, filename: str, upload_id: str = ""
+) -> Tuple[str, int, bool]:
+    """
+    Handles one request of a resumable upload, whose body holds the bytes given by its Content-Range header,
+    e.g. "bytes 0-8388607/104857600", or which asks for the upload's progress with e.g. "bytes */104857600".
+
+    A request without an upload ID starts a new upload, whose ID the client passes along with the rest of it.
+    The GCS session URL is kept in the uploads collection under that ID, so that the client can resume through
+    any instance, for up to UPLOAD_SESSION_TTL seconds; a TTL policy on the records' "expires" field deletes
+    those of abandoned uploads.
+    :return: The upload ID, the number of bytes persisted so far, which the client should continue from,
+        and whether the upload is complete.
+    :raises NotFound: If the upload ID is unknown, has expired, or belongs to another file.
+    """
+    match = CONTENT_RANGE_PATTERN.fullmatch(request.headers.get("Content-Range", ""))
+    if not match:
+        raise BadRequest("Content-Range must be 'bytes <first>-<last>/<total>' or 'bytes */<total>'")
+    total = int(match[3])
+    if total > constants.MAX_UPLOAD_SIZE:
+        raise RequestEntityTooLarge()
+    if match[1] is not None:
+        start, end = int(match[1]), int(match[2])
+        if start > end or end >= total:
+            raise BadRequest(f"Invalid Content-Range for a {total}-byte upload")
+        if request.content_length is not None and request.content_length != end - start + 1:
+            raise BadRequest("The body's length doesn't match its Content-Range")
+
+    file_path = result_path(study_id, role, filename)
+    if upload_id:
+        record_ref = db.collection(UPLOADS_COLLECTION).document(upload_id)
+        record = (await record_ref.get()).to_dict()
+        if (
+            not record
+            or record["expires"] <= datetime.now(timezone.utc)
+            or (record["study_id"], record["path"], record["total"]) != (study_id, file_path, total)
+        ):
+            raise NotFound(f"Unknown or expired upload {upload_id}; start a new upload without its ID")
+        upload = ResumableUpload(record["session_url"], total)
+        try:
+            await upload.query()
+        except UploadSessionExpired:
+            logger.info(f"Upload session for {file_path} expired; starting over")
+            upload = await _start_upload(record_ref, study_id, file_path, _guess_type(filename), total)
+    else:
+        record_ref = db.collection(UPLOADS_COLLECTION).document(secrets.token_urlsafe(24))
+        upload = await _start_upload(record_ref, study_id, file_path, _guess_type(filename), total)
+
+    if match[1] is not None and not upload.complete:
+        if start <= upload.offset:
+            # skip what GCS already has, e.g. when a retried request overlaps with the previous one
+            skip = upload.offset - start
+            remaining = end - start + 1
+            stats = _UploadStats()
+            async for chunk in request.body:
+                remaining -= len(chunk)
+                if remaining < 0:
+                    raise BadRequest("The body is longer than its Content-Range")
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                chunk, skip = chunk[skip:], 0
+                stats.add(len(chunk))
+                try:
+                    await upload.write(chunk)
+                except ValueError as e:
+                    raise BadRequest(str(e))
+            if remaining > 0:
+                raise BadRequest("The body is shorter than its Content-Range")
+            await upload.flush()
+            stats.record(file_path)
+
+    if upload.complete:
+        await record_ref.delete()
+        logger.info(f"Completed resumable upload of {file_path}")
+    return record_ref.id, upload.offset, upload.complete
+
+
+async def _start_upload(
+    record_ref: firestore.AsyncDocumentReference, study_id: str, file_path: str, content_type: str, total: int
+) -> ResumableUpload:
+    session_url = await _create_session(file_path, content_type, total)
+    await record_ref.set(
+        {
+            "session_url": session_url,
+            "study_id": study_id,
+            "path": file_path,
+            "total": total,
+            "created": firestore.SERVER_TIMESTAMP,
+            "expires": datetime.now(timezone.utc) + timedelta(seconds=constants.UPLOAD_SESSION_TTL),
+        }
+    )
+    return ResumableUpload(session_url, total)
+
+
+async def _create_session(file_path: str, content_type: str, size: Optional[int]) -> str:
+    return await storage.create_upload_session(constants.RESULTS_BUCKET, file_path, content_type, size)
+
+
+async def _chunks_then_end(body: AsyncIterable[bytes]) -> AsyncIterable[Optional[bytes]]:
+    # MultipartDecoder expects None once the body has ended
+    async for chunk in body:
+        yield chunk
+    yield None
+
+
+def _guess_type(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+class _UploadStats:
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.bytes = 0
+
+    def add(self, size: int) -> None:
+        self.bytes += size
+        if self.bytes > constants.MAX_UPLOAD_SIZE:
+            raise RequestEntityTooLarge()
+
+    def record(self, file_path: str) -> None:
+        elapsed = time.perf_counter() - self.start
+        metrics.increment("uploads.count")
+        metrics.increment("uploads.bytes", self.bytes)
+        metrics.observe("uploads.seconds", elapsed)
+        if elapsed > 0:
+            metrics.observe("uploads.bytes_per_second", self.bytes / elapsed)
+        logger.info(f"Uploaded {self.bytes} bytes to {file_path} in {elapsed:.2f}s")
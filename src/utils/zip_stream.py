@@ -0,0 +1,193 @@
+import hashlib
+import struct
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import AsyncIterator, Callable, Hashable, List, Optional, Tuple
+
+from src.utils.ttl_cache import TTLCache
+
+# entries are STORED with a data descriptor, since their CRC-32 is only known once they have been read
+_VERSION = 20
+_FLAGS = 0x0008 | 0x0800  # data descriptor | UTF-8 names
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+_MAX_SIZE = 0xFFFFFFFF  # no ZIP64
+
+# CRCs of entries that have been read, so that resumed downloads don't need to read skipped entries again
+_crcs: TTLCache[Hashable, int] = TTLCache("zip_crcs", max_size=1024, ttl=24 * 3600)
+
+ChunkReader = Callable[[int, int], AsyncIterator[bytes]]
+
+
+@dataclass
+class ZipEntry:
+    """
+    A file in a streamed zip archive.
+
+    :param name: The file's name in the archive.
+    :param size: The file's size in bytes.
+    :param modified: The file's modification time, which must be stable for the archive to be resumable.
+    :param read: Yields the file's bytes from start (inclusive) to end (exclusive), in chunks.
+    :param key: Identifies this version of the file's contents, e.g. a blob name and generation.
+    """
+
+    name: str
+    size: int
+    modified: datetime
+    read: ChunkReader
+    key: Hashable
+    crc: Optional[int] = field(default=None, init=False)
+
+
+class ZipStream:
+    """
+    Writes a zip archive of the given entries as a stream of bytes, without compression.
+
+    The archive's layout depends only on the entries' names, sizes and modification times,
+    so its length is known up front, and any byte range of it can be produced again later,
+    which is how HTTP Range requests are served.
+    """
+
+    def __init__(self, entries: List[ZipEntry]) -> None:
+        if len({entry.name for entry in entries}) != len(entries):
+            raise ValueError("Entry names must be unique")
+        self.entries = entries
+        self._headers: List[Tuple[int, bytes]] = []
+        offset = 0
+        for entry in entries:
+            if entry.size > _MAX_SIZE:
+                raise ValueError(f"{entry.name} is too large for a zip archive without ZIP64")
+            entry.crc = _crcs.get(entry.key)
+            header = self._local_header(entry)
+            self._headers.append((offset, header))
+            offset += len(header) + entry.size + _DATA_DESCRIPTOR.size
+        self._central_directory_offset = offset
+        self._central_directory_size = sum(_CENTRAL_HEADER.size + len(entry.name.encode()) for entry in entries)
+        self.length = offset + self._central_directory_size + _END_OF_CENTRAL_DIRECTORY.size
+        if self.length > _MAX_SIZE:
+            raise ValueError("Archive is too large without ZIP64")
+
+    @property
+    def etag(self) -> str:
+        """Changes whenever the archive's contents would."""
+        digest = hashlib.sha256()
+        for entry in self.entries:
+            digest.update(repr((entry.name, entry.size, entry.modified.isoformat(), entry.key)).encode())
+        return digest.hexdigest()
+
+    async def generate(self, start: int = 0, stop: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Yields the bytes of the archive from start (inclusive) to stop (exclusive)."""
+        stop = self.length if stop is None else stop
+        for entry, (offset, header) in zip(self.entries, self._headers):
+            if offset >= stop:
+                return
+            for chunk in _slice(header, offset, start, stop):
+                yield chunk
+
+            data_offset = offset + len(header)
+            descriptor_offset = data_offset + entry.size
+            need_crc = entry.crc is None and stop > descriptor_offset
+            if (start < descriptor_offset and stop > data_offset) or need_crc:
+                async for chunk in self._read_entry(entry, data_offset, start, stop, need_crc):
+                    yield chunk
+            if start < descriptor_offset + _DATA_DESCRIPTOR.size and stop > descriptor_offset:
+                for chunk in _slice(self._data_descriptor(entry), descriptor_offset, start, stop):
+                    yield chunk
+
+        offset = self._central_directory_offset
+        if offset >= stop:
+            return
+        for entry, (header_offset, _) in zip(self.entries, self._headers):
+            header = self._central_header(entry, header_offset)
+            for chunk in _slice(header, offset, start, stop):
+                yield chunk
+            offset += len(header)
+        for chunk in _slice(self._end_of_central_directory(), offset, start, stop):
+            yield chunk
+
+    async def _read_entry(
+        self, entry: ZipEntry, data_offset: int, start: int, stop: int, need_crc: bool
+    ) -> AsyncIterator[bytes]:
+        # read only the requested part, unless the CRC has to be computed from the whole entry
+        read_from = 0 if need_crc else max(0, start - data_offset)
+        read_to = entry.size if need_crc else min(entry.size, stop - data_offset)
+        compute_crc = entry.crc is None and read_from == 0 and read_to == entry.size
+        if read_from >= read_to and not compute_crc:
+            return
+
+        crc = 0
+        position = read_from
+        async for chunk in entry.read(read_from, read_to):
+            if compute_crc:
+                crc = zlib.crc32(chunk, crc)
+            for part in _slice(chunk, data_offset + position, start, stop):
+                yield part
+            position += len(chunk)
+
+        if position != read_to:
+            raise RuntimeError(f"{entry.name} changed while it was being read")
+        if compute_crc:
+            entry.crc = crc
+            _crcs.set(entry.key, crc)
+
+    @staticmethod
+    def _dos_time(modified: datetime) -> Tuple[int, int]:
+        year = min(max(modified.year, 1980), 2107)
+        return (
+            (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2),
+            ((year - 1980) << 9) | (modified.month << 5) | modified.day,
+        )
+
+    def _local_header(self, entry: ZipEntry) -> bytes:
+        name = entry.name.encode()
+        time, date = self._dos_time(entry.modified)
+        return _LOCAL_HEADER.pack(0x04034B50, _VERSION, _FLAGS, 0, time, date, 0, 0, 0, len(name), 0) + name
+
+    @staticmethod
+    def _data_descriptor(entry: ZipEntry) -> bytes:
+        assert entry.crc is not None
+        return _DATA_DESCRIPTOR.pack(0x08074B50, entry.crc, entry.size, entry.size)
+
+    def _central_header(self, entry: ZipEntry, header_offset: int) -> bytes:
+        assert entry.crc is not None
+        name = entry.name.encode()
+        time, date = self._dos_time(entry.modified)
+        external_attributes = 0o100644 << 16  # regular file, rw-r--r--
+        return (
+            _CENTRAL_HEADER.pack(
+                0x02014B50,
+                _VERSION,
+                _VERSION,
+                _FLAGS,
+                0,
+                time,
+                date,
+                entry.crc,
+                entry.size,
+                entry.size,
+                len(name),
+                0,
+                0,
+                0,
+                0,
+                external_attributes,
+                header_offset,
+            )
+            + name
+        )
+
+    def _end_of_central_directory(self) -> bytes:
+        count = len(self.entries)
+        return _END_OF_CENTRAL_DIRECTORY.pack(
+            0x06054B50, 0, 0, count, count, self._central_directory_size, self._central_directory_offset, 0
+        )
+
+
+def _slice(data: bytes, offset: int, start: int, stop: int) -> List[bytes]:
+    """Returns the part of data, which is located at offset in the archive, that lies within [start, stop)."""
+    begin = max(start - offset, 0)
+    end = min(stop - offset, len(data))
+    return [data[begin:end]] if begin < end else []
@@ -1,48 +1,61 @@
+import asyncio
 import io
 import uuid
 from datetime import datetime, timezone
+from typing import Dict, List
 
 from google.cloud import firestore
 from quart import Blueprint, Response, current_app, jsonify, request, send_file
 from werkzeug.exceptions import BadRequest, Conflict
 
-from src.api_utils import ID_KEY, add_user_to_db, fetch_study, validate_json, validate_uuid
-from src.auth import authenticate, authenticate_on_terra, get_cp0_id
+from src.api_utils import (ID_KEY, add_user_to_db, fetch_study, forget_display_name, get_display_names,
+                           invalidate_study, validate_json, validate_uuid)
+from src.auth import authenticate, authenticate_on_terra, delete_auth_key, forget_user, get_cp0_id
 from src.utils import constants, custom_logging
-from src.utils.google_cloud.google_cloud_compute import GoogleCloudCompute, format_instance_name
+from src.utils.google_cloud.google_cloud_compute import AsyncGoogleCloudCompute, format_instance_name
+from src.utils.google_cloud.google_cloud_iam import forget_permissions
 from src.utils.schemas.create_study import create_study_schema
 from src.utils.schemas.study_information import study_information_schema
 from src.utils.schemas.parameters import parameters_schema
-from src.utils.studies_functions import make_auth_key, study_title_already_exists
+from src.utils.studies_functions import (archive_messages, get_messages, make_auth_key, migrate_legacy_messages,
+                                         study_title_already_exists)
+from src.utils.study_mutations import StudyUpdate
 
 logger = custom_logging.setup_logging(__name__)
 bp = Blueprint("study", __name__, url_prefix="/api")
 
+# number of most recent messages returned with a study; older ones are paginated through /messages
+MESSAGE_TAIL_SIZE = 10
+
 
 @bp.route("/study", methods=["GET"])
 @authenticate
 async def study(user_id) -> Response:
     study_id = validate_uuid(request.args.get("study_id"))
-    db, _, doc_ref_dict = await fetch_study(study_id, user_id)
+    _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
+
+    await migrate_legacy_messages(doc_ref, doc_ref_dict)
+    messages, next_cursor = await get_messages(doc_ref, MESSAGE_TAIL_SIZE)
+    doc_ref_dict["messages"] = messages[::-1]  # chronological, as the study page shows them
+    doc_ref_dict["messages_cursor"] = next_cursor
 
+    participants = (
+        doc_ref_dict["participants"]
+        + list(doc_ref_dict["requested_participants"].keys())
+        + doc_ref_dict["invited_participants"]
+    )
     try:
-        display_names = (await db.collection("users").document("display_names").get()).to_dict() or {}
+        display_names = await get_display_names(participants + [doc_ref_dict["owner"]])
     except:
         logger.exception("Failed to fetch display names:")
         raise BadRequest()
 
-    doc_ref_dict["owner_name"] = display_names.get(doc_ref_dict["owner"], doc_ref_dict["owner"])
-    doc_ref_dict["display_names"] = {
-        participant: display_names.get(participant, participant)
-        for participant in doc_ref_dict["participants"]
-        + list(doc_ref_dict["requested_participants"].keys())
-        + doc_ref_dict["invited_participants"]
-    }
+    doc_ref_dict["owner_name"] = display_names[doc_ref_dict["owner"]]
+    doc_ref_dict["display_names"] = {participant: display_names[participant] for participant in participants}
 
     return jsonify({"study": doc_ref_dict})
 
 
-# TODO: use asyncio to delete in parallel. This requires making the google_cloud_compute functions async. Using multiple processing failed because inside daemon. Threads failed because of GIL.
 @bp.route("/restart_study", methods=["GET"])
 @authenticate
 async def restart_study(user_id) -> Response:
@@ -50,27 +63,39 @@ async def restart_study(user_id) -> Response:
     _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
 
     if not constants.TERRA:  # TODO: add equivalent for terra
+        instances: Dict[str, List[str]] = {}
         for role, v in enumerate(doc_ref_dict["participants"]):
             participant = doc_ref_dict["personal_parameters"][v]
             if (gcp_project := participant.get("GCP_PROJECT").get("value")) != "":
-                google_cloud_compute = GoogleCloudCompute(study_id, gcp_project)
-                for instance in google_cloud_compute.list_instances():
-                    if instance == format_instance_name(google_cloud_compute.study_id, str(role)):
-                        google_cloud_compute.delete_instance(instance)
+                instances.setdefault(gcp_project, []).append(format_instance_name(study_id, str(role)))
 
-                google_cloud_compute.delete_firewall("")
-        logger.info("Successfully Deleted gcp instances and firewalls")
+        async def reset_project(gcp_project: str) -> Dict[str, str]:
+            google_cloud_compute = await AsyncGoogleCloudCompute.create(study_id, gcp_project)
+            return await google_cloud_compute.delete_instances_and_firewall(instances[gcp_project])
 
+        report = dict(zip(instances, await asyncio.gather(*map(reset_project, instances))))
+        logger.info(f"Deleted gcp instances and firewalls for study {study_id}: {report}")
+
+    update = StudyUpdate(doc_ref)
     for participant in doc_ref_dict["participants"]:
-        doc_ref_dict["status"][participant] = "ready to begin protocol" if participant == get_cp0_id() else ""
-        doc_ref_dict["personal_parameters"][participant]["PUBLIC_KEY"]["value"] = ""
-        doc_ref_dict["personal_parameters"][participant]["IP_ADDRESS"]["value"] = ""
-    doc_ref_dict["tasks"] = {key: [] for key in doc_ref_dict["tasks"].keys()}
-    await doc_ref.set(doc_ref_dict)
+        update.set("status", participant, value="ready to begin protocol" if participant == get_cp0_id() else "")
+        update.set("personal_parameters", participant, "PUBLIC_KEY", "value", value="")
+        update.set("personal_parameters", participant, "IP_ADDRESS", "value", value="")
+    for participant in doc_ref_dict["tasks"].keys():
+        update.set("tasks", participant, value=[])
+    await update.commit()
 
     return jsonify({"message": "Successfully restarted study"})
 
 
+@bp.route("/jobs", methods=["GET"])
+@authenticate
+async def jobs(user_id) -> Response:
+    study_id = validate_uuid(request.args.get("study_id"))
+    await fetch_study(study_id, user_id)
+    return jsonify({"jobs": await current_app.config["JOBS"].list(study_id)})
+
+
 @bp.route("/create_study", methods=["POST"])
 @authenticate_on_terra
 async def create_study(user_id="") -> Response:
@@ -134,25 +159,38 @@ async def delete_study(user_id) -> Response:
     db, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
 
     if not constants.TERRA:  # TODO: add equivalent for terra
-        for participant in doc_ref_dict["personal_parameters"].values():
-            if (gcp_project := participant.get("GCP_PROJECT").get("value")) != "":
-                google_cloud_compute = GoogleCloudCompute(study_id, gcp_project)
-                google_cloud_compute.delete_everything()
-        logger.info("Successfully deleted GCP instances and other related resources")
+        gcp_projects = {
+            gcp_project
+            for participant in doc_ref_dict["personal_parameters"].values()
+            if (gcp_project := participant.get("GCP_PROJECT").get("value")) != ""
+        }
+
+        async def delete_project(gcp_project: str) -> Dict[str, str]:
+            google_cloud_compute = await AsyncGoogleCloudCompute.create(study_id, gcp_project)
+            return await google_cloud_compute.delete_everything()
+
+        report = dict(zip(gcp_projects, await asyncio.gather(*map(delete_project, gcp_projects))))
+        logger.info(f"Deleted GCP instances and other related resources for study {study_id}: {report}")
 
     for participant in doc_ref_dict["personal_parameters"].values():
         if (auth_key := participant.get("AUTH_KEY").get("value")) != "":
-            doc_ref_auth_keys = db.collection("users").document("auth_keys")
-            await doc_ref_auth_keys.update({auth_key: firestore.DELETE_FIELD})
+            await delete_auth_key(auth_key)
     for participant in doc_ref_dict["participants"]:
         doc_ref_user = db.collection("users").document(participant)
         doc_ref_user_dict = (await doc_ref_user.get()).to_dict() or {}
         if doc_ref_user_dict.get("display_name") == "Anonymous":
             await doc_ref_user.delete()
-            # TODO: delete user from display_names. This will require reworking the user_ids, as they need to start with a letter and have no hyphens for firestore field names
-
-    await db.collection("deleted_studies").document(study_id).set(doc_ref_dict)
+            forget_display_name(participant)
+            forget_user(participant)
+
+    # archive the messages with the study, since deleting it leaves its subcollections behind;
+    # they go into a subcollection of the archived copy, which can't hold them all within Firestore's 1 MiB limit
+    await migrate_legacy_messages(doc_ref, doc_ref_dict)
+    archive_ref = db.collection("deleted_studies").document(study_id)
+    await archive_ref.set(doc_ref_dict)
+    await archive_messages(doc_ref, archive_ref)
     await doc_ref.delete()
+    invalidate_study(study_id)
 
     return jsonify({"message": "Successfully deleted study"})
 
@@ -167,12 +205,11 @@ async def study_information(user_id) -> Response:
         description = data.get("description")
         study_information = data.get("information")
 
-        await doc_ref.set(
-            {
-                "description": description,
-                "study_information": study_information,
-            },
-            merge=True,
+        await (
+            StudyUpdate(doc_ref)
+            .set("description", value=description)
+            .set("study_information", value=study_information)
+            .commit()
         )
 
         return jsonify({"message": "Study information updated successfully"})
@@ -188,20 +225,26 @@ async def parameters(user_id) -> Response:
     study_id = validate_uuid(request.args.get("study_id"))
     _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
     try:
+        update = StudyUpdate(doc_ref)
         for p, value in data.items():
             if p in doc_ref_dict["parameters"]:
-                doc_ref_dict["parameters"][p]["value"] = value
+                update.set("parameters", p, "value", value=value)
             elif p in doc_ref_dict["advanced_parameters"]:
-                doc_ref_dict["advanced_parameters"][p]["value"] = value
+                update.set("advanced_parameters", p, "value", value=value)
             elif "NUM_INDS" in p:
                 participant = p.split("NUM_INDS")[1]
-                doc_ref_dict["personal_parameters"][participant]["NUM_INDS"]["value"] = value
+                if participant not in doc_ref_dict["personal_parameters"]:
+                    raise KeyError(participant)
+                update.set("personal_parameters", participant, "NUM_INDS", "value", value=value)
             elif p in doc_ref_dict["personal_parameters"][user_id]:
-                doc_ref_dict["personal_parameters"][user_id][p]["value"] = value
+                update.set("personal_parameters", user_id, p, "value", value=value)
                 if p == "NUM_CPUS":
-                    doc_ref_dict["personal_parameters"][user_id]["NUM_THREADS"]["value"] = value
+                    update.set("personal_parameters", user_id, "NUM_THREADS", "value", value=value)
 
-        await doc_ref.set(doc_ref_dict, merge=True)
+        await update.commit()
+        if "GCP_PROJECT" in data:
+            old_project = doc_ref_dict["personal_parameters"][user_id]["GCP_PROJECT"]["value"]
+            forget_permissions(old_project, data["GCP_PROJECT"])
 
         return jsonify({"message": "Parameters updated successfully"})
     except:
@@ -1,27 +1,38 @@
 import asyncio
+import functools
+import hashlib
 import io
-import os
-import zipfile
-from datetime import datetime, timezone
+import re
+from datetime import datetime
+from typing import Optional, Tuple
 
 from firebase_admin import auth as firebase_auth
+from google.cloud.storage import Blob
 from quart import Blueprint, Response, current_app, jsonify, request, send_file
 from werkzeug.exceptions import BadRequest, Conflict, Forbidden
 
-from src.api_utils import fetch_study, get_display_names, get_studies, validate_json, validate_uuid
+from src.api_utils import (STUDY_LIST_FIELDS, fetch_study, get_display_names, get_studies, update_profile,
+                           validate_json, validate_uuid)
 from src.auth import authenticate, authenticate_on_terra, get_user_email
 from src.utils import constants, custom_logging
 from src.utils.generic_functions import add_notification, remove_notification
 from src.utils.google_cloud.google_cloud_secret_manager import get_firebase_api_key
-from src.utils.google_cloud.google_cloud_storage import download_blob_to_bytes
+from src.utils.google_cloud.google_cloud_storage import storage
 from src.utils.schemas.profile import profile_schema
 from src.utils.schemas.send_message import send_message_schema
 from src.utils.schemas.update_notifications import update_notifications_schema
-from src.utils.studies_functions import check_conditions, update_status_and_start_setup
+from src.utils.studies_functions import (add_message, check_conditions, get_messages, migrate_legacy_messages,
+                                         update_status_and_start_setup)
+from src.utils.study_mutations import StudyUpdate
+from src.utils.zip_stream import ZipEntry, ZipStream
 
 logger = custom_logging.setup_logging(__name__)
 bp = Blueprint("web", __name__, url_prefix="/api")
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+MESSAGE_ID_PATTERN = re.compile(r"[0-9a-zA-Z-]{1,64}")
+
 
 @bp.route("/createCustomToken", methods=["POST"])
 @authenticate
@@ -43,52 +54,79 @@ async def create_custom_token(user_id) -> Response:
         raise BadRequest("Error creating custom token")
 
 
+def _get_page_args() -> Tuple[Optional[int], str]:
+    limit = request.args.get("limit", type=int)
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    cursor = request.args.get("cursor", "")
+    if cursor:
+        validate_uuid(cursor)
+    return limit, cursor
+
+
 @bp.route("/public_studies", methods=["GET"])
 @authenticate_on_terra
 async def public_studies(user_id="") -> Response:
+    limit, cursor = _get_page_args()
+
+    async def render() -> dict:
+        public_studies = await get_studies(private_filter=False, limit=limit, start_after=cursor)
+        display_names = await get_display_names(study["owner"] for study in public_studies)
+        for study in public_studies:
+            study["owner_name"] = display_names.get(study["owner"], study["owner"])
+        next_cursor = public_studies[-1]["study_id"] if limit and len(public_studies) == limit else None
+        return {"studies": public_studies, "next_cursor": next_cursor}
+
     try:
-        public_studies = await get_studies(private_filter=False)
-        display_names = await get_display_names()
+        page, etag = await current_app.config["PUBLIC_STUDIES_CACHE"].get((limit, cursor), render)
+    except BadRequest:
+        raise
     except:
         logger.exception(f"Failed to fetch public studies:")
         raise BadRequest("Failed to fetch public studies")
 
-    for study in public_studies:
-        study["owner_name"] = display_names.get(study["owner"], study["owner"])
-
-    return jsonify({"studies": public_studies})
+    res = Response(status=304) if request.if_none_match.contains(etag) else jsonify(page)
+    res.set_etag(etag)
+    # the page is the same for every caller, so let browsers revalidate it instead of refetching
+    res.headers["Cache-Control"] = "private, no-cache"
+    return res
 
 
 @bp.route("/my_studies", methods=["GET"])
 @authenticate
 async def my_studies(user_id) -> Response:
+    limit, cursor = _get_page_args()
+    fields = [field for field in request.args.get("fields", "").split(",") if field]
+    if any(field not in STUDY_LIST_FIELDS for field in fields):
+        raise BadRequest(f"fields must be a subset of {','.join(STUDY_LIST_FIELDS)}")
+
     try:
-        my_studies = await get_studies()
-        display_names = await get_display_names()
+        email = await get_user_email(user_id)
+        my_studies = await get_studies(user_id=user_id, email=email, fields=fields, limit=limit, start_after=cursor)
+        display_names = await get_display_names(study["owner"] for study in my_studies if "owner" in study)
+    except BadRequest:
+        raise
     except:
         logger.exception("Failed to fetch my studies:")
         raise BadRequest("Failed to fetch my studies")
 
     for study in my_studies:
-        study["owner_name"] = display_names.get(study["owner"], study["owner"])
+        if "owner" in study:
+            study["owner_name"] = display_names.get(study["owner"], study["owner"])
 
-    email = await get_user_email(user_id)
-    my_studies = [
-        study for study in my_studies if user_id in study["participants"] or email in study["invited_participants"]
-    ]
-    return jsonify({"studies": my_studies})
+    next_cursor = my_studies[-1]["study_id"] if limit and len(my_studies) == limit else None
+    return jsonify({"studies": my_studies, "next_cursor": next_cursor})
 
 
 @bp.route("/profile/<target_user_id>", methods=["GET", "POST"])
 @authenticate
 async def profile(user_id: str, target_user_id: str = "") -> Response:
     db = current_app.config["DATABASE"]
-    display_names = (await db.collection("users").document("display_names").get()).to_dict() or {}
-    profile = (await db.collection("users").document(target_user_id).get()).to_dict() or {}
 
     if request.method == "GET":
         try:
-            profile["displayName"] = display_names.get(target_user_id, target_user_id)
+            profile = (await db.collection("users").document(target_user_id).get()).to_dict() or {}
+            profile["displayName"] = (await get_display_names([target_user_id]))[target_user_id]
             profile = {key: profile[key] for key in ["about", "displayName", "email"] if key in profile}
             return jsonify({"profile": profile})
         except:
@@ -100,11 +138,7 @@ async def profile(user_id: str, target_user_id: str = "") -> Response:
 
         data = validate_json(await request.get_json(), schema=profile_schema)
         try:
-            display_names[target_user_id] = data["displayName"]
-            await db.collection("users").document("display_names").set(display_names)
-
-            profile["about"] = data["about"]
-            await db.collection("users").document(target_user_id).set(profile)
+            await update_profile(target_user_id, {"display_name": data["displayName"], "about": data["about"]})
 
             return jsonify({"message": "Profile updated successfully"})
         except:
@@ -120,14 +154,14 @@ async def start_protocol(user_id) -> Response:
     statuses = doc_ref_dict["status"]
 
     if statuses[user_id] == "":
-        if message := check_conditions(doc_ref_dict, user_id):
+        if message := await check_conditions(doc_ref_dict, user_id):
             raise Conflict(message)
 
         if "dry_run" in request.args:
             return jsonify({"message": "Protocol would have started successfully"})
 
         statuses[user_id] = "ready to begin sfkit"
-        await doc_ref.set({"status": statuses}, merge=True)
+        await StudyUpdate(doc_ref).set("status", user_id, value=statuses[user_id]).commit()
 
     if "" in statuses.values():
         logger.info("Not all participants are ready.")
@@ -147,18 +181,28 @@ async def send_message(user_id) -> Response:
     if not message or not study_id:
         raise BadRequest("Missing required fields")
 
-    _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
+    _, doc_ref, _ = await fetch_study(study_id, user_id)
+    new_message = await add_message(doc_ref, user_id, message)
 
-    new_message = {
-        "sender": user_id,
-        "time": datetime.now(timezone.utc).strftime("%m/%d/%Y %H:%M"),
-        "body": message,
-    }
+    return jsonify({"message": "Message sent successfully", "data": new_message})
 
-    doc_ref_dict["messages"] = doc_ref_dict.get("messages", []) + [new_message]
-    await doc_ref.set(doc_ref_dict)
 
-    return jsonify({"message": "Message sent successfully", "data": new_message})
+@bp.route("/messages", methods=["GET"])
+@authenticate
+async def messages(user_id) -> Response:
+    study_id = validate_uuid(request.args.get("study_id"))
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    cursor = request.args.get("cursor", "")
+    if cursor and not MESSAGE_ID_PATTERN.fullmatch(cursor):
+        raise BadRequest("Invalid cursor")
+
+    _, doc_ref, doc_ref_dict = await fetch_study(study_id, user_id)
+    await migrate_legacy_messages(doc_ref, doc_ref_dict)
+    messages, next_cursor = await get_messages(doc_ref, limit, start_after=cursor)
+
+    return jsonify({"messages": messages, "next_cursor": next_cursor})
 
 
 @bp.route("/download_results_file", methods=("GET",))
@@ -170,46 +214,103 @@ async def download_results_file(user_id) -> Response:
     role: str = str(doc_ref_dict["participants"].index(user_id))
     shared = f"{study_id}/p{role}"
 
-    result_name = "result.txt"
-    result_file = download_blob_to_bytes(constants.RESULTS_BUCKET, os.path.join(shared, result_name))
-
-    plot_file, plot_name = None, ""
+    names = ["result.txt"]
     if "GWAS" in doc_ref_dict["study_type"]:
-        plot_name = "manhattan.png"
+        names.append("manhattan.png")
     elif "PCA" in doc_ref_dict["study_type"]:
-        plot_name = "pca_plot.png"
-    if plot_name:
-        plot_file = download_blob_to_bytes(constants.RESULTS_BUCKET, os.path.join(shared, plot_name))
-
-    if not result_file and not plot_file:
-        result_file = "Failed to get results".encode()
-
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        if result_file:
-            zip_file.writestr(result_name, result_file)
-        if plot_file:
-            zip_file.writestr(plot_name, plot_file)
-
-    zip_buffer.seek(0)
-    return await send_file(
-        zip_buffer,
-        attachment_filename=f"{study_id}_p{role}_results.zip",
+        names.append("pca_plot.png")
+
+    blobs = (await storage.metadata_many(constants.RESULTS_BUCKET, [f"{shared}/{name}" for name in names])).values()
+    if _use_signed_urls(request.args.get("signed_url")):
+        found = [(name, blob) for name, blob in zip(names, blobs) if blob is not None]
+        if not found:
+            raise BadRequest("Failed to get results")
+        urls = await asyncio.gather(
+            *(storage.signed_url(blob, name, constants.SIGNED_URL_TTL) for name, blob in found)
+        )
+        files = [{"name": name, "url": url} for (name, _), url in zip(found, urls)]
+        return jsonify({"files": files, "expires_in": constants.SIGNED_URL_TTL})
+
+    entries = [_blob_zip_entry(name, blob) for name, blob in zip(names, blobs) if blob is not None]
+    if not entries:
+        entries = [_bytes_zip_entry("result.txt", "Failed to get results".encode())]
+
+    # entries are stored rather than deflated: the PNGs are compressed already,
+    # and it makes the archive's length known up front, so that interrupted downloads can be resumed
+    archive = ZipStream(entries)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{archive.etag}"',
+        "Content-Disposition": f'attachment; filename="{study_id}_p{role}_results.zip"',
+    }
+
+    content_range = None
+    # multipart/byteranges responses aren't supported, so several ranges get the whole archive
+    if request.range and len(request.range.ranges) == 1 and _if_range_matches(archive.etag):
+        content_range = request.range.range_for_length(archive.length)
+        if content_range is None:
+            return Response("", status=416, headers=headers | {"Content-Range": f"bytes */{archive.length}"})
+
+    start, stop = content_range or (0, archive.length)
+    if content_range:
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{archive.length}"
+    headers["Content-Length"] = str(stop - start)
+    return Response(
+        archive.generate(start, stop),
+        status=206 if content_range else 200,
+        headers=headers,
         mimetype="application/zip",
-        as_attachment=True,
     )
 
 
+def _blob_zip_entry(name: str, blob: Blob) -> ZipEntry:
+    return ZipEntry(
+        name=name,
+        size=blob.size or 0,
+        modified=blob.updated or blob.time_created,
+        read=functools.partial(storage.read_range, blob),
+        key=(blob.bucket.name, blob.name, blob.generation),
+    )
+
+
+def _bytes_zip_entry(name: str, data: bytes) -> ZipEntry:
+    async def read(start: int, end: int):
+        yield data[start:end]
+
+    return ZipEntry(name, len(data), datetime(1980, 1, 1), read, hashlib.sha256(data).hexdigest())
+
+
+def _if_range_matches(etag: str) -> bool:
+    # a Range request whose If-Range doesn't match the current archive gets the whole archive instead
+    if_range = request.if_range
+    return (if_range.etag is None and if_range.date is None) or if_range.etag == etag
+
+
+def _use_signed_urls(value) -> bool:
+    # signed URLs let the client download straight from GCS, so the bytes don't go through this server
+    if value is None:
+        value = constants.SIGNED_URL_DOWNLOADS
+    return str(value).lower() in ("1", "true", "yes")
+
+
 @bp.route("/fetch_plot_file", methods=["POST"])
 @authenticate
 async def fetch_plot_file(user_id) -> Response:
-    study_id = validate_uuid((await request.get_json()).get("study_id"))
+    data = await request.get_json()
+    study_id = validate_uuid(data.get("study_id"))
     _, _, doc_ref_dict = await fetch_study(study_id, user_id)
     role: str = str(doc_ref_dict["participants"].index(user_id))
 
     plot_name = "manhattan" if "GWAS" in doc_ref_dict["study_type"] else "pca_plot"
 
-    if plot := download_blob_to_bytes(constants.RESULTS_BUCKET, f"{study_id}/p{role}/{plot_name}.png"):
+    if _use_signed_urls(data.get("signed_url")):
+        blob = await storage.metadata(constants.RESULTS_BUCKET, f"{study_id}/p{role}/{plot_name}.png")
+        if blob is None:
+            raise BadRequest("Failed to fetch plot")
+        url = await storage.signed_url(blob, f"{plot_name}.png", constants.SIGNED_URL_TTL)
+        return jsonify({"name": f"{plot_name}.png", "url": url, "expires_in": constants.SIGNED_URL_TTL})
+
+    if plot := await storage.download(constants.RESULTS_BUCKET, f"{study_id}/p{role}/{plot_name}.png"):
         return await send_file(
             io.BytesIO(plot),
             mimetype="image/png",
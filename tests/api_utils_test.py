@@ -0,0 +1,90 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fake_firestore import FakeFirestore
+from quart import Quart
+from werkzeug.exceptions import BadRequest
+
+from src import api_utils
+from src.utils import migrations
+
+
+def run_with_db(test) -> FakeFirestore:
+    db = FakeFirestore()
+    app = Quart(__name__)
+    app.config["DATABASE"] = db
+    api_utils._display_names.clear()
+    migrations._done.clear()
+
+    async def run():
+        async with app.app_context():
+            await test(db)
+
+    asyncio.run(run())
+    return db
+
+
+async def add_users(db: FakeFirestore) -> None:
+    await db.collection("users").document("alice").set({"display_name": "alice@example.com"})
+    await db.collection("users").document("bob").set({"display_name": "Bob"})
+    # alice renamed herself before display names moved into the user documents
+    await db.collection("users").document("display_names").set({"alice": "Alice"})
+
+
+def test_legacy_display_names_take_precedence_until_migrated():
+    async def test(db):
+        await add_users(db)
+        assert await api_utils.get_display_names(["alice", "bob", "carol"]) == {
+            "alice": "Alice",
+            "bob": "Bob",
+            "carol": "carol",
+        }
+
+    run_with_db(test)
+
+
+def test_migrated_display_names_come_from_the_user_documents():
+    async def test(db):
+        await add_users(db)
+        await migrations.run_migrations(db)
+        api_utils._display_names.clear()
+        # the migration has copied the legacy name, so the map isn't read anymore
+        await db.collection("users").document("display_names").set({"alice": "Stale"})
+        assert await api_utils.get_display_names(["alice", "bob"]) == {"alice": "Alice", "bob": "Bob"}
+
+    run_with_db(test)
+
+
+def test_updated_display_name_overrides_the_legacy_one():
+    async def test(db):
+        await add_users(db)
+        assert (await api_utils.get_display_names(["alice"]))["alice"] == "Alice"
+
+        await api_utils.update_profile("alice", {"display_name": "Alice A.", "about": ""})
+        assert (await api_utils.get_display_names(["alice"]))["alice"] == "Alice A."
+
+        await migrations.run_migrations(db)
+        assert (await db.collection("users").document("alice").get()).get("display_name") == "Alice A."
+
+    run_with_db(test)
+
+
+def test_studies_are_paged_newest_first_by_cursor():
+    async def test(db):
+        created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for i in range(5):
+            participants = ["alice"] if i != 2 else ["bob"]
+            study = {"study_id": f"study{i}", "created": created + timedelta(days=i), "participants": participants}
+            await db.collection("studies").document(f"study{i}").set(study)
+
+        pages, cursor = [], ""
+        while page := await api_utils.get_studies(user_id="alice", fields=["title"], limit=2, start_after=cursor):
+            pages.append([study["study_id"] for study in page])
+            cursor = page[-1]["study_id"]
+        assert pages == [["study4", "study3"], ["study1", "study0"]]
+
+        with pytest.raises(BadRequest):
+            await api_utils.get_studies(user_id="alice", limit=2, start_after="missing")
+
+    run_with_db(test)
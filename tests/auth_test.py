@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+from fake_firestore import FakeFirestore
+from fake_sam import FakeSAM
+from quart import Quart
+from werkzeug.exceptions import Unauthorized
+
+from src import auth
+from src.utils import http_clients, migrations
+
+
+def run_with_db(test) -> FakeFirestore:
+    db = FakeFirestore()
+    app = Quart(__name__)
+    app.config["DATABASE"] = db
+    auth._auth_keys.clear()
+    migrations._done.clear()
+
+    async def run():
+        async with app.app_context():
+            await test(db)
+
+    asyncio.run(run())
+    return db
+
+
+async def add_legacy_keys(db: FakeFirestore, keys: dict) -> None:
+    await db.collection("users").document("auth_keys").set(keys)
+
+
+def test_auth_key_options_include_legacy_keys_after_one_was_migrated_on_use():
+    async def test(db):
+        await add_legacy_keys(
+            db,
+            {
+                "key1": {"username": "alice", "study_id": "s1", "title": "One"},
+                "key2": {"username": "alice", "study_id": "s2", "title": "Two"},
+                "key3": {"username": "bob", "study_id": "s1", "title": "One"},
+            },
+        )
+        assert (await auth._get_auth_key_user("key1"))["study_id"] == "s1"
+        assert (await db.collection("auth_keys").document("key1").get()).exists
+
+        options = await auth.get_auth_key_options("alice")
+        assert sorted(option["auth_key"] for option in options) == ["key1", "key2"]
+        assert (await db.collection("auth_keys").document("key2").get()).exists
+
+    run_with_db(test)
+
+
+def test_auth_key_options_skip_the_legacy_map_once_migrated():
+    async def test(db):
+        await add_legacy_keys(db, {"key1": {"username": "alice", "study_id": "s1", "title": "One"}})
+        await migrations.run_migrations(db)
+        reads = db.reads
+        options = await auth.get_auth_key_options("alice")
+        assert [option["auth_key"] for option in options] == ["key1"]
+        assert db.reads == reads + 1  # just the auth_keys query
+        assert await auth._get_auth_key_user("unknown") in (None, {})
+
+    run_with_db(test)
+
+
+def test_unknown_auth_keys_are_cached():
+    async def test(db):
+        assert not await auth._get_auth_key_user("unknown")
+        reads = db.reads
+        assert not await auth._get_auth_key_user("unknown")
+        assert db.reads == reads
+
+    run_with_db(test)
+
+
+def test_deleted_auth_keys_are_forgotten():
+    async def test(db):
+        await db.collection("auth_keys").document("key1").set({"username": "alice", "study_id": "s1"})
+        assert await auth._get_auth_key_user("key1")
+        await auth.delete_auth_key("key1")
+        assert not await auth._get_auth_key_user("key1")
+
+    run_with_db(test)
+
+
+def run_with_sam(test) -> FakeSAM:
+    sam = FakeSAM(delay=0.05)
+    auth._terra_users.clear()
+
+    async def run():
+        await http_clients.set_transport(sam.transport)
+        try:
+            await test()
+        finally:
+            await http_clients.set_transport(None)
+
+    asyncio.run(run())
+    return sam
+
+
+def test_concurrent_terra_lookups_of_one_token_share_a_sam_request():
+    async def test():
+        users = await asyncio.gather(*(auth._get_terra_user(f"{auth.BEARER_PREFIX}user{i % 2}") for i in range(10)))
+        assert [user["sub"] for user in users] == ["user0", "user1"] * 5
+        # and the next lookups are served from the cache
+        assert (await auth._get_terra_user(f"{auth.BEARER_PREFIX}user0"))["sub"] == "user0"
+
+    assert run_with_sam(test).requests == 2
+
+
+def test_failed_terra_lookups_are_shared_but_not_cached():
+    async def test():
+        results = await asyncio.gather(*(auth._get_terra_user("Basic nope") for _ in range(5)), return_exceptions=True)
+        assert all(isinstance(result, Unauthorized) for result in results)
+        with pytest.raises(Unauthorized):
+            await auth._get_terra_user("Basic nope")
+
+    assert run_with_sam(test).requests == 2
+
+
+def test_each_event_loop_gets_its_own_http_client():
+    async def get_and_close():
+        client = http_clients.get_http_client()
+        assert http_clients.get_http_client() is client
+        await http_clients.close_http_client()
+        assert client.is_closed
+        return client
+
+    assert asyncio.run(get_and_close()) is not asyncio.run(get_and_close())
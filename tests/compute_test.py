@@ -0,0 +1,132 @@
+import asyncio
+import itertools
+from typing import Any, Dict, List, Optional
+
+from src.utils.google_cloud import google_cloud_compute
+from src.utils.google_cloud.google_cloud_compute import GoogleCloudCompute, TeardownPlan
+
+_projects = itertools.count()
+
+
+class FakeRequest:
+    def __init__(self, response: dict) -> None:
+        self.response = response
+
+    def execute(self) -> dict:
+        return self.response
+
+
+class FakeFirewalls:
+    def __init__(self, service: "FakeComputeService") -> None:
+        self.service = service
+
+    def list(self, project: str, filter: Optional[str] = None) -> FakeRequest:
+        self.service.calls.append(("firewalls.list", filter))
+        items = list(self.service.existing_firewalls.values())
+        if filter:
+            items = [item for item in items if filter == f'name = "{item["name"]}"']
+        return FakeRequest({"items": items})
+
+    def insert(self, project: str, body: dict) -> FakeRequest:
+        self.service.calls.append(("firewalls.insert", body["name"]))
+        self.service.existing_firewalls[body["name"]] = body
+        return FakeRequest(self.service.operation(project, "insert", f"global/firewalls/{body['name']}"))
+
+
+class FakeOperations:
+    def __init__(self, service: "FakeComputeService") -> None:
+        self.service = service
+
+    def wait(self, operation: str, **_kwargs: Any) -> FakeRequest:
+        return FakeRequest(self.service.operations[operation])
+
+
+class FakeComputeService:
+    """Just enough of the Compute Engine discovery client for firewalls, whose operations finish at once."""
+
+    def __init__(self) -> None:
+        self.existing_firewalls: Dict[str, dict] = {}
+        self.operations: Dict[str, dict] = {}
+        self.calls: List[tuple] = []
+
+    def operation(self, project: str, kind: str, target: str) -> dict:
+        name = f"operation-{len(self.operations)}"
+        self.operations[name] = {
+            "name": name,
+            "status": "DONE",
+            "operationType": kind,
+            "targetLink": f"https://www.googleapis.com/compute/v1/projects/{project}/{target}",
+        }
+        return self.operations[name]
+
+    def firewalls(self) -> FakeFirewalls:
+        return FakeFirewalls(self)
+
+    def globalOperations(self) -> FakeOperations:
+        return FakeOperations(self)
+
+
+def fake_compute(monkeypatch) -> GoogleCloudCompute:
+    service = FakeComputeService()
+    monkeypatch.setattr(google_cloud_compute, "get_service", lambda *_args: service)
+    compute = GoogleCloudCompute("study", f"project-{next(_projects)}")
+    monkeypatch.setattr(compute, "get_network", lambda: {"selfLink": "network"})
+    return compute
+
+
+def test_create_firewall_looks_up_the_firewall_by_name(monkeypatch):
+    compute = fake_compute(monkeypatch)
+    service: FakeComputeService = compute.compute  # type: ignore
+    service.existing_firewalls["other"] = {"name": "other"}
+    study = {"participants": ["alice"], "personal_parameters": {"alice": {"IP_ADDRESS": {"value": ""}}}}
+
+    compute.create_firewall(study)
+    compute.create_firewall(study)
+
+    name_filter = f'name = "{compute.firewall_name}"'
+    # the insert invalidates the cached lookup, so the second call looks the firewall up again, and finds it
+    assert service.calls == [
+        ("firewalls.list", name_filter),
+        ("firewalls.insert", compute.firewall_name),
+        ("firewalls.list", name_filter),
+    ]
+    compute.create_firewall(study)
+    assert len(service.calls) == 3
+
+
+def test_teardown_plan_deletes_resources_after_their_dependents():
+    async def run() -> None:
+        events: List[str] = []
+
+        def step(resource: str, delay: float = 0, error: Optional[Exception] = None):
+            async def delete() -> None:
+                events.append(f"start {resource}")
+                await asyncio.sleep(delay)
+                if error:
+                    raise error
+                events.append(f"end {resource}")
+
+            return delete
+
+        plan = TeardownPlan("study")
+        instances = [plan.add(f"instance{i}", step(f"instance{i}", delay=0.02)) for i in range(2)]
+        subnet = plan.add("subnet", step("subnet"), after=instances)
+        firewall = plan.add("firewall", step("firewall", error=RuntimeError("in use")))
+        plan.add("network", step("network"), after=[subnet, firewall])
+        plan.add("router", step("router"), after=[subnet])
+
+        results = await plan.run()
+        assert results == {
+            "instance0": "deleted",
+            "instance1": "deleted",
+            "subnet": "deleted",
+            "firewall": "failed: in use",
+            "network": "skipped: firewall not deleted",
+            "router": "deleted",
+        }
+        # independent steps run concurrently, and dependent ones only once their dependencies are gone
+        assert events[:3] == ["start instance0", "start instance1", "start firewall"]
+        assert events.index("start subnet") > max(events.index("end instance0"), events.index("end instance1"))
+        assert events.index("start router") > events.index("end subnet")
+
+    asyncio.run(run())
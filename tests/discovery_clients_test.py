@@ -0,0 +1,51 @@
+import threading
+from typing import List
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from src.utils.google_cloud import discovery_clients
+
+
+@pytest.fixture(autouse=True)
+def credentials():
+    discovery_clients.set_credentials(AnonymousCredentials())
+    yield
+    discovery_clients.set_credentials(None)
+
+
+def test_each_api_client_is_built_once_and_shared_between_threads(monkeypatch):
+    builds: List[tuple] = []
+
+    def build(name: str, version: str, **_kwargs) -> object:
+        builds.append((name, version))
+        return object()
+
+    monkeypatch.setattr(discovery_clients.googleapi, "build", build)
+    services: List[object] = []
+
+    def get_service() -> None:
+        services.append(discovery_clients.get_service("compute", "v1"))
+
+    threads = [threading.Thread(target=get_service) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert builds == [("compute", "v1")]
+    assert len(services) == 8 and all(service is services[0] for service in services)
+    discovery_clients.get_service("iam", "v1")
+    assert builds == [("compute", "v1"), ("iam", "v1")]
+
+
+def test_requests_use_a_connection_per_thread():
+    service = discovery_clients.get_service("compute", "v1")
+    request = service.instances().list(project="project", zone="zone")
+    assert request.http is service.instances().get(project="project", zone="zone", instance="a").http
+
+    other: List[object] = []
+    thread = threading.Thread(target=lambda: other.append(service.instances().list(project="p", zone="z").http))
+    thread.start()
+    thread.join()
+    assert other[0] is not request.http
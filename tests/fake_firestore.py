@@ -0,0 +1,308 @@
+"""
+In-memory stand-in for the parts of firestore.AsyncClient that the app uses, for tests that run without the emulator.
+
+Writes apply the usual transforms (server timestamps, increments, array unions and removals, field deletes),
+queries support field filters, ordering, cursors and limits, and transactions work with
+firestore.async_transactional, committing their writes atomically on success.
+"""
+import copy
+import itertools
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud import firestore
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import parse_field_path
+from google.cloud.firestore_v1.transforms import ArrayRemove, ArrayUnion, Increment
+
+_ids = itertools.count()
+
+
+class FakeFirestore:
+    def __init__(self) -> None:
+        self.docs: Dict[str, dict] = {}
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self, name)
+
+    def document(self, path: str) -> "FakeDocument":
+        collection, _, doc_id = path.rpartition("/")
+        return FakeDocument(self, collection, doc_id)
+
+    def batch(self) -> "FakeBatch":
+        return FakeBatch(self)
+
+    def transaction(self, **_kwargs) -> "FakeTransaction":
+        return FakeTransaction(self)
+
+    async def get_all(self, refs, field_paths=None, transaction=None) -> Any:
+        for ref in refs:
+            yield await ref.get(transaction=transaction)
+
+    def _apply(self, op: str, path: str, data: Optional[dict] = None, merge: bool = False) -> None:
+        self.writes += 1
+        if op == "delete":
+            self.docs.pop(path, None)
+        elif op == "create":
+            if path in self.docs:
+                raise AlreadyExists(f"Document already exists: {path}")
+            self.docs[path] = _transform({}, data or {})
+        elif op == "set":
+            self.docs[path] = _transform(self.docs.get(path, {}) if merge else {}, data or {})
+        elif op == "update":
+            if path not in self.docs:
+                raise NotFound(f"No document to update: {path}")
+            self.docs[path] = _transform(self.docs[path], data or {})
+
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocument", data: Optional[dict]) -> None:
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str) -> Any:
+        value: Any = self._data
+        for part in field.split("."):
+            value = value[part]
+        return copy.deepcopy(value)
+
+
+class FakeDocument:
+    def __init__(self, db: FakeFirestore, collection: str, doc_id: str) -> None:
+        self._db = db
+        self.id = doc_id
+        self.path = f"{collection}/{doc_id}"
+        self.parent = FakeCollection(db, collection)
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    async def get(self, transaction=None, **_kwargs) -> FakeSnapshot:
+        self._db.reads += 1
+        return FakeSnapshot(self, copy.deepcopy(self._db.docs.get(self.path)))
+
+    async def create(self, data: dict) -> None:
+        self._db._apply("create", self.path, data)
+
+    async def set(self, data: dict, merge: bool = False) -> None:
+        self._db._apply("set", self.path, data, merge)
+
+    async def update(self, data: dict) -> None:
+        self._db._apply("update", self.path, data)
+
+    async def delete(self) -> None:
+        self._db._apply("delete", self.path)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FakeDocument) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+
+class FakeQuery:
+    def __init__(self, db: FakeFirestore, path: str) -> None:
+        self._db = db
+        self._path = path
+        self._filters: List[Tuple[str, str, Any]] = []
+        self._orders: List[Tuple[str, str]] = []
+        self._cursor: Optional[Any] = None
+        self._limit: Optional[int] = None
+
+    def _copy(self) -> "FakeQuery":
+        query = copy.copy(self)
+        query._filters = list(self._filters)
+        query._orders = list(self._orders)
+        return query
+
+    def where(self, *, filter: FieldFilter) -> "FakeQuery":
+        query = self._copy()
+        query._filters.append((filter.field_path, filter.op_string, filter.value))
+        return query
+
+    def order_by(self, field: str, direction: str = firestore.Query.ASCENDING) -> "FakeQuery":
+        query = self._copy()
+        query._orders.append((field, direction))
+        return query
+
+    def start_after(self, cursor: Any) -> "FakeQuery":
+        query = self._copy()
+        query._cursor = cursor
+        return query
+
+    def limit(self, count: int) -> "FakeQuery":
+        query = self._copy()
+        query._limit = count
+        return query
+
+    def select(self, _fields: List[str]) -> "FakeQuery":
+        return self
+
+    async def stream(self, transaction=None) -> Any:
+        for snapshot in self._run():
+            yield snapshot
+
+    async def get(self, transaction=None) -> List[FakeSnapshot]:
+        return list(self._run())
+
+    def _run(self) -> Iterator[FakeSnapshot]:
+        prefix = self._path + "/"
+        docs = [
+            (path[len(prefix) :], data)
+            for path, data in self._db.docs.items()
+            if path.startswith(prefix) and "/" not in path[len(prefix) :]
+        ]
+        docs = [(doc_id, data) for doc_id, data in docs if all(_matches(data, *f) for f in self._filters)]
+        for field, direction in reversed(self._orders or [("__name__", firestore.Query.ASCENDING)]):
+            docs.sort(key=lambda doc: _sort_key(doc, field), reverse=direction == firestore.Query.DESCENDING)
+        if self._cursor is not None:
+            cursor_id = self._cursor.id if isinstance(self._cursor, (FakeSnapshot, FakeDocument)) else self._cursor
+            ids = [doc_id for doc_id, _ in docs]
+            docs = docs[ids.index(cursor_id) + 1 :] if cursor_id in ids else []
+        if self._limit is not None:
+            docs = docs[: self._limit]
+        for doc_id, data in docs:
+            self._db.reads += 1
+            yield FakeSnapshot(FakeDocument(self._db, self._path, doc_id), copy.deepcopy(data))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db: FakeFirestore, path: str) -> None:
+        super().__init__(db, path)
+        self.id = path.rpartition("/")[2]
+
+    def document(self, doc_id: Optional[str] = None) -> FakeDocument:
+        return FakeDocument(self._db, self._path, doc_id or f"auto{next(_ids):08d}")
+
+    async def add(self, data: dict) -> Tuple[datetime, FakeDocument]:
+        ref = self.document()
+        await ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+
+class FakeBatch:
+    """Collects writes and applies them together on commit, failing like Firestore past 500 writes."""
+
+    def __init__(self, db: FakeFirestore) -> None:
+        self._db = db
+        self._writes: List[Tuple[str, str, Optional[dict], bool]] = []
+
+    def create(self, ref: FakeDocument, data: dict) -> None:
+        self._writes.append(("create", ref.path, data, False))
+
+    def set(self, ref: FakeDocument, data: dict, merge: bool = False) -> None:
+        self._writes.append(("set", ref.path, data, merge))
+
+    def update(self, ref: FakeDocument, data: dict) -> None:
+        self._writes.append(("update", ref.path, data, False))
+
+    def delete(self, ref: FakeDocument) -> None:
+        self._writes.append(("delete", ref.path, None, False))
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    async def commit(self) -> list:
+        if len(self._writes) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        docs = copy.deepcopy(self._db.docs)
+        try:
+            for op, path, data, merge in self._writes:
+                self._db._apply(op, path, data, merge)
+        except Exception:
+            self._db.docs = docs
+            raise
+        writes, self._writes = self._writes, []
+        return writes
+
+
+class FakeTransaction(FakeBatch):
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db: FakeFirestore) -> None:
+        super().__init__(db)
+        self._id: Optional[bytes] = None
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._id = None
+
+    async def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        self._id = b"fake"
+
+    async def _commit(self) -> list:
+        return await self.commit()
+
+    async def _rollback(self) -> None:
+        self._clean_up()
+
+
+def _transform(base: dict, data: dict) -> dict:
+    result = copy.deepcopy(base)
+    for key, value in data.items():
+        # update() paths quote segments that aren't plain identifiers, e.g. emails, in backticks
+        *parents, field = parse_field_path(key) if "`" in key else key.split(".")
+        target = result
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        if value is firestore.DELETE_FIELD:
+            target.pop(field, None)
+        elif value is firestore.SERVER_TIMESTAMP:
+            target[field] = datetime.now(timezone.utc)
+        elif isinstance(value, Increment):
+            target[field] = target.get(field, 0) + value.value
+        elif isinstance(value, ArrayUnion):
+            target[field] = target.get(field, []) + [v for v in value.values if v not in target.get(field, [])]
+        elif isinstance(value, ArrayRemove):
+            target[field] = [v for v in target.get(field, []) if v not in value.values]
+        else:
+            target[field] = copy.deepcopy(value)
+    return result
+
+
+_MISSING = object()
+
+
+def _field(data: dict, field: str) -> Any:
+    value: Any = data
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _matches(data: dict, field: str, op: str, expected: Any) -> bool:
+    value = _field(data, field)
+    if value is _MISSING:
+        return False
+    if op == "==":
+        return value == expected
+    if op == "!=":
+        return value != expected
+    if op == "in":
+        return value in expected
+    if op == "not-in":
+        return value not in expected
+    if op == "array_contains":
+        return isinstance(value, list) and expected in value
+    if op == "array_contains_any":
+        return isinstance(value, list) and any(v in value for v in expected)
+    return {"<": value < expected, "<=": value <= expected, ">": value > expected, ">=": value >= expected}[op]
+
+
+def _sort_key(doc: Tuple[str, dict], field: str) -> Any:
+    doc_id, data = doc
+    if field == "__name__":
+        return doc_id
+    value = _field(data, field)
+    return (value is not _MISSING, value if value is not _MISSING else 0, doc_id)
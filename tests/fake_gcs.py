@@ -0,0 +1,85 @@
+"""
+Stand-in for GCS resumable upload sessions and blob range reads, for tests that run without fake-gcs-server.
+
+Sessions answer like GCS: 308 with the persisted Range while an upload is incomplete, 200 once it is,
+and 404 for unknown sessions. persist_limit makes a session persist only part of each chunk, as GCS may.
+"""
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import httpx
+
+CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+
+@dataclass
+class FakeSession:
+    data: bytearray = field(default_factory=bytearray)
+    total: Optional[int] = None
+    complete: bool = False
+
+
+class FakeGCS:
+    def __init__(self, persist_limit: Optional[int] = None) -> None:
+        self.sessions: Dict[str, FakeSession] = {}
+        self.blobs: Dict[str, bytes] = {}
+        self.requests: List[str] = []
+        self.persist_limit = persist_limit
+        self.transport = httpx.MockTransport(self.handle)
+
+    def create_session(self, name: str) -> str:
+        self.sessions[name] = FakeSession()
+        return f"https://storage.example/upload/{name}"
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        name = request.url.path.rsplit("/", 1)[1]
+        content_range = request.headers.get("Content-Range", "")
+        self.requests.append(content_range)
+        session = self.sessions.get(name)
+        match = CONTENT_RANGE.fullmatch(content_range)
+        if session is None or not match:
+            return httpx.Response(404 if session is None else 400)
+        if match[3] != "*":
+            session.total = int(match[3])
+
+        body = request.content
+        if match[1] is not None:
+            start = int(match[1])
+            if start != len(session.data):
+                return self._progress(session)
+            if self.persist_limit is not None and session.total != start + len(body):
+                body = body[: self.persist_limit]
+            session.data += body
+
+        if session.total is not None and len(session.data) == session.total:
+            session.complete = True
+            self.blobs[name] = bytes(session.data)
+            return httpx.Response(200, json={"name": name, "size": str(session.total)})
+        return self._progress(session)
+
+    @staticmethod
+    def _progress(session: FakeSession) -> httpx.Response:
+        headers = {"Range": f"bytes=0-{len(session.data) - 1}"} if session.data else {}
+        return httpx.Response(308, headers=headers)
+
+
+class FakeBlob:
+    """Enough of google.cloud.storage.Blob for range reads and the results archive."""
+
+    def __init__(self, name: str, data: bytes, generation: int = 1, bucket: str = "results") -> None:
+        self.name = name
+        self.bucket = SimpleNamespace(name=bucket)
+        self.size = len(data)
+        self.generation = generation
+        self.updated = datetime(2024, 1, 2, 3, 4, 6, tzinfo=timezone.utc)
+        self.time_created = self.updated
+        self.data = data
+        self.reads: List[tuple] = []
+
+    def download_as_bytes(self, start: int, end: int, if_generation_match: int, checksum=None) -> bytes:
+        assert if_generation_match == self.generation
+        self.reads.append((start, end))
+        return self.data[start : end + 1]
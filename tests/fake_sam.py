@@ -0,0 +1,27 @@
+"""
+Stand-in for SAM's /api/users/v2/self, for tests and benchmarks that run offline.
+
+Any bearer token is a valid user, whose ID is the token itself. Each lookup takes delay seconds,
+so that concurrent lookups overlap, and the number of lookups is kept in requests.
+"""
+import asyncio
+
+import httpx
+
+BEARER_PREFIX = "Bearer "
+
+
+class FakeSAM:
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.requests = 0
+        self.transport = httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        auth_header = request.headers.get("Authorization", "")
+        if request.url.path != "/api/users/v2/self" or not auth_header.startswith(BEARER_PREFIX):
+            return httpx.Response(401)
+        token = auth_header[len(BEARER_PREFIX) :]
+        return httpx.Response(200, json={"sub": token, "email": f"{token}@example.com"})
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Dict, Iterable, List
+
+import pytest
+
+from src.utils import constants
+from src.utils.google_cloud import google_cloud_iam
+from src.utils.google_cloud.google_cloud_iam import forget_permissions, has_permissions
+
+
+class FakeIAM:
+    granted: Dict[str, bool] = {}
+    checks: List[str] = []
+
+    def test_permissions(self, project_id: str, _desired_permissions: Iterable[str]) -> bool:
+        self.checks.append(project_id)
+        return self.granted.get(project_id, False)
+
+
+@pytest.fixture(autouse=True)
+def iam(monkeypatch):
+    monkeypatch.setattr(google_cloud_iam, "GoogleCloudIAM", FakeIAM)
+    monkeypatch.setattr(FakeIAM, "granted", {})
+    monkeypatch.setattr(FakeIAM, "checks", [])
+    google_cloud_iam._permission_checks.clear()
+    yield
+    google_cloud_iam._permission_checks.clear()
+
+
+def test_missing_permissions_are_cached_only_briefly(monkeypatch):
+    monkeypatch.setattr(constants, "IAM_PERMISSION_NEGATIVE_TTL", 0.05)
+
+    async def run() -> None:
+        assert not await has_permissions("project")
+        assert not await has_permissions("project")
+        assert FakeIAM.checks == ["project"]
+
+        FakeIAM.granted["project"] = True
+        await asyncio.sleep(0.06)
+        assert await has_permissions("project")
+        assert await has_permissions("project")
+        assert await has_permissions("project", ["compute.instances.get"])
+        assert FakeIAM.checks == ["project", "project", "project"]
+
+    asyncio.run(run())
+
+
+def test_forgotten_permissions_are_checked_again():
+    async def run() -> None:
+        FakeIAM.granted = {"project": True, "other": True}
+        assert await has_permissions("project") and await has_permissions("other")
+        assert await has_permissions("project", ["compute.instances.get"])
+
+        FakeIAM.granted["project"] = False
+        forget_permissions("project")
+        assert not await has_permissions("project")
+        assert not await has_permissions("project", ["compute.instances.get"])
+        assert await has_permissions("other")
+        assert FakeIAM.checks == ["project", "other", "project", "project", "project"]
+
+    asyncio.run(run())
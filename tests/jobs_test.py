@@ -0,0 +1,169 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple
+
+from fake_firestore import FakeFirestore
+from quart import Quart
+
+from src.utils import api_functions, studies_functions
+from src.utils.google_cloud import google_cloud_compute
+from src.utils.jobs import JobQueue, enqueue_job, job_handler
+from src.utils.study_cache import StudyCache
+
+calls: List[Tuple] = []
+releases: dict = {}
+
+
+@job_handler("test_record")
+async def record(study_id: str, role: str, step: str = "") -> None:
+    calls.append(("start", study_id, role, step))
+    if (release := releases.get((study_id, role, step))) is not None:
+        await release.wait()
+    calls.append(("end", study_id, role, step))
+
+
+class FakeCompute:
+    def __init__(self, study_id: str, gcp_project: str) -> None:
+        self.study_id = study_id
+        self.gcp_project = gcp_project
+
+    @classmethod
+    async def create(cls, study_id: str, gcp_project: str) -> "FakeCompute":
+        return cls(study_id, gcp_project)
+
+    async def stop_instance(self, name: str) -> None:
+        calls.append(("stop_instance", self.gcp_project, name))
+
+    async def delete_instance(self, name: str) -> None:
+        calls.append(("delete_instance", self.gcp_project, name))
+
+
+def run_with_queue(test, lease: float = 60) -> FakeFirestore:
+    db = FakeFirestore()
+    app = Quart(__name__)
+    queue = JobQueue(db, workers=4, lease=lease)
+    app.config.update(DATABASE=db, JOBS=queue, STUDY_CACHE=StudyCache(None))
+    calls.clear()
+    releases.clear()
+
+    async def run():
+        await queue.start(app)
+        try:
+            async with app.app_context():
+                await test(db, queue)
+        finally:
+            await queue.close()
+
+    asyncio.run(run())
+    return db
+
+
+async def wait_for(db: FakeFirestore, job_id: str, timeout: float = 5) -> dict:
+    for _ in range(int(timeout / 0.01)):
+        job = (await db.collection("jobs").document(job_id).get()).to_dict() or {}
+        if job.get("status") in ("done", "failed"):
+            return job
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"job {job_id} didn't finish: {job}")
+
+
+def test_handlers_get_the_study_id_and_their_arguments():
+    async def test(db, _queue):
+        job = await wait_for(db, await enqueue_job("test_record", "study", role="1", step="a"))
+        assert job["status"] == "done", job
+        assert calls == [("start", "study", "1", "a"), ("end", "study", "1", "a")]
+
+    run_with_queue(test)
+
+
+def test_finished_protocol_stops_or_deletes_the_instance(monkeypatch):
+    monkeypatch.setattr(api_functions, "AsyncGoogleCloudCompute", FakeCompute)
+
+    async def test(db, _queue):
+        study_ref = db.collection("studies").document("study")
+        study = {
+            "study_id": "study",
+            "personal_parameters": {
+                "alice": {"CREATE_VM": {"value": "Yes"}, "DELETE_VM": {"value": "Yes"}},
+                "bob": {"CREATE_VM": {"value": "Yes"}, "DELETE_VM": {"value": "No"}},
+            },
+            "status": {},
+        }
+        await study_ref.set(study)
+
+        for username, role in (("alice", "1"), ("bob", "2")):
+            await api_functions.process_status(
+                username, "study", "status=Finished protocol", study_ref, study, f"project-{role}", role
+            )
+        for doc in await db.collection("jobs").get():
+            assert (await wait_for(db, doc.id))["status"] == "done"
+
+        assert sorted(calls) == [
+            ("delete_instance", "project-1", google_cloud_compute.format_instance_name("study", "1")),
+            ("stop_instance", "project-2", google_cloud_compute.format_instance_name("study", "2")),
+        ]
+
+    run_with_queue(test)
+
+
+def test_setup_gcp_jobs_provision_the_given_role(monkeypatch):
+    async def setup_gcp(doc_ref, role: str) -> None:
+        calls.append(("setup_gcp", doc_ref.id, role))
+
+    monkeypatch.setattr(studies_functions, "setup_gcp", setup_gcp)
+
+    async def test(db, _queue):
+        job = await wait_for(db, await enqueue_job("setup_gcp", "study", role="0"))
+        assert job["status"] == "done", job
+        assert calls == [("setup_gcp", "study", "0")]
+
+    run_with_queue(test)
+
+
+def test_jobs_of_different_roles_run_concurrently_and_of_the_same_role_in_order():
+    async def test(db, _queue):
+        releases[("study", "1", "a")] = asyncio.Event()
+        first = await enqueue_job("test_record", "study", role="1", step="a")
+        same_role = await enqueue_job("test_record", "study", role="1", step="b")
+        other_role = await enqueue_job("test_record", "study", role="2", step="a")
+
+        await wait_for(db, other_role)
+        assert ("start", "study", "1", "b") not in calls
+        releases[("study", "1", "a")].set()
+        await wait_for(db, first)
+        await wait_for(db, same_role)
+        assert calls.index(("end", "study", "1", "a")) < calls.index(("start", "study", "1", "b"))
+
+    run_with_queue(test)
+
+
+def test_jobs_whose_lease_lapsed_are_picked_up_while_running():
+    async def test(db, _queue):
+        now = datetime.now(timezone.utc)
+        await db.collection("jobs").document("orphan").set(
+            {
+                "kind": "test_record",
+                "study_id": "study",
+                "args": {"role": "1", "step": "orphan"},
+                "status": "running",
+                "attempts": 1,
+                "created": now - timedelta(seconds=1),
+                "lease_expires": now - timedelta(seconds=0.1),
+            }
+        )
+        job = await wait_for(db, "orphan")
+        assert job["status"] == "done" and job["attempts"] == 2
+        assert ("end", "study", "1", "orphan") in calls
+
+    run_with_queue(test, lease=0.2)
+
+
+def test_unknown_kinds_are_rejected():
+    async def test(_db, _queue):
+        try:
+            await enqueue_job("no_such_kind", "study")
+        except ValueError:
+            return
+        raise AssertionError("expected a ValueError")
+
+    run_with_queue(test)
@@ -0,0 +1,77 @@
+import asyncio
+import json
+from pathlib import Path
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt import algorithms
+from werkzeug.exceptions import ServiceUnavailable
+
+from src import auth
+from src.utils import constants
+from src.utils.jwks import JWKSManager
+
+
+def private_key() -> rsa.RSAPrivateKey:
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def write_jwks(path: Path, keys: dict) -> None:
+    jwks = [json.loads(algorithms.RSAAlgorithm.to_jwk(key.public_key())) | {"kid": kid} for kid, key in keys.items()]
+    path.write_text(json.dumps({"keys": jwks}))
+
+
+def test_unknown_key_id_refetches_rotated_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "JWKS_UNKNOWN_KID_INTERVAL", 0)
+    path = tmp_path / "jwks.json"
+    old, new = private_key(), private_key()
+    write_jwks(path, {"old": old})
+
+    async def run() -> None:
+        jwks = JWKSManager(path.as_uri())
+        assert (await jwks.get_key("old")).public_numbers() == old.public_key().public_numbers()
+        assert await jwks.get_key("new") is None
+
+        write_jwks(path, {"old": old, "new": new})
+        assert (await jwks.get_key("new")).public_numbers() == new.public_key().public_numbers()
+
+        # a failed refetch keeps the keys that were loaded before
+        path.unlink()
+        assert await jwks.get_key("newer") is None
+        assert await jwks.get_key("new") is not None
+
+    asyncio.run(run())
+
+
+def test_unknown_key_ids_are_refetched_at_most_once_per_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "JWKS_UNKNOWN_KID_INTERVAL", 3600)
+    path = tmp_path / "jwks.json"
+    write_jwks(path, {"old": private_key()})
+
+    async def run() -> None:
+        jwks = JWKSManager(path.as_uri())
+        await jwks.get_key("old")
+        write_jwks(path, {"new": private_key()})
+        assert await jwks.get_key("new") is None
+
+    asyncio.run(run())
+
+
+def test_tokens_are_unverifiable_until_the_keys_first_load(tmp_path, monkeypatch):
+    path = tmp_path / "jwks.json"
+    monkeypatch.setattr(auth, "jwks", JWKSManager(path.as_uri()))
+    token = jwt.encode({"sub": "alice"}, private_key(), algorithm="RS256", headers={"kid": "key"})
+
+    async def run() -> None:
+        for _ in range(2):
+            # the second request is within JWKS_MIN_TTL of the failed load, so it doesn't retry it
+            with pytest.raises(ServiceUnavailable):
+                await auth._get_azure_b2c_user(auth.BEARER_PREFIX + token)
+
+        # once the endpoint is back, a retry loads the keys
+        write_jwks(path, {"key": private_key()})
+        await auth.jwks.refresh()
+        assert await auth.jwks.get_key("key") is not None
+
+    asyncio.run(run())
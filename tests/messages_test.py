@@ -0,0 +1,73 @@
+import asyncio
+
+from fake_firestore import FakeFirestore
+from quart import Quart
+
+from src.utils.studies_functions import archive_messages, get_messages, migrate_legacy_messages
+from src.utils.study_cache import StudyCache
+
+
+def run_with_db(test) -> None:
+    db = FakeFirestore()
+    app = Quart(__name__)
+    app.config["DATABASE"] = db
+    app.config["STUDY_CACHE"] = StudyCache(None)
+
+    async def run():
+        async with app.app_context():
+            await test(db)
+
+    asyncio.run(run())
+
+
+def legacy_messages(count: int) -> list:
+    return [
+        {"sender": "alice", "body": f"message {i}", "time": f"2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}"}
+        for i in range(count)
+    ]
+
+
+def test_migrating_more_legacy_messages_than_fit_in_a_batch():
+    async def test(db):
+        study_ref = db.collection("studies").document("s")
+        await study_ref.set({"title": "S", "messages": legacy_messages(1234)})
+
+        await migrate_legacy_messages(study_ref, (await study_ref.get()).to_dict())
+
+        assert "messages" not in (await study_ref.get()).to_dict()
+        messages, _ = await get_messages(study_ref, limit=2000)
+        assert len(messages) == 1234
+
+    run_with_db(test)
+
+
+def test_interrupted_migration_resumes_with_the_first_missing_batch():
+    async def test(db):
+        study_ref = db.collection("studies").document("s")
+        await study_ref.set({"title": "S", "messages": legacy_messages(1200)})
+        # the first batch made it before the instance went away
+        batch = db.batch()
+        for i, message in enumerate(legacy_messages(500)):
+            batch.set(study_ref.collection("messages").document(f"legacy-{i:05d}"), message | {"created": 0})
+        await batch.commit()
+
+        writes = db.writes
+        await migrate_legacy_messages(study_ref, (await study_ref.get()).to_dict())
+        assert db.writes == writes + 700 + 1
+        assert len([doc async for doc in study_ref.collection("messages").stream()]) == 1200
+
+    run_with_db(test)
+
+
+def test_archiving_messages_in_batches():
+    async def test(db):
+        study_ref = db.collection("studies").document("s")
+        archive_ref = db.collection("deleted_studies").document("s")
+        await study_ref.set({"title": "S", "messages": legacy_messages(600)})
+        await migrate_legacy_messages(study_ref, (await study_ref.get()).to_dict())
+
+        assert await archive_messages(study_ref, archive_ref) == 600
+        assert not [doc async for doc in study_ref.collection("messages").stream()]
+        assert len([doc async for doc in archive_ref.collection("messages").stream()]) == 600
+
+    run_with_db(test)
@@ -0,0 +1,132 @@
+import asyncio
+from typing import List, Optional
+
+import pytest
+
+from src.utils.signaling_backends import BrokerSignalingBackend, FirestoreBroker, InProcessBroker
+
+
+class FailingBroker(InProcessBroker):
+    def __init__(self, fail: str) -> None:
+        super().__init__()
+        self.fail = fail
+
+    async def subscribe(self, channel: str, callback):
+        if self.fail == "subscribe" or (self.fail == "watch" and channel.endswith("/presence")):
+            raise ConnectionError("broker is down")
+        return await super().subscribe(channel, callback)
+
+    async def add_member(self, key: str, member: str, ttl: float) -> None:
+        if self.fail == "add_member":
+            raise ConnectionError("broker is down")
+        await super().add_member(key, member, ttl)
+
+
+class SilentQuery:
+    def where(self, **_kwargs) -> "SilentQuery":
+        return self
+
+    def order_by(self, *_args) -> "SilentQuery":
+        return self
+
+    def on_snapshot(self, _callback) -> "SilentQuery":
+        self.unsubscribed = False
+        return self
+
+    def unsubscribe(self) -> None:
+        self.unsubscribed = True
+
+
+class SilentClient:
+    def __init__(self) -> None:
+        self.query = SilentQuery()
+
+    def collection(self, _name: str) -> SilentQuery:
+        return self.query
+
+
+def test_parties_on_different_instances_reach_each_other():
+    async def run() -> None:
+        broker = InProcessBroker()
+        first, second = BrokerSignalingBackend(broker), BrokerSignalingBackend(broker)
+        received: List[tuple] = []
+
+        await first.join("study", 0, lambda msg: received.append((0, msg)))
+        waiting = asyncio.create_task(first.wait_for_parties("study", 2))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        assert not await second.is_connected("study", 1)
+
+        await second.join("study", 1, lambda msg: received.append((1, msg)))
+        await asyncio.wait_for(waiting, 1)
+        assert await first.is_connected("study", 1)
+        assert await second.is_connected("study", 0)
+
+        await first.publish("study", 1, {"data": "to 1"})
+        await second.publish("study", 0, {"data": "to 0"})
+        assert received == [(1, {"data": "to 1"}), (0, {"data": "to 0"})]
+
+        await second.leave("study", 1)
+        await asyncio.sleep(0)
+        assert not await first.is_connected("study", 1)
+        await first.close()
+        assert not broker._subscribers and not broker._sets
+
+    asyncio.run(run())
+
+
+def test_sessions_are_handed_over_only_for_their_token():
+    async def run() -> None:
+        broker = InProcessBroker()
+        first, second = BrokerSignalingBackend(broker), BrokerSignalingBackend(broker)
+        received: List[dict] = []
+
+        async def hand_over(token: str) -> Optional[List[dict]]:
+            if token != "token":
+                return None
+            await first.leave("study", 0)
+            return [{"data": "kept"}]
+
+        await first.join("study", 0, received.append, hand_over)
+        assert await second.hand_over("study", 0, "wrong") is None
+        assert await first.is_connected("study", 0)
+        assert await second.hand_over("study", 0, "token") == [{"data": "kept"}]
+        assert not await second.is_connected("study", 0)
+        assert not received and not broker._subscribers and not broker._sets
+
+    asyncio.run(run())
+
+
+def test_handover_gives_up_when_no_instance_answers(monkeypatch):
+    monkeypatch.setattr(BrokerSignalingBackend, "HANDOVER_TIMEOUT", 0.01)
+
+    async def run() -> None:
+        broker = InProcessBroker()
+        await BrokerSignalingBackend(broker).join("study", 0, lambda _msg: None)
+        assert await BrokerSignalingBackend(broker).hand_over("study", 0, "token") is None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("fail", ["subscribe", "add_member", "watch"])
+def test_failed_join_leaves_nothing_behind(fail):
+    async def run() -> None:
+        broker = FailingBroker(fail)
+        backend = BrokerSignalingBackend(broker)
+        with pytest.raises(ConnectionError):
+            await backend.join("study", 0, lambda _msg: None)
+        assert not backend._local and not backend._watches
+        assert not broker._subscribers and not broker._sets
+
+    asyncio.run(run())
+
+
+def test_firestore_subscription_times_out_when_the_listener_never_catches_up(monkeypatch):
+    async def run() -> None:
+        client = SilentClient()
+        monkeypatch.setattr(FirestoreBroker, "SUBSCRIBE_TIMEOUT", 0.01)
+        with pytest.raises(TimeoutError):
+            await FirestoreBroker(None, client).subscribe("channel", lambda _msg: None)  # type: ignore
+        assert client.query.unsubscribed
+
+    asyncio.run(run())
@@ -0,0 +1,157 @@
+import asyncio
+from typing import List, Optional
+
+import pytest
+from quart import Quart
+from werkzeug.exceptions import Conflict
+
+from src import signaling
+from src.signaling import SESSION_TOKEN_HEADER, STUDY_ID_HEADER, Message, MessageType
+from src.utils import constants
+from src.utils.signaling_backends import BrokerSignalingBackend, InMemorySignalingBackend, InProcessBroker
+
+
+@pytest.fixture
+def app(monkeypatch):
+    async def get_user_id(ws):
+        return ws.headers.get("X-User")
+
+    async def get_study_participants(_study_id):
+        return ["alice", "bob"]
+
+    monkeypatch.setattr(signaling, "_get_user_id", get_user_id)
+    monkeypatch.setattr(signaling, "_get_study_participants", get_study_participants)
+    monkeypatch.setattr(signaling, "sessions", signaling.SessionManager())
+    app = Quart(__name__)
+    app.config["SIGNALING"] = InMemorySignalingBackend()
+    app.register_blueprint(signaling.bp)
+    return app
+
+
+def connect(app: Quart, user: str, token: str = ""):
+    headers = {"X-User": user, STUDY_ID_HEADER: "study"} | ({SESSION_TOKEN_HEADER: token} if token else {})
+    return app.test_client().websocket("/api/ice", headers=headers)
+
+
+class FakeWebsocket:
+    def __init__(self) -> None:
+        self.sent: List[dict] = []
+
+    async def send_json(self, msg: dict) -> None:
+        self.sent.append(msg)
+
+
+def candidate(data: str, target: int) -> dict:
+    return {"type": "candidate", "data": data, "targetPID": target}
+
+
+def session(pid: int) -> Optional[signaling.PartySession]:
+    hub = signaling.sessions.hubs.get("study")
+    return hub.sessions.get(pid) if hub else None
+
+
+async def wait_until(condition) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+def test_resumed_session_replays_messages_sent_while_disconnected(app):
+    async def run() -> None:
+        async with connect(app, "bob") as bob:
+            async with connect(app, "alice") as alice:
+                await alice.send_json(candidate("first", 1))
+                assert (await bob.receive_json())["data"] == "first"
+            alice_session = session(0)
+            assert alice_session is not None
+            await wait_until(lambda: alice_session.channel is None)
+
+            await bob.send_json(candidate("while away", 0))
+            await bob.send_json(candidate("still away", 0))
+            await wait_until(lambda: len(alice_session.replay) == 2)
+
+            async with connect(app, "alice", alice_session.token) as alice:
+                assert (await alice.receive_json())["data"] == "while away"
+                assert (await alice.receive_json())["data"] == "still away"
+                assert session(0) is alice_session and alice_session.connects == 2
+
+    asyncio.run(run())
+
+
+def test_reconnecting_without_a_token_restarts_a_disconnected_session(app):
+    async def run() -> None:
+        async with connect(app, "bob") as bob:
+            async with connect(app, "alice"):
+                await wait_until(lambda: session(0) is not None)
+            alice_session = session(0)
+            assert alice_session is not None
+            token = alice_session.token
+            await wait_until(lambda: alice_session.channel is None)
+            await bob.send_json(candidate("stale", 0))
+            await wait_until(lambda: len(alice_session.replay) == 1)
+
+            async with connect(app, "alice") as alice:
+                await bob.send_json(candidate("fresh", 0))
+                assert (await alice.receive_json())["data"] == "fresh"
+                assert alice_session.token != token and alice_session.replay_dropped == 1
+
+    asyncio.run(run())
+
+
+def test_reconnecting_without_a_token_to_a_connected_session_conflicts(app):
+    async def run() -> None:
+        async with connect(app, "bob"):
+            async with connect(app, "alice"):
+                async with connect(app, "alice") as duplicate:
+                    assert (await duplicate.receive_json())["type"] == "error"
+
+    asyncio.run(run())
+
+
+def test_idle_websocket_is_detached_from_its_session(app, monkeypatch):
+    monkeypatch.setattr(constants, "SIGNALING_IDLE_TIMEOUT", 0.05)
+
+    async def run() -> None:
+        async with connect(app, "bob"):
+            async with connect(app, "alice"):
+                await wait_until(lambda: session(0) is not None)
+                alice_session = session(0)
+                assert alice_session is not None
+                await wait_until(lambda: alice_session.channel is None)
+                assert alice_session.disconnected is not None
+
+    asyncio.run(run())
+
+
+def test_session_resumes_on_another_instance():
+    async def run() -> None:
+        broker = InProcessBroker()
+        old = signaling.SessionManager().hub("study", BrokerSignalingBackend(broker))
+        new = signaling.SessionManager().hub("study", BrokerSignalingBackend(broker))
+        await old.connect(1, FakeWebsocket(), None)
+        alice_session = await old.connect(0, FakeWebsocket(), None)
+        assert alice_session.channel is not None
+        await old.disconnect(alice_session, alice_session.channel)
+        await old.route(Message(MessageType.CANDIDATE, "while away", sourcePID=1, targetPID=0))
+
+        for token in (None, "wrong"):
+            with pytest.raises(Conflict):
+                await new.connect(0, FakeWebsocket(), token)
+
+        alice = FakeWebsocket()
+        resumed = await new.connect(0, alice, alice_session.token)
+        assert resumed.token == alice_session.token and 0 not in old.sessions
+        await wait_until(lambda: len(alice.sent) == 1)
+        assert alice.sent[0]["data"] == "while away"
+
+        # the old instance sees the party again once the new one has joined
+        await wait_until(lambda: 0 in old.backend._watches["study"].parties)  # type: ignore[attr-defined]
+        await old.route(Message(MessageType.CANDIDATE, "after", sourcePID=1, targetPID=0))
+        await wait_until(lambda: len(alice.sent) == 2)
+        assert alice.sent[1]["data"] == "after"
+        await old.close()
+        await new.close()
+
+    asyncio.run(run())
@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import io
+import threading
+import zipfile
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+import pytest
+from fake_gcs import FakeBlob, FakeGCS
+
+from src.utils import constants
+from src.utils.google_cloud import google_cloud_storage
+from src.utils.google_cloud.google_cloud_storage import RESUMABLE_CHUNK_QUANTUM, ResumableUpload, storage
+from src.utils.zip_stream import ZipEntry, ZipStream
+
+
+@pytest.fixture
+def gcs(monkeypatch) -> FakeGCS:
+    gcs = FakeGCS()
+    monkeypatch.setattr(google_cloud_storage, "_http", httpx.AsyncClient(transport=gcs.transport))
+    return gcs
+
+
+def test_resumable_upload_sends_whole_chunks_then_the_rest(gcs):
+    async def run():
+        data = bytes(range(256)) * (3 * RESUMABLE_CHUNK_QUANTUM // 256 + 100)
+        upload = ResumableUpload(gcs.create_session("blob"), chunk_size=RESUMABLE_CHUNK_QUANTUM)
+        for i in range(0, len(data), 100_000):
+            await upload.write(data[i : i + 100_000])
+        await upload.finish()
+        assert upload.complete and upload.offset == len(data)
+        assert gcs.blobs["blob"] == data
+        assert len(gcs.requests) == 4
+
+    asyncio.run(run())
+
+
+def test_resumable_upload_resends_what_gcs_did_not_persist(gcs):
+    gcs.persist_limit = RESUMABLE_CHUNK_QUANTUM
+
+    async def run():
+        data = b"x" * (4 * RESUMABLE_CHUNK_QUANTUM + 5)
+        session_url = gcs.create_session("blob")
+        upload = ResumableUpload(session_url, total_size=len(data), chunk_size=2 * RESUMABLE_CHUNK_QUANTUM)
+        await upload.write(data)
+        await upload.finish()
+        assert gcs.blobs["blob"] == data
+
+    asyncio.run(run())
+
+
+def test_resumable_upload_resumes_from_the_persisted_offset(gcs):
+    async def run():
+        data = b"y" * (2 * RESUMABLE_CHUNK_QUANTUM + 10)
+        session_url = gcs.create_session("blob")
+        first = ResumableUpload(session_url, total_size=len(data), chunk_size=RESUMABLE_CHUNK_QUANTUM)
+        await first.write(data[: RESUMABLE_CHUNK_QUANTUM + 10])
+        assert await first.flush() == RESUMABLE_CHUNK_QUANTUM
+
+        second = ResumableUpload(session_url, total_size=len(data), chunk_size=RESUMABLE_CHUNK_QUANTUM)
+        assert await second.query() == RESUMABLE_CHUNK_QUANTUM
+        await second.write(data[second.offset :])
+        await second.finish()
+        assert gcs.blobs["blob"] == data
+
+    asyncio.run(run())
+
+
+def test_expired_upload_sessions_are_reported(gcs):
+    async def run():
+        with pytest.raises(google_cloud_storage.UploadSessionExpired):
+            await ResumableUpload("https://storage.example/upload/gone", total_size=1).query()
+
+    asyncio.run(run())
+
+
+def test_read_range_reads_in_download_chunks(monkeypatch):
+    monkeypatch.setattr(constants, "DOWNLOAD_CHUNK_SIZE", 10)
+
+    async def run():
+        blob = FakeBlob("blob", bytes(range(95)))
+        chunks = [chunk async for chunk in storage.read_range(blob, 5, 42)]  # type: ignore[arg-type]
+        assert b"".join(chunks) == bytes(range(5, 42))
+        assert blob.reads == [(5, 14), (15, 24), (25, 34), (35, 41)]
+
+    asyncio.run(run())
+
+
+def test_download_many_downloads_concurrently(monkeypatch):
+    blobs = {"study/p1/result.txt": b"result", "study/p1/manhattan.png": b"plot"}
+    names = [*blobs, "study/p1/missing.png"]
+    # every download has to be in flight at once for any of them to get past the barrier
+    barrier = threading.Barrier(len(names), timeout=5)
+
+    def download(_bucket_name: str, blob_name: str) -> Optional[bytes]:
+        barrier.wait()
+        return blobs.get(blob_name)
+
+    monkeypatch.setattr(google_cloud_storage, "download_blob_to_bytes", download)
+    assert asyncio.run(storage.download_many("results", names)) == blobs | {"study/p1/missing.png": None}
+
+
+def test_zip_stream_ranges_reassemble_into_a_valid_archive(monkeypatch):
+    monkeypatch.setattr(constants, "DOWNLOAD_CHUNK_SIZE", 7)
+
+    async def run():
+        blobs = [FakeBlob(f"result{i}.txt", bytes(range(i, 50 + i)) * (i + 1), generation=i + 1) for i in range(3)]
+        modified = datetime(2024, 1, 2, 3, 4, 6, tzinfo=timezone.utc)
+
+        def entry(blob: FakeBlob) -> ZipEntry:
+            read = functools.partial(storage.read_range, blob)
+            return ZipEntry(blob.name, blob.size, modified, read, (blob.name, blob.generation))  # type: ignore
+
+        async def read(start: int = 0, stop: Optional[int] = None) -> bytes:
+            # a new archive for every request, as the download endpoint does
+            return b"".join([chunk async for chunk in ZipStream([entry(blob) for blob in blobs]).generate(start, stop)])
+
+        whole = await read()
+        assert len(whole) == ZipStream([entry(blob) for blob in blobs]).length
+        parts = [await read(start, min(start + 61, len(whole))) for start in range(0, len(whole), 61)]
+        assert b"".join(parts) == whole
+
+        with zipfile.ZipFile(io.BytesIO(whole)) as zf:
+            assert zf.testzip() is None
+            for blob in blobs:
+                assert zf.read(blob.name) == blob.data
+
+    asyncio.run(run())
+
+
+def test_emulator_download_urls_need_no_signature(monkeypatch):
+    monkeypatch.setattr(constants, "STORAGE_EMULATOR_HOST", "http://localhost:4443/")
+
+    class Bucket:
+        name = "results"
+
+    class Blob:
+        bucket = Bucket()
+        name = "study/p1/result.txt"
+
+    url = google_cloud_storage.generate_download_url(Blob(), "result.txt", 60)  # type: ignore[arg-type]
+    assert url == "http://localhost:4443/download/storage/v1/b/results/o/study%2Fp1%2Fresult.txt?alt=media"
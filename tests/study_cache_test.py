@@ -0,0 +1,116 @@
+import asyncio
+
+from fake_firestore import FakeDocument, FakeFirestore, FakeSnapshot
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+from src.utils import metrics
+from src.utils.study_cache import PublicStudiesCache, StudyCache
+
+
+class SlowDocument:
+    """Wraps a document so that reads can be held until the test releases them."""
+
+    def __init__(self, ref) -> None:
+        self.ref = ref
+        self.id = ref.id
+        self.release = asyncio.Event()
+
+    async def get(self):
+        snapshot = await self.ref.get()
+        await self.release.wait()
+        return snapshot
+
+
+def test_study_cache_hits_until_invalidated():
+    async def run():
+        db = FakeFirestore()
+        await db.collection("studies").document("a").set({"title": "A"})
+        cache = StudyCache(None)
+        ref = db.collection("studies").document("a")
+
+        assert await cache.get(ref) == {"title": "A"}
+        reads = db.reads
+        (await cache.get(ref))["title"] = "mutated copy"
+        assert await cache.get(ref) == {"title": "A"}
+        assert db.reads == reads
+
+        await ref.update({"title": "B"})
+        cache.invalidate("a")
+        assert await cache.get(ref) == {"title": "B"}
+        assert db.reads == reads + 1
+        assert cache.stats() == {"size": 1}
+
+    asyncio.run(run())
+
+
+def test_study_cache_drops_only_fetches_that_raced_with_their_own_study():
+    async def run():
+        db = FakeFirestore()
+        await db.collection("studies").document("a").set({"title": "A"})
+        await db.collection("studies").document("b").set({"title": "B"})
+        cache = StudyCache(None)
+        slow_a = SlowDocument(db.collection("studies").document("a"))
+        slow_b = SlowDocument(db.collection("studies").document("b"))
+
+        fetch_a = asyncio.create_task(cache.get(slow_a))
+        fetch_b = asyncio.create_task(cache.get(slow_b))
+        await asyncio.sleep(0)
+        cache.invalidate("b")  # unrelated to a
+        slow_a.release.set()
+        slow_b.release.set()
+        await asyncio.gather(fetch_a, fetch_b)
+
+        hits = metrics.snapshot()["counters"].get("study_cache.hits", 0)
+        await cache.get(db.collection("studies").document("a"))
+        assert metrics.snapshot()["counters"]["study_cache.hits"] == hits + 1
+        # b's fetch may predate the write that invalidated it, so it isn't cached
+        assert cache.stats() == {"size": 1}
+        assert not cache._versions.keys() - {"a"}
+        assert not cache._fetches
+
+    asyncio.run(run())
+
+
+def test_study_cache_evicts_least_recently_used():
+    async def run():
+        db = FakeFirestore()
+        cache = StudyCache(None, max_size=2)
+        for study_id in "abc":
+            await db.collection("studies").document(study_id).set({"title": study_id})
+            await cache.get(db.collection("studies").document(study_id))
+        assert list(cache._entries) == ["b", "c"]
+        assert await cache.get(db.collection("studies").document("missing")) == {}
+        assert cache.stats() == {"size": 2}
+
+    asyncio.run(run())
+
+
+def change(change_type: ChangeType, study_id: str, data: dict) -> DocumentChange:
+    return DocumentChange(change_type, FakeSnapshot(FakeDocument(FakeFirestore(), "studies", study_id), data), 0, 0)
+
+
+def test_public_studies_cache_ignores_changes_to_unlisted_fields():
+    async def run():
+        cache = PublicStudiesCache(None, fields=["title", "participants"])
+        renders = 0
+
+        async def render() -> dict:
+            nonlocal renders
+            renders += 1
+            return {"studies": [], "render": renders}
+
+        cache.on_changes([change(ChangeType.ADDED, "a", {"title": "A", "participants": ["x"], "status": {}})])
+        page, etag = await cache.get((10, ""), render)
+
+        status_update = {"title": "A", "participants": ["x"], "status": {"x": "1"}}
+        cache.on_changes([change(ChangeType.MODIFIED, "a", status_update)])
+        assert await cache.get((10, ""), render) == (page, etag)
+
+        cache.on_changes([change(ChangeType.MODIFIED, "a", {"title": "B", "participants": ["x"], "status": {}})])
+        assert (await cache.get((10, ""), render))[0]["render"] == 2
+
+        cache.on_changes([change(ChangeType.REMOVED, "a", {"title": "B", "participants": ["x"]})])
+        assert (await cache.get((10, ""), render))[0]["render"] == 3
+        assert renders == 3
+
+    asyncio.run(run())
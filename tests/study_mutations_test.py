@@ -0,0 +1,45 @@
+import asyncio
+
+from fake_firestore import FakeFirestore
+
+from src.utils.api_functions import update_parameter
+from src.utils.study_mutations import StudyUpdate
+
+USER = "alice@example.com"
+
+
+def study() -> dict:
+    return {
+        "title": "study",
+        "parameters": {"NUM_SNPS": {"value": "100"}},
+        "personal_parameters": {USER: {"PORTS": {"value": ""}}, "bob": {"PORTS": {"value": "9000"}}},
+    }
+
+
+def test_study_update_applies_only_the_changed_fields_in_a_transaction():
+    async def run():
+        db = FakeFirestore()
+        doc_ref = db.collection("studies").document("study")
+        await doc_ref.set(study() | {"participants": [USER]})
+
+        def data(parameter: str) -> dict:
+            return {"username": USER, "parameter": parameter, "doc_ref": doc_ref}
+
+        assert await update_parameter(db.transaction(), data("PORTS=8000"))
+        assert await update_parameter(db.transaction(), data("NUM_SNPS=200"))
+        writes = db.writes
+        assert not await update_parameter(db.transaction(), data("UNKNOWN=1"))
+        assert db.writes == writes
+
+        transaction = db.transaction()
+        StudyUpdate(doc_ref).array_union("participants", values=["bob"]).delete("title").apply(transaction)
+        assert (await doc_ref.get()).get("participants") == [USER]  # nothing is written until the commit
+        await transaction.commit()
+
+        expected = study()
+        expected["parameters"]["NUM_SNPS"]["value"] = "200"
+        expected["personal_parameters"][USER]["PORTS"]["value"] = "8000"
+        del expected["title"]
+        assert (await doc_ref.get()).to_dict() == expected | {"participants": [USER, "bob"]}
+
+    asyncio.run(run())
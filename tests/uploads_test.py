@@ -0,0 +1,171 @@
+import asyncio
+import itertools
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+import httpx
+import pytest
+from fake_firestore import FakeFirestore
+from fake_gcs import FakeGCS
+from quart import Quart, request
+from werkzeug.exceptions import BadRequest, NotFound
+
+from src.utils import constants, uploads
+from src.utils.google_cloud import google_cloud_storage
+from src.utils.google_cloud.google_cloud_storage import RESUMABLE_CHUNK_QUANTUM
+from src.utils.uploads import UploadBody, UploadConnection, UploadRequest, resumable_upload
+
+CHUNK = 64 * 1024
+
+
+def receive_from(total: int):
+    sent = 0
+
+    async def receive() -> dict:
+        nonlocal sent
+        if sent >= total:
+            await asyncio.Event().wait()  # the client has sent everything
+        sent += CHUNK
+        return {"type": "http.request", "body": b"x" * CHUNK, "more_body": sent < total}
+
+    return receive
+
+
+def test_upload_body_pauses_the_client_while_the_app_is_behind(monkeypatch):
+    monkeypatch.setattr(constants, "UPLOAD_BUFFER_SIZE", 4 * CHUNK)
+
+    async def run():
+        total = 100 * CHUNK
+        request = SimpleNamespace(body=UploadBody(None, None))
+        connection = UploadConnection(Quart(__name__), {"type": "http"})
+        receiver = asyncio.create_task(connection.handle_messages(request, receive_from(total)))
+
+        received = 0
+        largest = 0
+        async for chunk in request.body:
+            largest = max(largest, len(chunk))
+            received += len(chunk)
+            await asyncio.sleep(0.001)  # a slow upstream
+        receiver.cancel()
+
+        assert received == total
+        assert largest <= constants.UPLOAD_BUFFER_SIZE
+
+    asyncio.run(run())
+
+
+def test_awaiting_an_upload_body_is_not_limited(monkeypatch):
+    monkeypatch.setattr(constants, "UPLOAD_BUFFER_SIZE", 4 * CHUNK)
+
+    async def run():
+        request = SimpleNamespace(body=UploadBody(None, None))
+        connection = UploadConnection(Quart(__name__), {"type": "http"})
+        receiver = asyncio.create_task(connection.handle_messages(request, receive_from(10 * CHUNK)))
+        assert len(await asyncio.wait_for(request.body, 5)) == 10 * CHUNK
+        receiver.cancel()
+
+    asyncio.run(run())
+
+
+def test_only_streaming_upload_paths_use_the_bounded_body():
+    async def run():
+        app = Quart(__name__)
+        app.request_class = UploadRequest
+        async with app.test_request_context("/api/upload_file", method="POST"):
+            assert isinstance(request.body, UploadBody)
+            assert request.body._max_content_length == constants.MAX_UPLOAD_SIZE
+        async with app.test_request_context("/api/other", method="POST"):
+            assert not isinstance(request.body, UploadBody)
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def gcs(monkeypatch) -> FakeGCS:
+    gcs = FakeGCS()
+    sessions = itertools.count()
+
+    async def create_session(file_path: str, content_type: str, size: Optional[int]) -> str:
+        return gcs.create_session(f"session{next(sessions)}")
+
+    monkeypatch.setattr(google_cloud_storage, "_http", httpx.AsyncClient(transport=gcs.transport))
+    monkeypatch.setattr(uploads, "_create_session", create_session)
+    return gcs
+
+
+async def put(db: FakeFirestore, data: bytes, content_range: str, upload_id: str = "") -> Tuple[str, int, bool]:
+    headers = {"Content-Range": content_range}
+    async with Quart(__name__).test_request_context("/api/upload_file", method="PUT", data=data, headers=headers):
+        return await resumable_upload(request, db, "study", "1", "result.txt", upload_id)
+
+
+def test_uploads_of_the_same_file_and_size_are_kept_apart(gcs):
+    async def run():
+        db = FakeFirestore()
+        old, new = b"o" * (2 * RESUMABLE_CHUNK_QUANTUM), b"n" * (2 * RESUMABLE_CHUNK_QUANTUM)
+        total = len(old)
+        first_part = f"bytes 0-{RESUMABLE_CHUNK_QUANTUM - 1}/{total}"
+        old_id, committed, _ = await put(db, old[:RESUMABLE_CHUNK_QUANTUM], first_part)
+        assert committed == RESUMABLE_CHUNK_QUANTUM
+
+        # a fresh upload of another file with the same size doesn't resume the abandoned one
+        new_id, committed, complete = await put(db, new, f"bytes 0-{total - 1}/{total}")
+        assert new_id != old_id and complete and committed == total
+        assert list(gcs.blobs.values()) == [new]
+        assert not (await db.collection(uploads.UPLOADS_COLLECTION).document(new_id).get()).exists
+
+        # while the abandoned one can still be resumed by its ID
+        _, committed, complete = await put(
+            db, old[RESUMABLE_CHUNK_QUANTUM:], f"bytes {RESUMABLE_CHUNK_QUANTUM}-{total - 1}/{total}", old_id
+        )
+        assert complete and sorted(gcs.blobs.values()) == sorted([old, new])
+
+    asyncio.run(run())
+
+
+def test_progress_is_reported_for_an_upload_id(gcs):
+    async def run():
+        db = FakeFirestore()
+        total = 2 * RESUMABLE_CHUNK_QUANTUM
+        first_part = f"bytes 0-{RESUMABLE_CHUNK_QUANTUM - 1}/{total}"
+        upload_id, _, _ = await put(db, b"x" * RESUMABLE_CHUNK_QUANTUM, first_part)
+        assert await put(db, b"", f"bytes */{total}", upload_id) == (upload_id, RESUMABLE_CHUNK_QUANTUM, False)
+
+    asyncio.run(run())
+
+
+def test_unknown_expired_and_mismatched_upload_ids_are_rejected(gcs):
+    async def run():
+        db = FakeFirestore()
+        with pytest.raises(NotFound):
+            await put(db, b"", "bytes */10", "unknown")
+
+        upload_id, _, _ = await put(db, b"", "bytes */10")
+        with pytest.raises(NotFound):
+            await put(db, b"", "bytes */11", upload_id)
+
+        record_ref = db.collection(uploads.UPLOADS_COLLECTION).document(upload_id)
+        await record_ref.update({"expires": datetime.now(timezone.utc) - timedelta(seconds=1)})
+        with pytest.raises(NotFound):
+            await put(db, b"", "bytes */10", upload_id)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "data, content_range",
+    [
+        (b"x" * 5, "bytes 0-9/10"),  # shorter than its range
+        (b"x" * 15, "bytes 0-9/10"),  # longer than its range
+        (b"x" * 10, "bytes 0-10/10"),  # past the end of the upload
+        (b"x" * 10, "bytes 9-0/10"),  # backwards
+    ],
+)
+def test_bodies_that_do_not_match_their_content_range_are_rejected(gcs, data, content_range):
+    async def run():
+        with pytest.raises(BadRequest):
+            await put(FakeFirestore(), data, content_range)
+        assert not gcs.blobs
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import asyncio
+import io
+import zipfile
+from typing import Dict, List, Optional
+
+import pytest
+from fake_gcs import FakeBlob
+from quart import Quart
+
+from src import auth
+from src.web import web
+from src.web.web import storage
+
+STUDY_ID = "6a0b1c2d-3e4f-4a5b-8c6d-7e8f9a0b1c2d"
+URL = f"/api/download_results_file?study_id={STUDY_ID}"
+
+
+@pytest.fixture
+def app(monkeypatch) -> Quart:
+    blobs = {
+        f"{STUDY_ID}/p0/result.txt": FakeBlob("result.txt", b"result line\n" * 200),
+        f"{STUDY_ID}/p0/manhattan.png": FakeBlob("manhattan.png", bytes(range(256)) * 20, generation=2),
+    }
+
+    async def get_user_id() -> str:
+        return "alice"
+
+    async def fetch_study(_study_id: str, _user_id: str) -> tuple:
+        return None, None, {"participants": ["alice", "bob"], "study_type": "SF-GWAS"}
+
+    async def metadata_many(_bucket_name: str, blob_names: List[str]) -> Dict[str, Optional[FakeBlob]]:
+        return {name: blobs.get(name) for name in blob_names}
+
+    monkeypatch.setattr(auth, "get_user_id", get_user_id)
+    monkeypatch.setattr(web, "fetch_study", fetch_study)
+    monkeypatch.setattr(storage, "metadata_many", metadata_many)
+    app = Quart(__name__)
+    app.register_blueprint(web.bp)
+    return app
+
+
+def get(app: Quart, **headers: str):
+    async def run():
+        response = await app.test_client().get(URL, headers=headers)
+        return response, await response.get_data()
+
+    return asyncio.run(run())
+
+
+def test_results_archive_is_a_valid_zip(app):
+    response, whole = get(app)
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == str(len(whole))
+    with zipfile.ZipFile(io.BytesIO(whole)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["result.txt", "manhattan.png"]
+        assert zf.read("result.txt") == b"result line\n" * 200
+
+
+@pytest.mark.parametrize("range_header, start, stop", [("bytes=100-2599", 100, 2600), ("bytes=-700", -700, None)])
+def test_range_requests_get_part_of_the_archive(app, range_header, start, stop):
+    _, whole = get(app)
+    response, body = get(app, Range=range_header)
+    part = range(len(whole))[start:stop]
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes {part[0]}-{part[-1]}/{len(whole)}"
+    assert body == whole[start:stop]
+
+
+def test_range_requests_for_another_archive_get_the_whole_archive(app):
+    response, whole = get(app)
+    etag = response.headers["ETag"]
+
+    response, body = get(app, Range="bytes=100-199", **{"If-Range": etag})
+    assert response.status_code == 206 and body == whole[100:200]
+
+    response, body = get(app, Range="bytes=100-199", **{"If-Range": '"another-archive"'})
+    assert response.status_code == 200 and body == whole